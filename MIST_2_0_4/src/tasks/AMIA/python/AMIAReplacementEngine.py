@@ -116,17 +116,17 @@ class AMIAClearRenderingStrategy(ClearRenderingStrategy):
 
     def HOSPITALReplace(self, pattern, **kw):
         if pattern.isRoomNumber:
-            return _IDReplace(pattern.input)
+            return _IDReplace(pattern.input, pattern.rng)
         else:
             return ClearRenderingStrategy.HOSPITALReplace(self, pattern, **kw)
     
     def DOCTORReplace(self, pattern, **kw):
         if pattern.isDoctorInitials:
-            return _IDReplace(pattern.input)
+            return _IDReplace(pattern.input, pattern.rng)
         elif pattern.transcriberToks is not None:
             # Note I have to tell the category that it should use the pattern, because
             # the category isn't created by the replacer.
-            return _IDReplace(pattern.transcriberToks[0]) + " / " + \
+            return _IDReplace(pattern.transcriberToks[0], pattern.rng) + " / " + \
                    pattern.replacer.transcriptionCache.Replace(PIIIDPattern(pattern.replacer,
                                                                             pattern.transcriberToks[1]))
         else:
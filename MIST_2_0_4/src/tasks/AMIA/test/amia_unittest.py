@@ -340,3 +340,650 @@ class CoreferenceTest(MAT.UnitTest.MATTestCase):
         else:
             self.assertEqual(len(seen), 2)
         rEngine.EndDocumentForReplacement()
+
+# The replacement engine tests all start from the clear -> clear
+# replacer for the task, either directly or through the standalone
+# engine.
+
+class ReplacementEngineTestCase(MAT.UnitTest.MATTestCase):
+
+    def setUp(self):
+        MAT.UnitTest.MATTestCase.setUp(self)
+        self.task = MAT.PluginMgr.LoadPlugins().getTask("AMIA Deidentification")
+        self.rCls = self.task.findReplacer("clear -> clear")[0]
+
+    def _newEngine(self, **kw):
+        return self.rCls(self.task.getReplacerRDirs(), self.task.categories, **kw)
+
+    # A repository which reads the resources rather than a snapshot.
+
+    def _newRepository(self, **kw):
+        import ReplacementEngine
+        return ReplacementEngine.Repository(self.task.getReplacerRDirs(), findSnapshot = False, **kw)
+
+    def _newStandaloneEngine(self):
+        import AMIAReplacementEngine
+        e = AMIAReplacementEngine.AMIAStandaloneReplacementEngine()
+        for d in self.task.getReplacerRDirs():
+            e.addResourceDir(d)
+        return e
+
+# With a surrogate key, the replacements shouldn't depend on the
+# order in which the engine sees the inputs, or on which engine
+# instance sees them.
+
+class SurrogateKeyTest(ReplacementEngineTestCase):
+
+    def testSurrogateKey(self):
+        # "Sidney Pye" and "Pye, Sidney" share a replacement seed, and
+        # the seed mustn't depend on which of them is replaced first.
+        inputs = [("PATIENT", "Sidney Pye"), ("PHONE", "(617) 555-1234"),
+                  ("DATE", "March 3, 2009"), ("AGE", "45"), ("ID", "AB12345"),
+                  ("PATIENT", "Pye, Sidney")]
+        results = []
+        for seq in [inputs, list(reversed(inputs))]:
+            r = self._newEngine(surrogate_key = "test key")
+            r.setDocumentScope("doc1")
+            pats = [(lab, s, r.Digest(lab, s)) for lab, s in seq]
+            r.EndDocumentForDigestion()
+            results.append(dict([((lab, s), r.Replace(lab, pat)) for lab, s, pat in pats]))
+            r.EndDocumentForReplacement()
+        self.assertEqual(results[0], results[1])
+
+# With the persistent cache scope, a new engine should produce the
+# same replacements as the old one.
+
+class PersistentCacheTest(ReplacementEngineTestCase):
+
+    def setUp(self):
+        ReplacementEngineTestCase.setUp(self)
+        import tempfile
+        self.cacheDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        ReplacementEngineTestCase.tearDown(self)
+        import shutil
+        shutil.rmtree(self.cacheDir)
+
+    def _newPersistentEngine(self, cacheScope):
+        return self._newEngine(cache_scope = cacheScope,
+                               persistent_cache_file = os.path.join(self.cacheDir, "cache.db"))
+
+    def testPersistentCache(self):
+        inputs = [("PATIENT", "Sidney Pye"), ("PATIENT", "Pye"), ("PHONE", "(617) 555-1234")]
+        results = []
+        for i in range(2):
+            r = self._newPersistentEngine("PATIENT,persistent;PHONE,persistent")
+            pats = [(lab, s, r.Digest(lab, s)) for lab, s in inputs]
+            r.EndDocumentForDigestion()
+            results.append(dict([((lab, s), r.Replace(lab, pat)) for lab, s, pat in pats]))
+            r.EndDocumentForReplacement()
+            r.EndReplacement()
+            r.persistentStore.close()
+        self.assertEqual(results[0], results[1])
+
+    # The strategies fill in parts of the seeds after they're stored
+    # (here, the middle names), and those have to be stored too. The
+    # second engine doesn't use the replacement cache, so the middle
+    # initials have to come from the stored seeds.
+
+    def testPersistentSeeds(self):
+        names = ["John A. Morero", "Mary B. Burton", "Cynthia C. D. Phillips"]
+        results = []
+        for i in range(2):
+            r = self._newPersistentEngine("PATIENT,persistent")
+            if i == 1:
+                r.getReplacer("PATIENT").useCache(False)
+            pats = [r.Digest("PATIENT", n) for n in names]
+            r.EndDocumentForDigestion()
+            results.append([r.Replace("PATIENT", pat).split()[1:] for pat in pats])
+            # The keys for a name still share one seed.
+            seedCache = r.getReplacer("PATIENT").seedCache
+            seeds = [seedCache[k] for k in pats[0].getReplacementCacheKeysForStorage()]
+            for seed in seeds[1:]:
+                self.failUnless(seed is seeds[0])
+            r.EndDocumentForReplacement()
+            r.EndReplacement()
+            r.persistentStore.close()
+        self.assertEqual(results[0], results[1])
+
+class OffsetMapTest(ReplacementEngineTestCase):
+
+    def testOffsetMap(self):
+        r = self._newEngine()
+        signal = u"Hello John Smith, call 555-1234 now."
+        output, tuples, m = r.TransformWithOffsetMap(signal, u"PRO ", [("PATIENT", 6, 16, u"Bo"),
+                                                                        ("PHONE", 23, 31, u"555-9876")], [])
+        self.assertEqual(output, u"PRO Hello Bo, call 555-9876 now.")
+        self.assertEqual(m.spanToTarget(6, 16), (10, 12))
+        self.assertEqual(m.spanToTarget(17, 22), (13, 18))
+        self.assertEqual(m.spanToSource(19, 27), (23, 31))
+        self.assertEqual(m.spanToTarget(7, 9), (10, 12))
+
+# The date digestion cache has to agree with the parser, even for
+# dates with the same shape.
+
+class DateDigestCacheTest(ReplacementEngineTestCase):
+
+    def testDateDigestCache(self):
+        # Sets up the path for dateutil.
+        self._newEngine()
+        import dateutil.parser
+        c = dateutil.parser.digestcache()
+        for s in ["03/15/2009", "04/12/2010", "13/03/2009", "3/4/05", "3/4/75",
+                  "10:30 am", "12:30 am", "March 3, 2009", "02/30/2009",
+                  # Compact dates, where the numbers are parts of
+                  # one run of digits.
+                  "20090105", "20091217", "19571012", "090105", "280618", "091217"]:
+            try:
+                p = dateutil.parser.digest(s)
+            except ValueError:
+                self.assertRaises(ValueError, c.digest, s)
+                continue
+            q = c.digest(s)
+            self.assertEqual(repr(p.pseq), repr(q.pseq))
+            self.assertEqual(p.dt, q.dt)
+
+class ReplacementProfileTest(ReplacementEngineTestCase):
+
+    def testReplacementProfile(self):
+        r = self._newEngine(cache_scope = "PATIENT,batch")
+        self.assertEqual(r.getProfileReport(), None)
+        r.enableProfiling()
+        for i in range(2):
+            pat = r.Digest("PATIENT", "John Smith")
+            r.EndDocumentForDigestion()
+            r.Replace("PATIENT", pat)
+            r.EndDocumentForReplacement()
+        report = r.getProfileReport()
+        self.assertEqual(report["operations"]["Digest"]["PATIENT"]["calls"], 2)
+        self.assertEqual(report["operations"]["Replace"]["PATIENT"]["calls"], 2)
+        self.assertEqual(report["caches"]["PATIENT"]["cache"]["hits"], 1)
+        self.assertEqual(report["caches"]["PATIENT"]["cache"]["misses"], 1)
+        self.failUnless(report["resources"].has_key("loadNames"))
+        r.disableProfiling()
+        r.Digest("PATIENT", "Mary Jones")
+        self.assertEqual(r.getProfileReport(), None)
+        # An engine which shares the repository has its own profile,
+        # and turning off the first engine's doesn't affect it.
+        other = self._newEngine(repository = r.repository)
+        other.enableProfiling()
+        r.enableProfiling()
+        r.disableProfiling()
+        pat = other.Digest("PATIENT", "Mary Jones")
+        other.EndDocumentForDigestion()
+        other.Replace("PATIENT", pat)
+        self.failUnless(other.getProfileReport()["resources"].has_key("loadNames"))
+
+    # The persistent cache is probed during digestion (see
+    # canSkipDigestion()), but only Replace() counts the lookup.
+
+    def testPersistentCacheProfile(self):
+        import tempfile, shutil
+        d = tempfile.mkdtemp()
+        try:
+            for i in range(2):
+                r = self._newEngine(cache_scope = "PATIENT,persistent",
+                                    persistent_cache_file = os.path.join(d, "cache.db"),
+                                    profile_replacement = True)
+                pat = r.Digest("PATIENT", "John Smith")
+                r.EndDocumentForDigestion()
+                r.Replace("PATIENT", pat)
+                r.EndDocumentForReplacement()
+                r.EndReplacement()
+                r.persistentStore.close()
+            counts = r.getProfileReport()["caches"]["PATIENT"]["cache"]
+            self.assertEqual((counts["hits"], counts["misses"]), (1, 0))
+        finally:
+            shutil.rmtree(d)
+
+class ReplacementServerTest(ReplacementEngineTestCase):
+
+    def testReplacementServer(self):
+        import ReplacementServer
+        server = ReplacementServer.ReplacementServer(self._newStandaloneEngine)
+        resp = server.handleRequest({"id": 1, "replacer": "clear -> [ ]", "signal": u"Hello John Smith.",
+                                     "tuples": [["PATIENT", 6, 16]]})
+        self.assertEqual(resp, {"id": 1, "signal": u"Hello [PATIENT].", "tuples": [["PATIENT", 6, 15]]})
+        # In a session, the caches persist across requests.
+        r1 = server.handleRequest({"replacer": "clear -> clear", "signal": u"Hello John Smith.",
+                                   "tuples": [["PATIENT", 6, 16]], "session": "s"})
+        r2 = server.handleRequest({"replacer": "clear -> clear", "signal": u"John Smith left.",
+                                   "tuples": [["PATIENT", 0, 10]], "session": "s"})
+        self.assertEqual(r1["signal"][6:-1], r2["signal"][:-6])
+        self.failUnless(server.handleRequest({"replacer": "nonexistent", "signal": u"x"}).has_key("error"))
+
+class ConvertBatchTest(ReplacementEngineTestCase):
+
+    def testConvertBatch(self):
+        e = self._newStandaloneEngine()
+        evts = []
+        for signal, tuples in [(u"Seen at 12 Main St., Boston, MA 02110 by John Smith.", [("LOCATION", 8, 37), ("PATIENT", 41, 51)]),
+                               (u"She lives in Cambridge.", [("LOCATION", 13, 22)]),
+                               (u"Call 555-1234.", [("PHONE", 5, 13)])]:
+            evt = e.newEvent(signal)
+            for t in tuples:
+                evt.addTuple(*t)
+            evts.append(evt)
+        res = e.convertBatch(evts, "clear -> [ ]")
+        self.assertEqual([r[0] for r in res], [u"Seen at [LOCATION] by [PATIENT].", u"She lives in [LOCATION].",
+                                               u"Call [PHONE]."])
+        res = e.convertBatch(evts, "clear -> clear")
+        self.assertEqual(len(res), 3)
+        for evt, (signal, tuples) in zip(evts, res):
+            self.assertEqual(signal, evt.getReplacedSignal())
+            self.assertEqual(tuples, evt.getReplacedTuples())
+
+    # Each event in a batch is converted in its own document scope, so
+    # with a surrogate key, a batch gives the same replacements as
+    # converting the events one at a time.
+
+    def testConvertBatchDocumentScope(self):
+        e = self._newStandaloneEngine()
+        docs = [("a.txt", u"John Smith called 555-1234.", [("PATIENT", 0, 10), ("PHONE", 18, 26)]),
+                ("b.txt", u"Call John Smith at 555-1234.", [("PATIENT", 5, 15), ("PHONE", 19, 27)])]
+        def newEvents():
+            evts = []
+            for name, signal, tuples in docs:
+                evt = e.newEvent(signal, documentScope = name)
+                for t in tuples:
+                    evt.addTuple(*t)
+                evts.append(evt)
+            return evts
+        rEngine = e.newReplacementEngine("clear -> clear", surrogate_key = "test key")
+        single = []
+        for evt in newEvents():
+            evt.convertWithEngine(rEngine)
+            single.append([evt.getReplacedSignal(), evt.getReplacedTuples()])
+        e.definedReplacers["clear -> clear"] = e.newReplacementEngine("clear -> clear", surrogate_key = "test key")
+        self.assertEqual(e.convertBatch(newEvents(), "clear -> clear"), single)
+
+# Contexts share the engine's resources, but not its caches, so they
+# can convert in different threads at once.
+
+class ReplacementContextTest(ReplacementEngineTestCase):
+
+    def testReplacementContexts(self):
+        import threading
+        e = self._newStandaloneEngine()
+        rEngine = e.getReplacementEngine("clear -> clear")
+        ctx = rEngine.newContext()
+        self.failUnless(ctx.repository is rEngine.repository)
+        self.failIf(ctx.getReplacer("PATIENT") is rEngine.getReplacer("PATIENT"))
+        e.setThreadSafe(True)
+        results = []
+        def work():
+            for i in range(20):
+                evt = e.newEvent(u"Seen by John Smith on 03/15/2009.")
+                evt.addTuple("PATIENT", 8, 18)
+                evt.addTuple("DATE", 22, 32)
+                evt.convert("clear -> clear")
+                results.append(evt.getReplacedTuples())
+        threads = [threading.Thread(target = work) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(results), 80)
+        for tuples in results:
+            self.assertEqual([t[0] for t in tuples], ["PATIENT", "DATE"])
+
+# Digesting a document a label at a time gives the same patterns as
+# digesting it span by span. The combined phone pattern has to prefer
+# the patterns in the order they're listed.
+
+class DigestDocumentTest(ReplacementEngineTestCase):
+
+    def testDigestMany(self):
+        spans = [("PHONE", "(617) 555-1234"), ("PATIENT", "John Smith"), ("PHONE", "555-1234"),
+                 ("AGE", "45"), ("PHONE", "617-555-1234 or (508) 555-1234"), ("PHONE", "Tel: 555-1234"),
+                 ("PATIENT", "Smith, John"), ("PHONE", "no number")]
+        r1 = self._newEngine()
+        r2 = self._newEngine()
+        pats = r1.DigestDocument(spans)
+        for (lab, seed), pat in zip(spans, pats):
+            self.assertEqual(pat.__dict__.keys(), r2.Digest(lab, seed).__dict__.keys())
+        self.assertEqual(pats[4].preS, "617-555-1234 or ")
+        self.assertEqual(pats[4].parse["areaCode"], "508")
+        self.assertEqual(pats[5].preS, "")
+        self.assertEqual(pats[5].parse["areaCode"], "Tel: ")
+        self.failUnless(pats[7].seed_unparseable)
+
+# The state trie finds the shortest state at the end of the tokens,
+# ignoring case and commas, just like looking up the last one, two
+# and three tokens in turn.
+
+class StateTrieTest(ReplacementEngineTestCase):
+
+    def testStateTrie(self):
+        r = self._newEngine()
+        states = r.repository.loadStates()
+        trie = r.repository.getStateTrie()
+        norm = lambda t: t.replace(",", "").upper()
+        for toks in [["Boston,", "MA"], ["Albany,", "New", "York"], ["Raleigh", "north", "carolina,"],
+                     ["Main", "St."], [], ["Springfield", "Ma."]]:
+            expected = None
+            for i in range(1, min(3, len(toks)) + 1):
+                eList = states.lookUp(" ".join(toks[-i:]).replace(",", ""))
+                if eList:
+                    expected = (i, eList[0][0])
+                    break
+            self.assertEqual(trie.shortestSuffix(toks, 3, norm), expected)
+        pat = r.Digest("LOCATION", "12 Main St., Boston, MA 02110")
+        self.assertEqual(pat.parse["state"], "MA")
+        self.assertEqual(pat.parse["cityToks"], ["Boston"])
+
+# Compacting the names doesn't change the choices.
+
+class CompactNamesTest(ReplacementEngineTestCase):
+
+    def testCompactNames(self):
+        import random
+        compact = self._newRepository().loadNames()
+        plain = self._newRepository(compact = False).loadNames()
+        self.failIf(compact.lastNameDist.__class__ is plain.lastNameDist.__class__)
+        for attr in ["maleFirstNameDist", "femaleFirstNameDist", "lastNameDist"]:
+            self.assertEqual(getattr(compact, attr).WeightedChoices(50, rng = random.Random(7)),
+                             getattr(plain, attr).WeightedChoices(50, rng = random.Random(7)))
+        for k in ["MCDONALD", "OBRIEN", "SMITH", "NOTANAME"]:
+            self.assertEqual(compact.capitalizationHash.get(k), plain.capitalizationHash.get(k))
+
+# A frozen repository stores every group in the snapshot
+# representation, and makes the same choices.
+
+class FreezeRepositoryTest(ReplacementEngineTestCase):
+
+    def testFreezeRepository(self):
+        import random
+        frozen = self._newRepository()
+        frozen.freeze()
+        plain = self._newRepository(compact = False)
+        plain.preloadAll()
+        self.failIf(type(frozen.streetNames) is list)
+        self.failIf(frozen.hospitals.__class__ is plain.hospitals.__class__)
+        self.assertEqual(frozen.hospitals.WeightedChoices(50, rng = random.Random(7)),
+                         plain.hospitals.WeightedChoices(50, rng = random.Random(7)))
+        self.assertEqual(frozen.datePatternDist.WeightedChoices(50, rng = random.Random(7)),
+                         plain.datePatternDist.WeightedChoices(50, rng = random.Random(7)))
+        self.assertEqual(list(frozen.areaCodes), list(plain.areaCodes))
+        self.assertEqual([(frozen.townTuples[i][0], frozen.townTuples[i][1].alts["shortabbr"][0], frozen.townTuples[i][2]) for i in range(0, len(plain.townTuples), 97)],
+                         [(plain.townTuples[i][0], plain.townTuples[i][1].alts["shortabbr"][0], plain.townTuples[i][2]) for i in range(0, len(plain.townTuples), 97)])
+        self.assertEqual(dict([(k, (g, n)) for k, (g, d, n) in frozen.getFirstNameHash().items()]),
+                         dict([(k, (g, n)) for k, (g, d, n) in plain.getFirstNameHash().items()]))
+
+class NominateStepTest(MAT.UnitTest.MATTestCase):
+
+    # With a surrogate key, parallel and streaming nomination should
+    # produce exactly what serial nomination produces.
+
+    def testParallelNomination(self):
+        if not NOT_WINDOWS:
+            return
+        task = MAT.PluginMgr.LoadPlugins().getTask("AMIA Deidentification")
+        labels = task.getAnnotationTypesByCategory("content")
+        _jsonIO = MAT.DocumentIO.getDocumentIO("mat-json", task = task)
+        p = os.path.join(self.testContext["AMIA_TEST_DOCS"], "111_modified.amia.xml.json")
+        results = []
+        for workerKw in [{}, {"nominate_workers": "3"}, {"nominate_streaming": True}]:
+            # Need to reset this - ugh.
+            if task._instantiatedReplacerCache.has_key("clear -> clear"):
+                del task._instantiatedReplacerCache["clear -> clear"]
+            dList = [("doc%d.json" % i, _jsonIO.readFromSource(p)) for i in range(5)]
+            outputDList = MAT.ToolChain.MATEngine(taskObj = task, workflow = "Demo").RunDataPairs(dList, ["nominate"], replacer = "clear -> clear", surrogate_key = "test key", **workerKw)
+            results.append([[a[task.REDACTION_ATTR] for a in d.orderAnnotations(labels)] for f, d in outputDList])
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+
+    # The forked digest workers consult the persistent cache (to skip
+    # digesting what's already been replaced), so they each need
+    # their own connection to it. The second parallel run finds
+    # everything in the cache the first one wrote.
+
+    def testParallelPersistentNomination(self):
+        if not NOT_WINDOWS:
+            return
+        import tempfile, shutil
+        task = MAT.PluginMgr.LoadPlugins().getTask("AMIA Deidentification")
+        labels = task.getAnnotationTypesByCategory("content")
+        _jsonIO = MAT.DocumentIO.getDocumentIO("mat-json", task = task)
+        p = os.path.join(self.testContext["AMIA_TEST_DOCS"], "111_modified.amia.xml.json")
+        tmpDir = tempfile.mkdtemp()
+        try:
+            results = []
+            for cacheFile, workerKw in [("serial.db", {}), ("parallel.db", {"nominate_workers": "3"}),
+                                        ("parallel.db", {"nominate_workers": "3"})]:
+                if task._instantiatedReplacerCache.has_key("clear -> clear"):
+                    del task._instantiatedReplacerCache["clear -> clear"]
+                dList = [("doc%d.json" % i, _jsonIO.readFromSource(p)) for i in range(5)]
+                outputDList = MAT.ToolChain.MATEngine(taskObj = task, workflow = "Demo").RunDataPairs(dList, ["nominate"], replacer = "clear -> clear", surrogate_key = "test key", cache_scope = "PATIENT,persistent;DOCTOR,persistent", persistent_cache_file = os.path.join(tmpDir, cacheFile), **workerKw)
+                results.append([[a[task.REDACTION_ATTR] for a in d.orderAnnotations(labels)] for f, d in outputDList])
+                task._instantiatedReplacerCache["clear -> clear"].persistentStore.close()
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(results[0], results[2])
+        finally:
+            if task._instantiatedReplacerCache.has_key("clear -> clear"):
+                del task._instantiatedReplacerCache["clear -> clear"]
+            shutil.rmtree(tmpDir)
+
+class TransformStepTest(MAT.UnitTest.MATTestCase):
+
+    # A document with overlapping content annotations or an unreviewed
+    # unparseable seed is skipped, but the rest of the batch is
+    # still transformed.
+
+    def testTransformSkipsBadDocuments(self):
+        task = MAT.PluginMgr.LoadPlugins().getTask("AMIA Deidentification")
+        labels = task.getAnnotationTypesByCategory("content")
+        _jsonIO = MAT.DocumentIO.getDocumentIO("mat-json", task = task)
+        p = os.path.join(self.testContext["AMIA_TEST_DOCS"], "111_modified.amia.xml.json")
+        dList = [("doc%d.json" % i, _jsonIO.readFromSource(p)) for i in range(3)]
+        engine = MAT.ToolChain.MATEngine(taskObj = task, workflow = "Demo")
+        dList = engine.RunDataPairs(dList, ["nominate"], replacer = "clear -> clear")
+        a = dList[1][1].orderAnnotations(labels)[0]
+        dList[1][1].createAnnotation(a.start, a.end, a.atype.lab)
+        dList[2][1].orderAnnotations(labels)[0][task.SEED_UNPARSEABLE_ATTR] = "PHONE"
+        step = task.getStep("Demo", "transform")
+        self.assertEqual(sorted(step.findUntransformableDocuments(dList, labels).keys()), [1, 2])
+        outputDList = engine.RunDataPairs(dList, ["transform"], replacer = "clear -> clear")
+        self.assertEqual([f for f, d in outputDList], ["doc0.json"])
+
+class CarafeTaggingTest(MAT.UnitTest.MATTestCase):
+
+    # The resident taggers tag each document in a call of its own.
+    # This doesn't need jCarafe: the tagger is a stand-in XML-RPC
+    # service which marks the whole signal.
+
+    STAND_IN_TAGGER = """
+import sys, base64, json, SimpleXMLRPCServer
+def tag(s):
+    d = json.loads(base64.b64decode(s))
+    d["asets"] = [{"type": "DOCTOR", "attrs": [], "annots": [[0, len(d["signal"])]]}]
+    return base64.b64encode(json.dumps(d))
+server = SimpleXMLRPCServer.SimpleXMLRPCServer(("127.0.0.1", int(sys.argv[1])), logRequests = False)
+server.register_function(tag, "jarafe.processBase64String")
+server.serve_forever()
+"""
+
+    def testCarafeTaggerPool(self):
+        # Sets up the path for the task's Python.
+        MAT.PluginMgr.LoadPlugins()
+        import CarafeTaggerPool, tempfile, shutil
+        d = tempfile.mkdtemp()
+        pool = CarafeTaggerPool.CarafeTaggerPool()
+        try:
+            script = os.path.join(d, "tagger.py")
+            fp = open(script, "w")
+            fp.write(self.STAND_IN_TAGGER)
+            fp.close()
+            tagger = pool.getTaggerForCommand([sys.executable, script, "%(port)s"], processes = 2)
+            docs = [{"signal": u"Mr. Smith", "asets": []},
+                    {"signal": u"Dr. Jones saw her.", "asets": []},
+                    {"signal": u"", "asets": []}]
+            results = tagger.tagDocuments(docs)
+            self.assertEqual([[aset["annots"] for aset in asets] for asets in results],
+                             [[[[0, 9]]], [[[0, 18]]], [[[0, 0]]]])
+        finally:
+            pool.shutdown()
+            shutil.rmtree(d)
+
+    # The number of jCarafe processes is limited by the documents
+    # and by how many heaps fit in the memory budget.
+
+    def testTaggerWorkers(self):
+        # Sets up the path for the task's Python.
+        MAT.PluginMgr.LoadPlugins()
+        from Deidentification import _getTaggerWorkers
+        self.assertEqual(_getTaggerWorkers(None, None, "1G", 100), 1)
+        self.assertEqual(_getTaggerWorkers("4", None, "1G", 100), 4)
+        self.assertEqual(_getTaggerWorkers("4", None, "1G", 3), 3)
+        self.assertEqual(_getTaggerWorkers("4", "3G", "1G", 100), 3)
+        self.assertEqual(_getTaggerWorkers("4", "2560m", "1G", 100), 2)
+        self.assertEqual(_getTaggerWorkers("4", "512m", "1G", 100), 1)
+        self.assertRaises(MAT.Error.MATError, _getTaggerWorkers, "4", "3G", None, 100)
+        self.assertRaises(MAT.Error.MATError, _getTaggerWorkers, "0", None, None, 100)
+
+# Tests of the deidentification workspace folders and operations.
+
+import shutil
+
+class DeidWorkspaceTest(MAT.UnitTest.MATTestCase):
+
+    def setUp(self):
+        MAT.UnitTest.MATTestCase.setUp(self)
+        self.wdir = os.path.join(self.testContext["TMPDIR"], "testDeidWorkspace")
+        self.inputDir = os.path.join(self.testContext["TMPDIR"], "testDeidWorkspaceInput")
+        for d in [self.wdir, self.inputDir]:
+            if os.path.isdir(d):
+                shutil.rmtree(d)
+        self.workspace = None
+
+    def tearDown(self):
+        MAT.UnitTest.MATTestCase.tearDown(self)
+        if self.workspace is not None:
+            self.workspace.closeDB()
+        for d in [self.wdir, self.inputDir]:
+            if os.path.isdir(d):
+                shutil.rmtree(d)
+
+    # A workspace with gold copies of the test document, named
+    # doc0.json, doc1.json, etc.
+
+    def _createWorkspace(self, numDocs):
+        self.workspace = MAT.Workspace.Workspace(self.wdir, taskName = "AMIA Deidentification",
+                                                 create = True, initialUsers = ["user1"])
+        os.mkdir(self.inputDir)
+        p = os.path.join(self.testContext["AMIA_TEST_DOCS"], "111_modified.amia.xml.json")
+        paths = []
+        for i in range(numDocs):
+            paths.append(os.path.join(self.inputDir, "doc%d.json" % i))
+            shutil.copy(p, paths[-1])
+        self.workspace.importFiles(paths, "core", document_status = "gold", users = "user1")
+        return self.workspace
+
+    # The redacted folders record their contents in the workspace DB.
+
+    def testFolderContents(self):
+        w = self._createWorkspace(3)
+        w.runFolderOperation("core", "redact")
+        db = w.getDB()
+        rich = w.folders["redacted, rich"]
+        self.assertEqual(db.folderContents(rich._folderKey()), set(["doc0.json", "doc1.json", "doc2.json"]))
+        rich.removeFile("doc1.json")
+        self.assertEqual(rich.presentDocuments(db), set(["doc0.json", "doc2.json"]))
+        # If the contents were never recorded (e.g., in a workspace
+        # created before the folders were tracked), the first listing
+        # records what's in the directory.
+        db._execute("DELETE FROM folder_index", retrieval = False)
+        db._execute("DELETE FROM folder_contents", retrieval = False)
+        self.assertEqual(db.folderContents(rich._folderKey()), None)
+        self.assertEqual(rich.presentDocuments(db), set(["doc0.json", "doc2.json"]))
+        self.assertEqual(db.folderContents(rich._folderKey()), set(["doc0.json", "doc2.json"]))
+        self.assertEqual([info["basename"] for info in rich.listContents(w.getBasenames(), offset = 1, sort_key = "basename")],
+                         ["doc2.json"])
+        o = w.getFolderOperation("redacted, rich", "list_page")
+        o.do(offset = "0", limit = "1", sort_key = "basename")
+        self.assertEqual(o.total, 2)
+        self.assertEqual([info["basename"] for info in o.page], ["doc0.json"])
+        rich.clear()
+        self.assertEqual(rich.presentDocuments(db), set())
+
+    # Incremental redaction. To see which outputs are rewritten, we
+    # overwrite the raw outputs with a marker.
+
+    def _readManifestDocs(self, w):
+        from MAT import json
+        fp = open(os.path.join(w.dir, "redaction_manifest.json"), "r")
+        m = json.loads(fp.read())
+        fp.close()
+        return sorted(m["documents"].keys())
+
+    def _markOutputs(self, w):
+        raw = w.folders["redacted, raw"]
+        for b in os.listdir(raw.dir):
+            fp = open(os.path.join(raw.dir, b), "w")
+            fp.write("marker")
+            fp.close()
+
+    def _marked(self, w):
+        raw = w.folders["redacted, raw"]
+        res = []
+        for b in sorted(os.listdir(raw.dir)):
+            fp = open(os.path.join(raw.dir, b), "r")
+            if fp.read() == "marker":
+                res.append(b)
+            fp.close()
+        return res
+
+    def testIncrementalRedaction(self):
+        w = self._createWorkspace(3)
+        allDocs = ["doc0.json", "doc1.json", "doc2.json"]
+        w.runFolderOperation("core", "redact", incremental = True)
+        self.assertEqual(self._readManifestDocs(w), allDocs)
+        self.assertEqual(sorted(os.listdir(w.folders["redacted, raw"].dir)), allDocs)
+        # Nothing has changed, so nothing is redacted.
+        self._markOutputs(w)
+        w.runFolderOperation("core", "redact", incremental = True)
+        self.assertEqual(self._marked(w), allDocs)
+        # A changed source is redacted again.
+        fp = open(os.path.join(w.folders["core"].dir, "doc1.json"), "a")
+        fp.write("\n")
+        fp.close()
+        w.runFolderOperation("core", "redact", incremental = True)
+        self.assertEqual(self._marked(w), ["doc0.json", "doc2.json"])
+        # A source which isn't redacted anymore loses its outputs.
+        w.runFolderOperation("core", "redact", incremental = True, basenames = ["doc0.json", "doc1.json"])
+        self.assertEqual(self._readManifestDocs(w), ["doc0.json", "doc1.json"])
+        self.assertEqual(sorted(os.listdir(w.folders["redacted, rich"].dir)), ["doc0.json", "doc1.json"])
+        self.assertEqual(self._marked(w), ["doc0.json"])
+        # A new configuration redacts everything again.
+        w.runFolderOperation("core", "redact", incremental = True, replacer = "clear -> [ ]")
+        self.assertEqual(self._readManifestDocs(w), allDocs)
+        self.assertEqual(self._marked(w), [])
+
+    # With retain_existing, a new configuration doesn't clear the
+    # folders, but the outputs whose sources are gone are still removed.
+
+    def testIncrementalRedactionRetainExisting(self):
+        w = self._createWorkspace(3)
+        w.runFolderOperation("core", "redact", incremental = True)
+        w.runFolderOperation("core", "redact", incremental = True, retain_existing = True,
+                             replacer = "clear -> [ ]", basenames = ["doc0.json", "doc1.json"])
+        self.assertEqual(self._readManifestDocs(w), ["doc0.json", "doc1.json"])
+        self.assertEqual(sorted(os.listdir(w.folders["redacted, raw"].dir)), ["doc0.json", "doc1.json"])
+
+    # A document the transform step skips loses its old outputs, and
+    # drops out of the manifest, so it's tried again next time.
+
+    def testIncrementalRedactionSkipsBadDocuments(self):
+        w = self._createWorkspace(3)
+        w.runFolderOperation("core", "redact", incremental = True)
+        task = w.task
+        _jsonIO = MAT.DocumentIO.getDocumentIO("mat-json", task = task)
+        p = os.path.join(w.folders["core"].dir, "doc1.json")
+        d = _jsonIO.readFromSource(p)
+        a = d.orderAnnotations(task.getAnnotationTypesByCategory("content"))[0]
+        d.createAnnotation(a.start, a.end, a.atype.lab)
+        _jsonIO.writeToTarget(d, p)
+        w.runFolderOperation("core", "redact", incremental = True)
+        self.assertEqual(self._readManifestDocs(w), ["doc0.json", "doc2.json"])
+        self.assertEqual(sorted(os.listdir(w.folders["redacted, raw"].dir)), ["doc0.json", "doc2.json"])
@@ -17,7 +17,7 @@ class HInitialsPattern(PIIPattern):
 class HClearRenderingStrategy(ClearRenderingStrategy):
 
     def INITIALSReplace(self, pattern, **kw):
-        return _IDReplace("A" * random.randint(2, 3))
+        return _IDReplace("A" * pattern.rng.randint(2, 3), pattern.rng)
     
 H_CATEGORIES = {"NAME": (PIIPersonPattern, {}),
                 "INITIALS": (HInitialsPattern, {}),
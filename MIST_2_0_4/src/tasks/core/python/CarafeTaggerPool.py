@@ -0,0 +1,405 @@
+# Copyright (C) 2012 The MITRE Corporation. See the toplevel
+# file LICENSE for license terms.
+
+# This file implements a pool of resident jCarafe taggers. The Carafe
+# tag step starts a Java process for each run, which loads the model
+# before it tags anything; for a few documents, that's almost all of
+# the time. jCarafe also comes with an XML-RPC tagging service
+# (org.mitre.itc.jcarafe_server.tagging.JarafeTaggerServer, in the
+# jcarafe_xmlrpc jar; see "jCarafe as a Service using XML-RPC" in the
+# jCarafe users guide), which loads the model once and tags MAT JSON
+# documents until it's stopped. The pool keeps one of those per model
+# (and heap size and decoder options), and sends it the documents.
+
+# - Documents are queued for each tagger, and each of the tagger's
+#   processes has a thread which takes the next document from the queue
+#   and sends it to the process in an XML-RPC call of its own. So
+#   jCarafe sees each document exactly as the Carafe tag step would
+#   give it: its own signal, zones and segments, and nothing else in
+#   the CRF's context. (Joining several documents into one call would
+#   save calls, but it changes the tags: the sentence and zone
+#   boundaries and the context across the joins are different.) What
+#   the pool saves is the process startup and the model load, which
+#   are most of the time for a few documents.
+# - Before a document, if the process has been idle for healthInterval
+#   seconds, it's sent an empty document; if that fails, or the
+#   process has died, or the call fails because the connection does,
+#   the process is restarted and the document is sent again. A
+#   document which fails a second time fails alone; the others in
+#   the queue are still tagged.
+# - A tagger can have several processes serving its queue at once;
+#   see CarafeTagger.
+# - The pool itself lasts as long as the Python process does (e.g.,
+#   MATWeb). To reuse the taggers across processes (e.g., successive
+#   MATEngine runs), give the pool a registry directory. The taggers
+#   it starts are detached and recorded there, and other pools with
+#   the same registry use them if they're still healthy. They run
+#   until stopRegistered() is called.
+
+# Like the replacement server, this doesn't use anything from MAT;
+# documents are MAT JSON dictionaries.
+
+import os, sys, socket, threading, time, subprocess, base64, xmlrpclib, httplib, Queue
+
+try:
+    import json
+except ImportError:
+    # Python 2.5, or Jython. The caller has to make sure it's
+    # on the path.
+    import simplejson as json
+
+SERVER_CLASS = "org.mitre.itc.jcarafe_server.tagging.JarafeTaggerServer"
+
+class CarafeTaggerPoolError(Exception):
+    pass
+
+#
+# The tagger processes.
+#
+
+class _TimeoutTransport(xmlrpclib.Transport):
+
+    def __init__(self, timeout):
+        xmlrpclib.Transport.__init__(self)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        conn = xmlrpclib.Transport.make_connection(self, host)
+        conn.timeout = self.timeout
+        return conn
+
+def _freePort():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def _pidAlive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+class _TaggerProcess:
+
+    # cmd is a list, in which "%(port)s" is replaced by the port.
+
+    def __init__(self, cmd, startupTimeout = 300, callTimeout = 600, detach = False):
+        self.cmd = cmd
+        self.startupTimeout = startupTimeout
+        self.callTimeout = callTimeout
+        self.detach = detach
+        self.process = None
+        self.pid = None
+        self.port = None
+
+    def start(self):
+        self.port = _freePort()
+        cmd = [a.replace("%(port)s", str(self.port)) for a in self.cmd]
+        kw = {}
+        if self.detach and hasattr(os, "setsid"):
+            # So it outlives us.
+            kw["preexec_fn"] = os.setsid
+        devnull = open(os.devnull, "w")
+        try:
+            self.process = subprocess.Popen(cmd, stdin = open(os.devnull, "r"), stdout = devnull,
+                                            stderr = devnull, close_fds = (sys.platform != "win32"), **kw)
+        finally:
+            devnull.close()
+        self.pid = self.process.pid
+        deadline = time.time() + self.startupTimeout
+        while True:
+            if self.process.poll() is not None:
+                raise CarafeTaggerPoolError, ("tagger exited with status %d on startup: %s" % (self.process.returncode, " ".join(cmd)))
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 1).close()
+                return
+            except socket.error:
+                if time.time() > deadline:
+                    self.stop()
+                    raise CarafeTaggerPoolError, ("tagger didn't start within %d seconds: %s" % (self.startupTimeout, " ".join(cmd)))
+                time.sleep(.2)
+
+    # A process started by another pool (see the registry).
+
+    def attach(self, pid, port):
+        self.process = None
+        self.pid = pid
+        self.port = port
+
+    def alive(self):
+        if self.process is not None:
+            return self.process.poll() is None
+        return (self.pid is not None) and _pidAlive(self.pid)
+
+    def tag(self, doc, timeout = None):
+        proxy = xmlrpclib.ServerProxy("http://127.0.0.1:%d" % self.port,
+                                      transport = _TimeoutTransport(timeout or self.callTimeout))
+        res = proxy.jarafe.processBase64String(base64.b64encode(json.dumps(doc)))
+        if isinstance(res, xmlrpclib.Binary):
+            res = res.data
+        try:
+            return json.loads(base64.b64decode(res))
+        except (TypeError, ValueError):
+            return json.loads(res)
+
+    def healthy(self):
+        if not self.alive():
+            return False
+        try:
+            self.tag({"signal": u"", "asets": []}, timeout = 10)
+            return True
+        except (socket.error, httplib.HTTPException, xmlrpclib.Error, ValueError):
+            return False
+
+    def stop(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.terminate()
+                self.process.wait()
+        elif (self.pid is not None) and _pidAlive(self.pid):
+            import signal
+            os.kill(self.pid, signal.SIGTERM)
+        self.process = None
+        self.pid = None
+
+class _Request:
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.done = threading.Event()
+        self.asets = None
+        self.error = None
+
+# A tagger may have more than one process (e.g., to tag a large batch
+# on several cores), each with a thread of its own, all serving the
+# same queue, so each process takes the next document as soon as it's
+# done with the last one.
+
+class _TaggerWorker:
+
+    def __init__(self, tagger, slot):
+        self.tagger = tagger
+        self.slot = slot
+        self.proc = None
+        self.lastUsed = 0
+        self.thread = threading.Thread(target = self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _run(self):
+        queue = self.tagger.queue
+        while True:
+            req = queue.get()
+            if req is None:
+                return
+            try:
+                self._tag(req)
+            except Exception, e:
+                req.error = "%s: %s" % (e.__class__.__name__, e)
+            req.done.set()
+
+    def _ensureProcess(self):
+        if (self.proc is not None) and (time.time() - self.lastUsed < self.tagger.pool.healthInterval) and \
+           self.proc.alive():
+            return
+        if (self.proc is not None) and self.proc.healthy():
+            return
+        self.proc = self.tagger.pool._startProcess(self.tagger.key, self.slot, self.tagger.cmd, self.proc)
+
+    def _tag(self, req):
+        for attempt in (0, 1):
+            self._ensureProcess()
+            try:
+                tagged = self.proc.tag(req.doc)
+                break
+            except (socket.error, httplib.HTTPException):
+                if attempt == 1:
+                    raise
+                # Make sure it's restarted.
+                self.lastUsed = 0
+                if self.proc.healthy():
+                    raise
+        self.lastUsed = time.time()
+        req.asets = [aset for aset in tagged.get("asets", []) if aset.get("hasSpan", True)]
+
+class CarafeTagger:
+
+    def __init__(self, pool, key, cmd, processes = 1):
+        self.pool = pool
+        self.key = key
+        self.cmd = cmd
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.workers = []
+        self.addProcesses(processes)
+
+    # Make sure there are at least this many processes. The new ones
+    # are started when they get their first batch.
+
+    def addProcesses(self, processes):
+        self.lock.acquire()
+        try:
+            while len(self.workers) < processes:
+                self.workers.append(_TaggerWorker(self, len(self.workers)))
+        finally:
+            self.lock.release()
+
+    # Returns, for each document, the spanned annotation sets which
+    # came back from the tagger, in the order of the documents.
+
+    def tagDocuments(self, docs):
+        reqs = [_Request(doc) for doc in docs]
+        for req in reqs:
+            self.queue.put(req)
+        for req in reqs:
+            req.done.wait()
+        for req in reqs:
+            if req.error is not None:
+                raise CarafeTaggerPoolError, req.error
+        return [req.asets for req in reqs]
+
+    def stop(self):
+        for w in self.workers:
+            self.queue.put(None)
+        for w in self.workers:
+            w.thread.join()
+            if w.proc is not None:
+                self.pool._releaseProcess(w.proc)
+                w.proc = None
+
+class CarafeTaggerPool:
+
+    def __init__(self, registryDir = None, healthInterval = 30, startupTimeout = 300, callTimeout = 600):
+        self.registryDir = registryDir
+        self.healthInterval = healthInterval
+        self.startupTimeout = startupTimeout
+        self.callTimeout = callTimeout
+        self.taggers = {}
+        self.lock = threading.Lock()
+
+    # The tagger for a model. jar is the jcarafe_xmlrpc jar; options
+    # are any other decoder options (e.g., ["--prior-adjust", "-1.0"]).
+    # processes is the number of tagger processes (each with its own
+    # heap) for the model.
+
+    def getTagger(self, jar, model, heapSize = None, options = None, java = "java", processes = 1):
+        cmd = [java]
+        if heapSize:
+            cmd.append("-Xmx" + heapSize)
+        cmd += ["-cp", jar, SERVER_CLASS, "%(port)s", "--mode", "json", "--model", model] + list(options or [])
+        return self.getTaggerForCommand(cmd, processes = processes)
+
+    def getTaggerForCommand(self, cmd, processes = 1):
+        key = tuple(cmd)
+        self.lock.acquire()
+        try:
+            try:
+                t = self.taggers[key]
+            except KeyError:
+                t = self.taggers[key] = CarafeTagger(self, key, cmd, processes)
+                return t
+        finally:
+            self.lock.release()
+        t.addProcesses(processes)
+        return t
+
+    def shutdown(self):
+        self.lock.acquire()
+        try:
+            taggers = self.taggers.values()
+            self.taggers = {}
+        finally:
+            self.lock.release()
+        for t in taggers:
+            t.stop()
+
+    # Processes.
+
+    def _registryPath(self, key, slot):
+        import hashlib
+        return os.path.join(self.registryDir, hashlib.sha1(repr((key, slot))).hexdigest())
+
+    def _startProcess(self, key, slot, cmd, oldProc):
+        if oldProc is not None:
+            oldProc.stop()
+        if self.registryDir is None:
+            proc = _TaggerProcess(cmd, self.startupTimeout, self.callTimeout)
+            proc.start()
+            return proc
+        if not os.path.isdir(self.registryDir):
+            os.makedirs(self.registryDir)
+        p = self._registryPath(key, slot)
+        lockFp = open(p + ".lock", "w")
+        try:
+            try:
+                import fcntl
+                fcntl.flock(lockFp, fcntl.LOCK_EX)
+            except ImportError:
+                pass
+            proc = _TaggerProcess(cmd, self.startupTimeout, self.callTimeout, detach = True)
+            if os.path.exists(p):
+                fp = open(p, "r")
+                try:
+                    try:
+                        entry = json.loads(fp.read())
+                        proc.attach(entry["pid"], entry["port"])
+                    except (ValueError, KeyError):
+                        pass
+                finally:
+                    fp.close()
+                if (proc.pid is not None) and proc.healthy():
+                    return proc
+                proc.stop()
+            proc.start()
+            fp = open(p, "w")
+            fp.write(json.dumps({"pid": proc.pid, "port": proc.port, "cmd": cmd}))
+            fp.close()
+            return proc
+        finally:
+            lockFp.close()
+
+    def _releaseProcess(self, proc):
+        # Registered processes outlive the pool.
+        if self.registryDir is None:
+            proc.stop()
+
+# Stop all the taggers recorded in a registry directory.
+
+def stopRegistered(registryDir):
+    if not os.path.isdir(registryDir):
+        return
+    for f in os.listdir(registryDir):
+        if f.endswith(".lock"):
+            continue
+        p = os.path.join(registryDir, f)
+        fp = open(p, "r")
+        try:
+            try:
+                entry = json.loads(fp.read())
+            except ValueError:
+                entry = None
+        finally:
+            fp.close()
+        if entry is not None:
+            proc = _TaggerProcess(entry.get("cmd", []))
+            proc.attach(entry["pid"], entry["port"])
+            proc.stop()
+        os.remove(p)
+
+# The pool for this process.
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def getPool(registryDir = None):
+    global _POOL
+    _POOL_LOCK.acquire()
+    try:
+        if _POOL is None:
+            _POOL = CarafeTaggerPool(registryDir = registryDir)
+        return _POOL
+    finally:
+        _POOL_LOCK.release()
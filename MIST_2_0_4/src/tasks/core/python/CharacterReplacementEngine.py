@@ -12,7 +12,7 @@ class CharacterReplacementRenderingStrategy(RenderingStrategy):
     # Override the rendering for everything.
 
     def Replace(self, pattern, **kw):
-        return _IDReplace(pattern.input)
+        return _IDReplace(pattern.input, pattern.rng)
 
 # Now the engine.
         
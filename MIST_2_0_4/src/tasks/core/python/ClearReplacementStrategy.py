@@ -7,7 +7,7 @@
 # than to switch between places in the same buffer when putting these
 # things together.
 
-import re, random, string, datetime, os
+import re, random, string, datetime, os, sys
 
 from ReplacementEngine import DigestionStrategy, RenderingStrategy, \
      _urlparse, _IDReplace, PIIReplacementEngine, \
@@ -15,6 +15,11 @@ from ReplacementEngine import DigestionStrategy, RenderingStrategy, \
 
 class ClearDigestionStrategy(DigestionStrategy):
 
+    # Created the first time a date is digested, and shared by all
+    # the strategies, including those of engine contexts (see
+    # PIIReplacementEngine.newContext()). See dateutil.parser.digestcache.
+    dateDigestCache = None
+
     def canCache(self, ctype):
         return True
 
@@ -33,22 +38,64 @@ class ClearDigestionStrategy(DigestionStrategy):
                   # to make sure that everything has the same number of matches.
                   (re.compile("(.*?)(\d{3})-(\d{4})"), False, False, True)]
 
+    # All the PHONE_PATS, as a single regular expression, so a seed
+    # is usually scanned once, rather than once per pattern. The
+    # leftmost match of the combined expression is the leftmost match
+    # of the pattern it came from, and the patterns before that one
+    # can only match further on, so only they have to be searched
+    # again (usually, they won't match at all). A leading (.*?) is
+    # removed, and what it would have matched is computed from the
+    # match instead; otherwise search() retries it at every position,
+    # which makes a miss quadratic in the length of the seed.
+
+    def _compilePhonePats(pats):
+        alts = []
+        entries = []
+        for i in range(len(pats)):
+            p, hasParens, hasParenWS, hasAreaCode = pats[i]
+            src = p.pattern
+            hasPrefix = src.startswith("(.*?)")
+            if hasPrefix:
+                src = src[len("(.*?)"):]
+            alts.append("(?P<phone%d>%s)" % (i, src))
+            entries.append(("phone%d" % i, re.compile(src), hasPrefix, hasParens, hasParenWS, hasAreaCode))
+        return re.compile("|".join(alts)), entries
+
+    PHONE_PAT, PHONE_PAT_ENTRIES = _compilePhonePats(PHONE_PATS)
+    del _compilePhonePats
+
     def PHONEDigest(self, pat, seed):
-        for p, hasParens, hasParenWS, hasAreaCode in self.PHONE_PATS:
-            m = p.search(seed)
-            if m is not None:
-                pat.preS = seed[:m.start()]
-                pat.postS = seed[m.end():]
-                # Create the pattern as we go along.
-                pat.area_code = hasAreaCode
-                pat.ac_paren = hasParens
-                pat.ac_paren_ws = hasParenWS
-                areaCode, exchange, numbr = m.groups()
-                if not hasAreaCode:
-                    areaCode = None
-                pat.parse = {"exchange": exchange, "areaCode": areaCode, "number": numbr}
-                return
-        pat.seed_unparseable = True
+        m = self.PHONE_PAT.search(seed)
+        if m is None:
+            pat.seed_unparseable = True
+            return
+        for gName, p, hasPrefix, hasParens, hasParenWS, hasAreaCode in self.PHONE_PAT_ENTRIES:
+            if m.start(gName) > -1:
+                # The groups of the pattern follow its named group.
+                i = self.PHONE_PAT.groupindex[gName]
+                groups = [m.group(j) for j in range(i + 1, i + 1 + p.groups)]
+                start, end = m.span(gName)
+                break
+            earlier = p.search(seed, m.start() + 1)
+            if earlier is not None:
+                groups = list(earlier.groups())
+                start, end = earlier.span()
+                break
+        if hasPrefix:
+            # (.*?) would have matched from the start of the line.
+            lineStart = seed.rfind("\n", 0, start) + 1
+            groups = [seed[lineStart:start]] + groups
+            start = lineStart
+        pat.preS = seed[:start]
+        pat.postS = seed[end:]
+        # Create the pattern as we go along.
+        pat.area_code = hasAreaCode
+        pat.ac_paren = hasParens
+        pat.ac_paren_ws = hasParenWS
+        areaCode, exchange, numbr = groups
+        if not hasAreaCode:
+            areaCode = None
+        pat.parse = {"exchange": exchange, "areaCode": areaCode, "number": numbr}
 
     def URLDigest(self, pat, seed):
         try:
@@ -60,23 +107,27 @@ class ClearDigestionStrategy(DigestionStrategy):
         except:
             pat.seed_unparseable = True
 
+    EMAIL_PAT = re.compile("^(.*)@")
+
     def EMAILDigest(self, pat, seed):
 
         try:
-            pat.name = re.match("^(.*)@", seed).group(1)
+            pat.name = self.EMAIL_PAT.match(seed).group(1)
         except:
             pat.seed_unparseable = True
 
     def IDDigest(self, pat, seed):
         pat.template = seed
 
+    AGE_PAT = re.compile("\d+")
+
     def AGEDigest(self, pat, seed):
 
         # The age is a digit, somewhere in the string. Get a new
         # age, and replace the digit. If the year is spelled out,
         # we're hosed. Just hallucinate a number and format it.
         
-        m = re.search("\d+", seed)
+        m = self.AGE_PAT.search(seed)
         if m is not None:
             ageSeed = int(m.group())
             pat.ageLb = pat.ageUb = ageSeed
@@ -89,8 +140,10 @@ class ClearDigestionStrategy(DigestionStrategy):
         # Import here rather than earlier because we need
         # path information which may not be available at module load
         import dateutil.parser
+        if ClearDigestionStrategy.dateDigestCache is None:
+            ClearDigestionStrategy.dateDigestCache = dateutil.parser.digestcache()
         try:
-            pat.dateObj = dateutil.parser.digest(seed)
+            pat.dateObj = self.dateDigestCache.digest(seed)
             pat.deltaDay = 0
             pat._fillPattern(pat.dateObj)
         except (ValueError, IndexError, AssertionError):
@@ -108,6 +161,12 @@ class ClearDigestionStrategy(DigestionStrategy):
     # when its frequencies have been updated to rule out particular
     # options.
 
+    # The state trie is uppercase, without commas.
+
+    def _stateToken(tok):
+        return tok.replace(",", "").upper()
+    _stateToken = staticmethod(_stateToken)
+
     def LOCATIONDigest(self, pat, seed):
 
         pat.parse = {"streetNum": None,
@@ -145,27 +204,24 @@ class ClearDigestionStrategy(DigestionStrategy):
 
         pat.state = False
         if recognizeState:
-            # Peel off the state, if possible. It might be as many as three tokens.
-            states = self.repository.loadStates()
-            for i in range(1, 4):
-                if len(toks) >= i:
-                    # There might be commas somewhere in the token list.
-                    possibleState = " ".join(toks[-i:])
-                    possibleStateNoCommas = possibleState.replace(",", "")
-                    eList = states.lookUp(possibleStateNoCommas)
-                    if eList:
-                        # Pick the first way of matching.
-                        how, e = eList[0]
-                        pat.state = True
-                        pat.parse["state"] = possibleStateNoCommas
-                        try:
-                            pat.state_type = pat.STATE_KEY_ORDER.index(how)
-                        except ValueError:
-                            pat.state_type = -1
-                        if possibleStateNoCommas != possibleState:
-                            pat.state_comma = True
-                        toks[-1:] = []
-                        break
+            # Peel off the state, if possible. It might be as many as three
+            # tokens; the shortest match wins. There might be commas
+            # somewhere in the token list.
+            found = self.repository.getStateTrie().shortestSuffix(toks, 3, self._stateToken)
+            if found is not None:
+                # The first way of matching.
+                i, how = found
+                possibleState = " ".join(toks[-i:])
+                possibleStateNoCommas = possibleState.replace(",", "")
+                pat.state = True
+                pat.parse["state"] = possibleStateNoCommas
+                try:
+                    pat.state_type = pat.STATE_KEY_ORDER.index(how)
+                except ValueError:
+                    pat.state_type = -1
+                if possibleStateNoCommas != possibleState:
+                    pat.state_comma = True
+                toks[-1:] = []
 
             # Now we've gotten the state and the zip.
             # There may have been a comma standalone between state and city.
@@ -240,10 +296,10 @@ class ClearDigestionStrategy(DigestionStrategy):
                 for c in addressToks[0]:
                     if c in string.digits:
                         streetNum = addressToks[0]
+                        # The replacer collects this as a street number seed.
                         pat.parse["streetNum"] = streetNum
                         pat.street_num = True
                         addressToks[0:1] = []
-                        pat.replacer.streetNumSeeds.append(streetNum)
                         break
 
             pat.street = len(addressToks) > 0
@@ -315,7 +371,12 @@ class ClearDigestionStrategy(DigestionStrategy):
     
     def _PERSONAnalyze(self, pat, seed):
 
-        m = self.EXTPAT.search(seed)
+        # Most names have no extension, and EXTPAT is anchored at the
+        # end, so search() would try it at every position.
+        if ("III" in seed) or ("JR" in seed):
+            m = self.EXTPAT.search(seed)
+        else:
+            m = None
         if m is not None:
             name = seed[:m.start()]
             pat.name_ext = m.group().strip()
@@ -392,8 +453,125 @@ class ClearDigestionStrategy(DigestionStrategy):
         else:
             pat.cap_status = MIXED
 
+# The replacement map rules for a single file and label, compiled.
+# Most rules test a particular value of some attribute of the pattern
+# (e.g., input, or parse -> lastName), so each rule is indexed under
+# one of the paths to a scalar in its antecedent, by the value at
+# that path (folded to lower case, unless the rules are case
+# sensitive). Rendering only needs to check the rules indexed under
+# the pattern's own values for those paths, plus the rules which
+# couldn't be indexed (e.g., the empty antecedent). The candidates
+# are still checked in their original order against the full
+# antecedent, and since a consequent can change the pattern, the
+# candidates are recomputed when it touches something the index
+# looks at.
+
+class _CompiledReplacementRules:
+
+    def __init__(self, labelEntry):
+        # SOMETIMES, Unicode keys aren't handled correctly.
+        # If I pass the string from the CGI script, it seems not
+        # to be happy. But it's digested as JSON no matter what.
+        # So I don't get it.
+        labelEntry = dict([(k.encode('ascii'), v) for (k, v) in labelEntry.items()])
+        self.caseSensitive = labelEntry.get("caseSensitive", False)
+        # A list of (antecedent, consequent keywords).
+        self.rules = []
+        for rule in labelEntry.get("rules") or []:
+            if len(rule) != 2:
+                print >> sys.stderr, ("Bad replacement rule %s" % str(rule))
+                continue
+            [antecedent, consequent] = rule
+            self.rules.append((antecedent, dict([(u.encode('ascii'), v) for (u, v) in consequent.items()])))
+        # Choose the paths to index on. Each rule is indexed under the path
+        # which the most rules share, so there are as few paths to probe
+        # as possible.
+        rulePaths = [self._scalarPaths(antecedent, ()) for antecedent, consequent in self.rules]
+        pathCounts = {}
+        for paths in rulePaths:
+            for path, v in paths:
+                pathCounts[path] = pathCounts.get(path, 0) + 1
+        # path -> {value: [rule index, ...]}
+        self.index = {}
+        self.unindexed = []
+        for i in range(len(self.rules)):
+            paths = rulePaths[i]
+            if not paths:
+                self.unindexed.append(i)
+            else:
+                paths.sort(key = lambda p: (-pathCounts[p[0]], p[0]))
+                path, v = paths[0]
+                self.index.setdefault(path, {}).setdefault(self._normalize(v), []).append(i)
+        # The top-level attributes the index looks at.
+        self.roots = set([path[0] for path in self.index.keys()])
+
+    def _scalarPaths(self, antecedent, prefix):
+        paths = []
+        for k, v in antecedent.items():
+            if type(v) is dict:
+                paths += self._scalarPaths(v, prefix + (k,))
+            else:
+                try:
+                    hash(v)
+                except TypeError:
+                    continue
+                paths.append((prefix + (k,), v))
+        return paths
+
+    def _normalize(self, v):
+        if (not self.caseSensitive) and (type(v) in (str, unicode)):
+            return v.lower()
+        else:
+            return v
+
+    # The indices of the rules which might match, in order, after
+    # the given index.
+
+    def candidates(self, d, after = -1):
+        res = [i for i in self.unindexed if i > after]
+        for path, vDict in self.index.items():
+            v = d
+            found = True
+            for k in path:
+                if (type(v) is not dict) or (not v.has_key(k)):
+                    found = False
+                    break
+                v = v[k]
+            if found:
+                try:
+                    res += [i for i in vDict.get(self._normalize(v), []) if i > after]
+                except TypeError:
+                    # Unhashable.
+                    pass
+        res.sort()
+        return res
+
 class ClearRenderingStrategy(RenderingStrategy):
 
+    def __init__(self, engine):
+        RenderingStrategy.__init__(self, engine)
+        self._compileReplacementMap()
+
+    # The replacement map is compiled once, into a dictionary from file
+    # basename to label to _CompiledReplacementRules. If someone replaces the
+    # map on the engine, we'll notice. The compiled map is saved on the
+    # engine, so engine contexts (which get new strategies) don't compile
+    # it again.
+
+    def _compileReplacementMap(self):
+        map = self.engine.replacementMap
+        self._compiledMapSource = map
+        compiled = getattr(self.engine, "_compiledReplacementMap", None)
+        if compiled is not None and compiled[0] is map:
+            self._compiledMap = compiled[1]
+            return
+        self._compiledMap = {}
+        if map is not None:
+            for fName, mapEntry in map.items():
+                self._compiledMap[fName] = dict([(label, _CompiledReplacementRules(labelEntry))
+                                                 for label, labelEntry in mapEntry.items()])
+        self.engine._compiledReplacementMap = (map, self._compiledMap)
+
     # First, we attempt to cache a replacement seed
     # somewhere, or something. In some cases, we end up
     # altering the pattern. I suppose we should cache the
@@ -401,33 +579,33 @@ class ClearRenderingStrategy(RenderingStrategy):
     # to ensure that this is always, always called.
 
     def Replace(self, pattern, filename = None, **kw):
-        map = self.engine.replacementMap
-        if map is not None:
-            mapEntry = map.get(os.path.basename(filename))
+        if self.engine.replacementMap is not self._compiledMapSource:
+            self._compileReplacementMap()
+        if self._compiledMap:
+            mapEntry = self._compiledMap.get(os.path.basename(filename))
             if mapEntry is not None:
-                labelEntry = mapEntry.get(pattern.replacer.label)
-                if labelEntry is not None:
-                    # SOMETIMES, Unicode keys aren't handled correctly.
-                    # If I pass the string from the CGI script, it seems not
-                    # to be happy. But it's digested as JSON no matter what.
-                    # So I don't get it.
-                    self._possiblyUpdatePattern(pattern, **dict([(u.encode('ascii'), v) for (u, v) in labelEntry.items()]))
+                compiledRules = mapEntry.get(pattern.replacer.label)
+                if compiledRules is not None:
+                    self._possiblyUpdatePattern(pattern, compiledRules)
         return RenderingStrategy.Replace(self, pattern, **kw)
 
-    def _possiblyUpdatePattern(self, pattern, caseSensitive = False, rules = None):
-        # Rules should be a list of lists, where each sublist is a
-        # 2-element list where the first element is the antecedent and
-        # the second is the consequent. The antecedent might be hierarchically
-        # organized. The consequent will have keys for seed and for pattern.
-        if rules is not None:
-            for rule in rules:
-                if len(rule) != 2:
-                    print >> sys.stderr, ("Bad replacement rule %s" % str(rule))
-                [antecedent, consequent] = rule
-                d = pattern.__dict__
-                if self._antecedentMatches(antecedent, d, caseSensitive):
-                    # See the note about Unicode above.
-                    self._applyConsequent(pattern, **dict([(u.encode('ascii'), v) for (u, v) in consequent.items()]))
+    def _possiblyUpdatePattern(self, pattern, compiledRules):
+        # The rules are a list of pairs, where the first element is
+        # the antecedent and the second is the consequent. The antecedent
+        # might be hierarchically organized. The consequent will have keys
+        # for seed and for pattern. All the matching rules apply, in order.
+        d = pattern.__dict__
+        candidates = compiledRules.candidates(d)
+        while candidates:
+            i = candidates.pop(0)
+            antecedent, consequent = compiledRules.rules[i]
+            if self._antecedentMatches(antecedent, d, compiledRules.caseSensitive):
+                self._applyConsequent(pattern, **consequent)
+                changed = (consequent.get("pattern") or {}).keys()
+                if consequent.get("seed") is not None:
+                    changed.append("seed")
+                if compiledRules.roots.intersection(changed):
+                    candidates = compiledRules.candidates(d, i)
 
     def _antecedentMatches(self, antecedent, d, caseSensitive):
         for k, rV in antecedent.items():
@@ -461,18 +639,18 @@ class ClearRenderingStrategy(RenderingStrategy):
     def _PHONEReplacementSeed(self, pattern):
         # Pick the phone number. First digit can't be 0 or 1.
         # Pick the number. Format it as four digits.
-        seed = {"exchange": random.randint(200, 999),
+        seed = {"exchange": pattern.seedRng.randint(200, 999),
                 "areaCode": None,
-                "number": random.randint(0, 9999)}
+                "number": pattern.seedRng.randint(0, 9999)}
         if hasattr(pattern, "seed"):
             seed.update(pattern.seed)
         return seed
 
     # Only get it if it's needed.
-    def _getRSAreaCode(self, seed):
+    def _getRSAreaCode(self, seed, rng = random):
         if seed["areaCode"] is None:
             areaCodeList = self.repository.loadAreaCodes()
-            seed["areaCode"] = random.choice(areaCodeList)
+            seed["areaCode"] = rng.choice(areaCodeList)
         return seed["areaCode"]
 
     def PHONEReplace(self, pattern, **kw):
@@ -486,7 +664,7 @@ class ClearRenderingStrategy(RenderingStrategy):
         replSeed = self.getReplacementSeed(pattern, lambda: self._PHONEReplacementSeed(pattern))
         if pattern.area_code:
             # Do it.
-            ac = self._getRSAreaCode(replSeed)
+            ac = self._getRSAreaCode(replSeed, pattern.seedRng)
             if pattern.ac_paren:
                 if pattern.ac_paren_ws:
                     acStr = "( "+ac+" ) "
@@ -504,7 +682,7 @@ class ClearRenderingStrategy(RenderingStrategy):
         chars = []
         for c in pattern.postS:
             if c in string.digits:
-                chars.append(random.choice(string.digits))
+                chars.append(pattern.rng.choice(string.digits))
             else:
                 chars.append(c)
     
@@ -513,11 +691,12 @@ class ClearRenderingStrategy(RenderingStrategy):
     # Social security numbers. Pattern is ignored (has no content anyway).
     
     def SSNReplace(self, pattern, **kw):
-        return "".join([str(random.choice(string.digits)) for i in range(3)]) + \
+        rng = pattern.rng
+        return "".join([str(rng.choice(string.digits)) for i in range(3)]) + \
                "-" + \
-               "".join([str(random.choice(string.digits)) for i in range(2)]) + \
+               "".join([str(rng.choice(string.digits)) for i in range(2)]) + \
                "-" + \
-               "".join([str(random.choice(string.digits)) for i in range(4)])
+               "".join([str(rng.choice(string.digits)) for i in range(4)])
 
     # Other replacement. Pattern is ignored, obviously.
     # The replacerDist is marked for its capitalization status.
@@ -527,7 +706,7 @@ class ClearRenderingStrategy(RenderingStrategy):
         if replacerDist is None:
             return "<<OTHERPII>>"
         else:
-            v = replacerDist.choose()
+            v = replacerDist.choose(rng = pattern.rng)
             if pattern.is_initials and pattern.replacer.mimicInitials:
                 # replacer distribution is case sensitive. Find the elements which
                 # are upper.
@@ -551,29 +730,30 @@ class ClearRenderingStrategy(RenderingStrategy):
         import urlparse
         hostList, pathSuffs = self.repository.loadURLs()
         if pattern.port:
-            pSuff = ":" + str(random.randint(80, 36000))
+            pSuff = ":" + str(pattern.rng.randint(80, 36000))
         else:
             pSuff = ""
         if pattern.path_tail:
             # Pick some random element, and digest it.
-            scheme, hostname, port, path, params, query, frag = _urlparse(random.choice(pathSuffs))
+            scheme, hostname, port, path, params, query, frag = _urlparse(pattern.rng.choice(pathSuffs))
             path, query, frag = path, query, frag
         else:
             path, query, frag = None, None, None
-        return urlparse.urlunsplit(("http", random.choice(hostList) + pSuff,
+        return urlparse.urlunsplit(("http", pattern.rng.choice(hostList) + pSuff,
                                     path or "", query or "", frag or ""))
 
     # IP addresses. Pattern is ignored.
     
     def IPADDRESSReplace(self, pattern, **kw):
         # No seed.
-        return "%d.%d.%d.%d" % tuple([random.randint(0, 255) for i in range(4)])
+        return "%d.%d.%d.%d" % tuple([pattern.rng.randint(0, 255) for i in range(4)])
 
     # Email addresses. Pattern is ignored.
 
     def EMAILReplace(self, pattern, **kw):
         hostList, pathSuffs = self.repository.loadURLs()
-        host = random.choice(hostList)
+        rng = pattern.rng
+        host = rng.choice(hostList)
         # Trim the www.
         if re.match("^www\.", host):
             host = host[4:]
@@ -588,18 +768,18 @@ class ClearRenderingStrategy(RenderingStrategy):
             fDist = nameResource.femaleFirstNameDist
             nDist = nameResource.neutralFirstNameDist
             lastNameDist = nameResource.lastNameDist
-            firstNameDist = random.choice([mDist, fDist, nDist])
-            firstName = random.choice(firstNameDist.WeightedChoice(None))
-            lastName = lastNameDist.WeightedChoice(None)
-            choice = random.randint(0, 2)
+            firstNameDist = rng.choice([mDist, fDist, nDist])
+            firstName = rng.choice(firstNameDist.WeightedChoice(None, rng = rng))
+            lastName = lastNameDist.WeightedChoice(None, rng = rng)
+            choice = rng.randint(0, 2)
             if choice == 0:
                 name = firstName.lower()[0] + lastName.lower()
             elif choice == 1:
                 name = firstName.lower() + "." + lastName.lower()
             else:
-                name = firstName.lower() + str(random.randint(0, 9999))
+                name = firstName.lower() + str(rng.randint(0, 9999))
         else:
-            name = _IDReplace(pattern.name)
+            name = _IDReplace(pattern.name, rng)
         return name + "@" + host
     
     # IDs. Pretty straighforward. No replacement seed, default
@@ -610,9 +790,9 @@ class ClearRenderingStrategy(RenderingStrategy):
             return pattern.seed["id"]
         # If we have nothing to go by, well, we have nothing to go by. 
         elif pattern.template is None:
-            return pattern.prefix + str(random.randint(10000, 99999))
+            return pattern.prefix + str(pattern.rng.randint(10000, 99999))
         else:
-            return _IDReplace(pattern.template)
+            return _IDReplace(pattern.template, pattern.rng)
 
     # Hospitals.
 
@@ -621,8 +801,8 @@ class ClearRenderingStrategy(RenderingStrategy):
             return pattern.seed
         else:
             hospitals, postDist = self.repository.loadHospitals()
-            hosp = hospitals.WeightedChoice([])
-            postToks = postDist.WeightedChoice()
+            hosp = hospitals.WeightedChoice([], rng = pattern.seedRng)
+            postToks = postDist.WeightedChoice(rng = pattern.seedRng)
             # In case we subclass.
             return {"hospTokens": hosp + postToks.split()}
 
@@ -656,7 +836,7 @@ class ClearRenderingStrategy(RenderingStrategy):
         rSet.add(source_age_ub)
         if pattern.ageUb == pattern.ageLb:
             rSet.discard(pattern.ageUb)
-        newAge = random.choice(list(rSet))
+        newAge = pattern.rng.choice(list(rSet))
         if pattern.spell:
             # every so often, spell the number
             repl = numToWords(newAge)
@@ -670,11 +850,17 @@ class ClearRenderingStrategy(RenderingStrategy):
     # Or not. The problem, of course, is when we're trying to reconstitute
     # from something like [DATE].
 
+    # The seed date is counted back from a fixed date rather than from
+    # today, so that the same surrogate key gives the same replacement
+    # no matter when the documents are processed.
+
+    DATE_SEED_ANCHOR = datetime.date(2012, 1, 1)
+
     def _DATEReplacementSeed(self, pattern):
         if hasattr(pattern, "seed"):
             return pattern.seed
         else:
-            return {"date": datetime.date.today() - datetime.timedelta(random.randint(0, 365))}
+            return {"date": self.DATE_SEED_ANCHOR - datetime.timedelta(pattern.seedRng.randint(0, 365))}
     
     def DATEReplace(self, pattern, **kw):
         # Import here rather than earlier because we need
@@ -793,8 +979,8 @@ class ClearRenderingStrategy(RenderingStrategy):
 
     def _populateRSStreet(self, pattern, seed):
         streetNames, streetPostfixDist = self.repository.loadStreetNames()
-        seed["addressToks"] = [pattern.replacer._Capitalize(random.choice(streetNames))]
-        seed["streetPostfix"] = streetPostfixDist.WeightedChoice(noneVal = None)
+        seed["addressToks"] = [pattern.replacer._Capitalize(pattern.seedRng.choice(streetNames))]
+        seed["streetPostfix"] = streetPostfixDist.WeightedChoice(noneVal = None, rng = pattern.seedRng)
         
     def _getRSAddress(self, pattern, seed):
         if not seed["addressToks"]:
@@ -806,39 +992,39 @@ class ClearRenderingStrategy(RenderingStrategy):
             self._populateRSStreet(pattern, seed)
         return seed["streetPostfix"]
 
-    def _populateRSPlace(self, seed):
+    def _populateRSPlace(self, seed, rng = random):
         tuples = self.repository.loadZipsCitiesStates()
         # The state component is an XMLResourceEntry, with
         # possible alts of longabbr, longabbrnodot, shortabbr
-        city, seed["state"], seed["zipCode"] = random.choice(tuples)
+        city, seed["state"], seed["zipCode"] = rng.choice(tuples)
         seed["cityToks"] = city.split()
 
-    def _getRSZip(self, seed):
+    def _getRSZip(self, seed, rng = random):
         if seed["zipCode"] is None:
-            self._populateRSPlace(seed)
+            self._populateRSPlace(seed, rng)
         return seed["zipCode"]
 
-    def _getRSCity(self, seed):
+    def _getRSCity(self, seed, rng = random):
         if not seed["cityToks"]:
-            self._populateRSPlace(seed)
+            self._populateRSPlace(seed, rng)
         return seed["cityToks"]
 
-    def _getRSState(self, seed):
+    def _getRSState(self, seed, rng = random):
         if seed["state"] is None:            
-            self._populateRSPlace(seed)
+            self._populateRSPlace(seed, rng)
         return seed["state"]
 
-    def _getRSStreetNum(self, seed, numSeed = None):
+    def _getRSStreetNum(self, seed, numSeed = None, rng = random):
         if seed["streetNum"] is None:
             if numSeed is not None:
-                seed["streetNum"] = _IDReplace(numSeed)
+                seed["streetNum"] = _IDReplace(numSeed, rng)
                 # We have to be sure that we don't end up with a
                 # leading 0.
                 if seed["streetNum"] and (seed["streetNum"][0] == "0"):
-                    seed["streetNum"] = str(random.randint(1,9)) + seed["streetNum"][1:]
+                    seed["streetNum"] = str(rng.randint(1,9)) + seed["streetNum"][1:]
             else:
                 # Hell, just pick some number.
-                seed["streetNum"] = str(random.randint(1, 10000))
+                seed["streetNum"] = str(rng.randint(1, 10000))
         return seed["streetNum"]
 
     def LOCATIONReplace(self, pattern, street_num_seed = None, state_type = -1, **kw):
@@ -859,7 +1045,7 @@ class ClearRenderingStrategy(RenderingStrategy):
                 
         if pattern.street:
             if pattern.street_num:
-                addrToks.append(self._getRSStreetNum(replSeed, pattern.street_num_seed))
+                addrToks.append(self._getRSStreetNum(replSeed, pattern.street_num_seed, pattern.seedRng))
             # Choose a street. Not about to worry about matching
             # capitalization or selecting it randomly.
             addrToks = addrToks + self._getRSAddress(pattern, replSeed)
@@ -870,7 +1056,7 @@ class ClearRenderingStrategy(RenderingStrategy):
                     # Randomly choose an abbreviation. Unless, of course, there
                     # are no abbreviations.
                     if pattern.street_postfix_abbr and len(pfList) > 1:
-                        addrToks.append(pattern.replacer._Capitalize(random.choice(pfList[1:])))
+                        addrToks.append(pattern.replacer._Capitalize(pattern.rng.choice(pfList[1:])))
                         if pattern.abbr_has_period:
                             addrToks[-1] = addrToks[-1] + "."
                     else:
@@ -883,36 +1069,36 @@ class ClearRenderingStrategy(RenderingStrategy):
             if pattern.street and pattern.street_comma:
                 addrToks[-1] = addrToks[-1] + ","
             if pattern.city:
-                addrToks = addrToks + self._getRSCity(replSeed)
+                addrToks = addrToks + self._getRSCity(replSeed, pattern.seedRng)
             if pattern.state or pattern.zip:
                 if pattern.city and pattern.city_comma:
                     addrToks[-1] = addrToks[-1] + ","
                 if pattern.state:
-                    state = self._getRSState(replSeed)
+                    state = self._getRSState(replSeed, pattern.seedRng)
                     # States are already capitalized.
                     if pattern.state_type < 0:
                         # There are four possible states for the state name.
                         # Note that not all the elements will be present for
                         # the chosen state. 0 is always safe.
-                        pattern.state_type = random.randint(0, 3)
+                        pattern.state_type = pattern.rng.randint(0, 3)
                     how = pattern.STATE_KEY_ORDER[pattern.state_type]
                     if (how is not None) and (state.alts.get(how) is None):
                         pattern.state_type = pattern.STATE_KEY_ORDER.index(None)
                         how = None
                     if how is None:
-                        addrToks.append(random.choice(state.heads))
+                        addrToks.append(pattern.rng.choice(state.heads))
                     else:
-                        addrToks.append(random.choice(state.alts.get(how)))
+                        addrToks.append(pattern.rng.choice(state.alts.get(how)))
                 if pattern.zip:
                     if pattern.state and pattern.state_comma:
                         addrToks[-1] = addrToks[-1] + ","
-                    addrToks.append(self._getRSZip(replSeed))
+                    addrToks.append(self._getRSZip(replSeed, pattern.seedRng))
 
         return " ".join(addrToks)
 
     def COUNTRYReplace(self, pattern, **kw):
         countries = self.repository.loadCountries()
-        return countries.choose()
+        return countries.choose(rng = pattern.rng)
 
     # People.
 
@@ -932,10 +1118,10 @@ class ClearRenderingStrategy(RenderingStrategy):
         if pattern.one_name and (not pattern.one_name_is_known_first_name):
             # In this case, when we're preparing a seed based on a single token,
             # last names must be EXCLUSIVELY last names.
-            lastName = nameResource.exclusivelyLastNameDist.WeightedChoice(None)
+            lastName = nameResource.exclusivelyLastNameDist.WeightedChoice(None, rng = pattern.seedRng)
         else:
-            lastName = nameResource.lastNameDist.WeightedChoice(None)
-        seed = {"firstNameAlts": firstNameDist.WeightedChoice(None),
+            lastName = nameResource.lastNameDist.WeightedChoice(None, rng = pattern.seedRng)
+        seed = {"firstNameAlts": firstNameDist.WeightedChoice(None, rng = pattern.seedRng),
                 "middleNames": None,
                 "gender": gender,
                 "lastName": lastName}
@@ -943,14 +1129,13 @@ class ClearRenderingStrategy(RenderingStrategy):
             seed.update(pattern.seed)
         return seed
     
-    def _getRSMiddleNames(self, seed, numNames):
+    def _getRSMiddleNames(self, seed, numNames, rng = random):
         if seed["middleNames"] is None:
             seed["middleNames"] = []
         if len(seed["middleNames"]) < numNames:
             nameResource = self.repository.loadNames()
             firstNameDist = nameResource.getFirstNameDist(seed.get("gender", "N"))
-            while len(seed["middleNames"]) < numNames:
-                firstNameSeq = firstNameDist.WeightedChoice(None)
+            for firstNameSeq in firstNameDist.WeightedChoices(numNames - len(seed["middleNames"]), None, rng = rng):
                 # No nicknames in middle names.
                 seed["middleNames"].append(firstNameSeq[0])
         # Only return the requested number of names.
@@ -976,16 +1161,16 @@ class ClearRenderingStrategy(RenderingStrategy):
 
         if pattern.one_name:
             if pattern.one_name_is_known_first_name:
-                ntoks = [random.choice(replSeed["firstNameAlts"])]
+                ntoks = [pattern.rng.choice(replSeed["firstNameAlts"])]
             else:
                 ntoks = [replSeed["lastName"]]
 
         else:
             ntoks = []
             # Randomly choose from the first name.
-            firstName = random.choice(replSeed["firstNameAlts"])
+            firstName = pattern.rng.choice(replSeed["firstNameAlts"])
             midInitList = pattern.mid_initials
-            midNames = self._getRSMiddleNames(replSeed, len(midInitList))
+            midNames = self._getRSMiddleNames(replSeed, len(midInitList), pattern.seedRng)
             finalMids = []
             for i in range(len(midNames)):
                 midName = midNames[i]
@@ -1009,7 +1194,7 @@ class ClearRenderingStrategy(RenderingStrategy):
             n = " ".join(ntoks).lower()
         else:
             # The name replacer has a special capitalization routine.
-            n = pattern.replacer._Capitalize(ntoks)
+            n = pattern.replacer._Capitalize(ntoks, pattern.rng)
 
         return n 
 
@@ -88,7 +88,7 @@ class DEIDStyleRenderingStrategy(ClearRenderingStrategy):
                 "middleNames": None,
                 "lastName": self._nextName()}
 
-    def _getRSMiddleNames(self, seed, numNames):
+    def _getRSMiddleNames(self, seed, numNames, rng = random):
         if seed["middleNames"] is None:
             seed["middleNames"] = []
         while len(seed["middleNames"]) < numNames:
@@ -114,7 +114,7 @@ class DEIDStyleRenderingStrategy(ClearRenderingStrategy):
             # They're in the same decade.
             ageSeed = pattern.ageLb
         else:
-            ageSeed = random.randint(pattern.ageUb, pattern.ageLb)
+            ageSeed = pattern.rng.randint(pattern.ageUb, pattern.ageLb)
         if ageSeed < 13:
             return self._wrap(pattern, "birth-12")
         elif ageSeed < 20:
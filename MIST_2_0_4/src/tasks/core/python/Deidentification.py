@@ -5,7 +5,7 @@ from MAT.PluginMgr import PluginTaskDescriptor, \
      PluginError, FindPluginClass, PluginStep, TagStep, WholeZoneStep
 from MAT.PluginDocInstaller import PluginDocInstaller
 from ReplacementEngine import PIIReplacementEngine, DOC_CACHE_SCOPE, \
-     BATCH_CACHE_SCOPE, NO_CACHE_SCOPE
+     BATCH_CACHE_SCOPE, NO_CACHE_SCOPE, Repository
 from ClearReplacementStrategy import ClearRenderingStrategy
 from MAT import Error
 from MAT.Workspace import WorkspaceOperation, WorkspaceError, WorkspaceFolder, \
@@ -15,8 +15,9 @@ from MAT.Workspace import WorkspaceOperation, WorkspaceError, WorkspaceFolder, \
 from MAT.WorkspaceDB import WorkspaceDB
 from MAT.Operation import OpArgument
 from MAT.Score import AggregatorScoreColumn, FileAggregateScoreRow, BaseScoreRow, Formula
+from MAT.JavaCarafe import CarafeTagStep
 
-import os
+import os, threading
 
 # Used way below, in augmentTagSummaryScoreTable etc.
 
@@ -40,6 +41,20 @@ class DocConfidence(Formula):
             return None
         return reduce(lambda x, y: x * y, [float(a["posterior"]) for a in seqConfidences])
 
+# The manifest for incremental redaction, in the workspace directory.
+# It records a hash of the redaction configuration (the workflow, the
+# replacer and the other operation settings), and for each document
+# in the redacted folders, a hash of the source document it was
+# redacted from. Anything else which writes to the redacted folders
+# has to discard it.
+
+REDACTION_MANIFEST_FILE = "redaction_manifest.json"
+
+def _discardRedactionManifest(workspace):
+    p = os.path.join(workspace.dir, REDACTION_MANIFEST_FILE)
+    if os.path.exists(p):
+        os.remove(p)
+
 # I limit this to just completed documents, unless specified.
 
 class RedactionOperation(WorkspaceOperation):
@@ -49,7 +64,9 @@ class RedactionOperation(WorkspaceOperation):
     argList = [OpArgument("replacer", help = "specify the replacer to use for this redaction (optional; obligatory if no replacer is specified in the task.xml file)",
                           hasArg = True),
                OpArgument("retain_existing", help = "don't clear the redacted folders first"),
-               OpArgument("dont_limit_to_gold", help = "under normal circumstances, the redaction will apply only to gold and reconciled documents. If this flag is present, it applies to all documents.")]
+               OpArgument("dont_limit_to_gold", help = "under normal circumstances, the redaction will apply only to gold and reconciled documents. If this flag is present, it applies to all documents."),
+               OpArgument("incremental", help = "redact only the documents which have changed since the last redaction, and remove the redacted documents whose sources are no longer being redacted. If the replacer or the operation settings have changed, everything is redacted again."),
+               OpArgument("write_workers", hasArg = True, help = "write the redacted documents using this many worker processes. Not available on Windows.")]
 
     def getAffectedFolders(self):
         return ["redacted, rich", "redacted, raw"]
@@ -57,7 +74,8 @@ class RedactionOperation(WorkspaceOperation):
     def getTargetFolderAndDocuments(self):
         return "redacted, rich", self._getTargetDocuments("redacted, rich")
 
-    def do(self, replacer = None, retain_existing = False, dont_limit_to_gold = False):
+    def do(self, replacer = None, retain_existing = False, dont_limit_to_gold = False, incremental = False,
+           write_workers = None):
 
         # Clear the redacted folders. Run the engine.
         
@@ -84,10 +102,6 @@ class RedactionOperation(WorkspaceOperation):
 
         rawFolder = self.folder.workspace.folders['redacted, raw']
         richFolder = self.folder.workspace.folders['redacted, rich']
-        
-        if not retain_existing:
-            rawFolder.clear()
-            richFolder.clear()
 
         if not dont_limit_to_gold:
             # Find the documents which are completed, and only use those.
@@ -96,6 +110,46 @@ class RedactionOperation(WorkspaceOperation):
 
         allPaths = self.folder.getFiles(self.affectedBasenames)
 
+        manifest = None
+        if incremental:
+            config = self._configHash(workflow, operationSettings)
+            oldManifest = self._readManifest()
+            manifest = {"config": config, "documents": {}}
+            for p in allPaths:
+                manifest["documents"][os.path.basename(p)] = self._fileHash(p)
+            if oldManifest is None:
+                oldDocs = {}
+            else:
+                oldDocs = oldManifest.get("documents", {})
+            sameConfig = (oldManifest is not None) and (oldManifest.get("config") == config)
+            if sameConfig or retain_existing:
+                # Remove the outputs whose sources are gone. Otherwise,
+                # they'd drop out of the manifest, and never be removed.
+                for fileBasename in oldDocs.keys():
+                    if not manifest["documents"].has_key(fileBasename):
+                        self._removeOutput([richFolder, rawFolder], fileBasename)
+            if sameConfig:
+                # Nothing is cleared. Redact only the documents which
+                # have changed.
+                retain_existing = True
+                db = self.folder.workspace.getDB()
+                present = richFolder.presentDocuments(db) & rawFolder.presentDocuments(db)
+                allPaths = [p for p in allPaths
+                            if (oldDocs.get(os.path.basename(p)) != manifest["documents"][os.path.basename(p)]) or \
+                            (os.path.basename(p) not in present)]
+        else:
+            # The redacted folders won't match the manifest anymore.
+            _discardRedactionManifest(self.folder.workspace)
+        
+        if not retain_existing:
+            rawFolder.clear()
+            richFolder.clear()
+
+        if not allPaths:
+            if manifest is not None:
+                self._writeManifest(manifest)
+            return
+
         try:
             import MAT.ToolChain
             e = MAT.ToolChain.MATEngine(workflow = workflow, task = self.folder.workspace.task.name)
@@ -109,9 +163,69 @@ class RedactionOperation(WorkspaceOperation):
         # If this succeeds, I should write all the files to
         # the appropriate folder.        
 
-        for file, output in dataPairs:
-            richFolder.saveFile(output, os.path.basename(file))
-            rawFolder.saveFile(output, os.path.basename(file))
+        BatchDocumentWriter([richFolder, rawFolder], workers = write_workers).write(
+            [(os.path.basename(file), output) for file, output in dataPairs])
+
+        if manifest is not None:
+            # The transform step may have skipped some documents. Their
+            # old outputs are stale, and they should be tried again
+            # next time.
+            done = set([os.path.basename(file) for file, output in dataPairs])
+            for p in allPaths:
+                fileBasename = os.path.basename(p)
+                if fileBasename not in done:
+                    self._removeOutput([richFolder, rawFolder], fileBasename)
+                    del manifest["documents"][fileBasename]
+            self._writeManifest(manifest)
+
+    def _configHash(self, workflow, operationSettings):
+        import hashlib
+        return hashlib.sha1(repr((workflow, sorted(operationSettings.items())))).hexdigest()
+
+    def _fileHash(self, path):
+        import hashlib
+        h = hashlib.sha1()
+        fp = open(path, "rb")
+        while True:
+            block = fp.read(1 << 16)
+            if not block:
+                break
+            h.update(block)
+        fp.close()
+        return h.hexdigest()
+
+    def _removeOutput(self, folders, fileBasename):
+        for folder in folders:
+            if os.path.exists(os.path.join(folder.dir, fileBasename)):
+                folder.removeFile(fileBasename)
+
+    def _readManifest(self):
+        from MAT import json
+        p = os.path.join(self.folder.workspace.dir, REDACTION_MANIFEST_FILE)
+        if not os.path.exists(p):
+            return None
+        fp = open(p, "r")
+        try:
+            try:
+                return json.loads(fp.read())
+            except ValueError:
+                # Start over.
+                return None
+        finally:
+            fp.close()
+
+    # Written to a temporary file and renamed, so an interrupted
+    # redaction doesn't leave a truncated manifest behind.
+
+    def _writeManifest(self, manifest):
+        from MAT import json
+        p = os.path.join(self.folder.workspace.dir, REDACTION_MANIFEST_FILE)
+        fp = open(p + ".tmp", "w")
+        fp.write(json.dumps(manifest))
+        fp.close()
+        if sys.platform == "win32" and os.path.exists(p):
+            os.remove(p)
+        os.rename(p + ".tmp", p)
     
     def webResult(self):
         d = WorkspaceOperation.webResult(self)
@@ -136,7 +250,8 @@ class NominationOperation(WorkspaceOperation, MATEngineExecutionWorkspaceOperati
     argList = [OpArgument("replacer", help = "specify the replacer to use for this nomination (optional; obligatory if no replacer is specified in the task.xml file)",
                           hasArg = True),
                OpArgument("dont_limit_to_gold", help = "under normal circumstances, the nomination will apply only to gold and reconciled documents. If this flag is present, it applies to all documents."),
-               OpArgument("lock_id", hasArg = True, help="lock ID (if document is locked)")]
+               OpArgument("lock_id", hasArg = True, help="lock ID (if document is locked)"),
+               OpArgument("write_workers", hasArg = True, help = "write the nominated documents using this many worker processes. Not available on Windows.")]
 
     def getAffectedFolders(self):
         return ["nominated"]
@@ -177,9 +292,11 @@ class NominationOperation(WorkspaceOperation, MATEngineExecutionWorkspaceOperati
     # determine the source file, and whether to lock the output. But
     # we need to check the target locks the same way we do for autotag.
     
-    def do(self, checkPathsAffected = True, lock_id = None, replacer = None, dont_limit_to_gold = False):
+    def do(self, checkPathsAffected = True, lock_id = None, replacer = None, dont_limit_to_gold = False,
+           write_workers = None):
         self.replacer = replacer
         self.dont_limit_to_gold = dont_limit_to_gold
+        self.writeWorkers = write_workers
         db = self.folder.workspace.getDB()
         # If there's a lock_id, there better be only one affected basename.
         if lock_id and len(self.affectedBasenames) != 1:
@@ -227,26 +344,23 @@ class NominationOperation(WorkspaceOperation, MATEngineExecutionWorkspaceOperati
             if operationSettings.has_key(key):
                 raise WorkspaceError, ("workspace operation settings don't permit %s option to MATEngine", key)
             
-        return {"input_file_type": self.folder.fileType,
-                "input_encoding": "utf-8",
-                "replacer": replacer}
+        params = {"input_file_type": self.folder.fileType,
+                  "input_encoding": "utf-8",
+                  "replacer": replacer}
+        # Persistent caches are shared by all the nominations in
+        # the workspace.
+        if not operationSettings.has_key("persistent_cache_file"):
+            params["persistent_cache_file"] = os.path.join(self.folder.workspace.dir, "surrogate_cache.db")
+        return params
 
     def wrapup(self, dataPairs):
         nominationFolder = self.folder.workspace.folders['nominated']
-        db = self.folder.workspace.getDB()
-        # Next, we'd better check to make sure that we can write each file.
-        # If we can't, we want to raise an error. We should check each
-        # individual file, because we don't want ANYthing to happen
+        # The writer checks that we can write each file before
+        # writing any of them, because we don't want ANYthing to happen
         # if the writes can fail.
-        if not os.access(nominationFolder.dir, os.W_OK | os.X_OK):
-            raise WorkspaceError, "folder nominated not available for writing"
-        self.transaction.addFilesToAdd([os.path.join(nominationFolder.dir, os.path.basename(p))
-                                        for (p, iData) in dataPairs])
-        for p, iData in dataPairs:            
-            fileBasename = os.path.basename(p)
-            if not os.access(os.path.join(nominationFolder.dir, p), os.W_OK):
-                raise WorkspaceError, ("file %s in folder nominated not available for writing" % fileBasename)
-            nominationFolder.saveFile(iData, fileBasename)
+        BatchDocumentWriter([nominationFolder], workers = self.writeWorkers,
+                            transaction = self.transaction).write([(os.path.basename(p), iData)
+                                                                   for (p, iData) in dataPairs])
             
     def webResult(self):
         d = WorkspaceOperation.webResult(self)
@@ -414,6 +528,7 @@ class NominationSaveOperation(WorkspaceOperation):
             rawFolder = self.folder.workspace.folders['redacted, raw']
             richFolder = self.folder.workspace.folders['redacted, rich']
 
+            _discardRedactionManifest(self.folder.workspace)
             if not retain_existing:
                 rawFolder.clear()
                 richFolder.clear()
@@ -448,7 +563,90 @@ class NominationSaveOperation(WorkspaceOperation):
             del d["status"]
         return d
 
-class NominationFolder(CoreWorkspaceFolder):
+# The nominated and redacted folders record which documents they
+# contain in the workspace DB, so listing them doesn't require looking
+# for each file. The first listing records whatever is in the
+# directory (e.g., in workspaces created before the folders were
+# tracked); after that, saveFile(), removeFile() and clear() keep the
+# record up to date.
+
+# listContents() can also return a page of the listing, sorted by
+# one of the keys of the listing entries (see FolderListOperation).
+
+LISTING_SORT_KEYS = ["basename", "doc name", "assigned to", "locked by"]
+
+class TrackedFolder(CoreWorkspaceFolder):
+
+    def _folderKey(self):
+        return os.path.basename(self.dir)
+
+    def saveFile(self, doc, fileBasename, *args, **kw):
+        CoreWorkspaceFolder.saveFile(self, doc, fileBasename, *args, **kw)
+        self.workspace.getDB().addFolderDocument(self._folderKey(), fileBasename)
+
+    def removeFile(self, fileBasename, *args, **kw):
+        CoreWorkspaceFolder.removeFile(self, fileBasename, *args, **kw)
+        self.workspace.getDB().removeFolderDocument(self._folderKey(), fileBasename)
+
+    def clear(self, *args, **kw):
+        CoreWorkspaceFolder.clear(self, *args, **kw)
+        self.workspace.getDB().recordFolderContents(self._folderKey(), [])
+
+    def presentDocuments(self, db):
+        present = db.folderContents(self._folderKey())
+        if present is None:
+            if os.path.isdir(self.dir):
+                present = set(os.listdir(self.dir))
+            else:
+                present = set()
+            db.recordFolderContents(self._folderKey(), present)
+        return present
+
+    # Returns a dictionary from doc names to the users who've locked them.
+    
+    def _lockInfo(self, db, docNames):
+        return {}
+
+    def listAllContents(self, basenames, sort_key = None):
+        db = self.workspace.getDB()
+        present = self.presentDocuments(db)
+        rows = [r for r in db.basenameInfo(basenames) if r[0] in present]
+        lockInfo = self._lockInfo(db, [r[0] for r in rows])
+        bPairs = []
+        for docName, basename, status, assignedUser, lockedBy in rows:
+            # Ignore locking and status - this is just to get assignment info.
+            info = {"basename": basename}
+            if docName != basename:
+                info["doc name"] = docName
+            if assignedUser:
+                info["assigned to"] = assignedUser
+            lockedBy = lockInfo.get(docName)
+            if lockedBy:
+                info["locked by"] = lockedBy
+            bPairs.append(info)
+        if sort_key is not None:
+            if sort_key not in LISTING_SORT_KEYS:
+                raise WorkspaceError, ("unknown sort key '%s'" % sort_key)
+            # The doc name defaults to the basename. Entries without the
+            # key go at the end.
+            if sort_key == "doc name":
+                keyFn = lambda info: (False, info.get("doc name", info["basename"]), info["basename"])
+            else:
+                keyFn = lambda info: (not info.has_key(sort_key), info.get(sort_key), info["basename"])
+            bPairs.sort(key = keyFn)
+        return bPairs
+
+    def listContents(self, basenames, offset = None, limit = None, sort_key = None):
+        bPairs = self.listAllContents(basenames, sort_key = sort_key)
+        if (offset is not None) or (limit is not None):
+            offset = offset or 0
+            if limit is None:
+                bPairs = bPairs[offset:]
+            else:
+                bPairs = bPairs[offset:offset + limit]
+        return bPairs
+
+class NominationFolder(TrackedFolder):
     
     def fileBasenameLocked(self, fileBasename):
         return self.workspace.getDB().nominationDocumentLocked(fileBasename)
@@ -460,30 +658,14 @@ class NominationFolder(CoreWorkspaceFolder):
         db = self.workspace.getDB()
         db.lockNominationDocument(lockId, fileBasename, user)
 
-    def listContents(self, basenames):
-        db = self.workspace.getDB()
-        bPairs = []
-        # For these basenames, see which files are actually present.
-        lockInfo = dict([(docName, lockedBy) for (docName, lockedBy, lockID) in db.nominationLockInfo()])
-        for docName, basename, status, assignedUser, lockedBy in db.basenameInfo(basenames):
-            # Ignore locking and status - this is just to get assignment info.
-            if os.path.exists(os.path.join(self.dir, docName)):
-                info = {"basename": basename}
-                if docName != basename:
-                    info["doc name"] = docName
-                if assignedUser:
-                    info["assigned to"] = assignedUser
-                lockedBy = lockInfo.get(docName)
-                if lockedBy:
-                    info["locked by"] = lockedBy
-                bPairs.append(info)
-        return bPairs
+    def _lockInfo(self, db, docNames):
+        return dict([(docName, lockedBy) for (docName, lockedBy, lockID) in db.nominationLockInfoForDocuments(docNames)])
 
-    def removeFile(self, fileBasename):
-        CoreWorkspaceFolder.removeFile(self, fileBasename)
+    def removeFile(self, fileBasename, *args, **kw):
+        TrackedFolder.removeFile(self, fileBasename, *args, **kw)
         self.workspace.getDB().unlockNominationDocument(fileBasename)        
 
-class RedactionFolder(CoreWorkspaceFolder):
+class RedactionFolder(TrackedFolder):
     
     def fileBasenameLocked(self, fileBasename):
         return None
@@ -494,23 +676,171 @@ class RedactionFolder(CoreWorkspaceFolder):
     def prepareForEditing(self, doc, fileBasename, user, lockId):
         raise WorkspaceError, "folder is not editable"
 
-    def listContents(self, basenames):
-        db = self.workspace.getDB()
-        bPairs = []
-        # For these basenames, see which files are actually present.
-        for docName, basename, status, assignedUser, lockedBy in db.basenameInfo(basenames):
-            # Ignore locking and status - this is just to get assignment info.
-            if os.path.exists(os.path.join(self.dir, docName)):
-                info = {"basename": basename}
-                if docName != basename:
-                    info["doc name"] = docName
-                if assignedUser:
-                    info["assigned to"] = assignedUser
-                bPairs.append(info)
-        return bPairs
+# Writes a batch of documents to one or more workspace folders (e.g.,
+# the same redacted documents to 'redacted, rich' and 'redacted, raw').
+# The documents are serialized to temporary files next to their
+# targets, possibly in forked worker processes (with workers > 1, as
+# in the nominate step), and only when every one of them has been
+# written are they renamed onto their targets, so a failure partway
+# through leaves the folders as they were. If there's a workspace
+# transaction, the targets are added to it before they're renamed,
+# so rolling it back removes them.
+
+# With more than one worker, the workers are forked, and the documents
+# get to them in this global; several threads (e.g., in MATWeb) may be
+# writing at once, so it's only set while holding the lock.
+
+_WRITE_WORKER_STATE = None
+_WRITE_WORKER_LOCK = threading.Lock()
+
+def _writeWorker(i):
+    writer, docPairs = _WRITE_WORKER_STATE
+    fileBasename, doc = docPairs[i]
+    writer._writeTemp(fileBasename, doc)
+    return i
+
+class BatchDocumentWriter:
+
+    def __init__(self, folders, workers = None, transaction = None):
+        self.folders = folders
+        self.workers = workers
+        self.transaction = transaction
+        self.tempSuffix = ".tmp%d" % os.getpid()
+
+    def _tempPath(self, folder, fileBasename):
+        return os.path.join(folder.dir, "." + fileBasename + self.tempSuffix)
+
+    def _writeTemp(self, fileBasename, doc):
+        for folder in self.folders:
+            folder.docIO.writeToTarget(doc, self._tempPath(folder, fileBasename))
+
+    # docPairs is a list of (fileBasename, doc) pairs.
+
+    def write(self, docPairs):
+        global _WRITE_WORKER_STATE
+        if not docPairs:
+            return
+        # Make sure we can write everything before we write anything.
+        db = self.folders[0].workspace.getDB()
+        for folder in self.folders:
+            if not os.access(folder.dir, os.W_OK | os.X_OK):
+                raise WorkspaceError, ("folder %s not available for writing" % os.path.basename(folder.dir))
+            present = folder.presentDocuments(db)
+            for fileBasename, doc in docPairs:
+                if (fileBasename in present) and \
+                   not os.access(os.path.join(folder.dir, fileBasename), os.W_OK):
+                    raise WorkspaceError, ("file %s in folder %s not available for writing" % (fileBasename, os.path.basename(folder.dir)))
+        workers = _getWorkerCount(self.workers, len(docPairs), "write_workers", WorkspaceError, "writing")
+        try:
+            if workers == 1:
+                for fileBasename, doc in docPairs:
+                    self._writeTemp(fileBasename, doc)
+            else:
+                _WRITE_WORKER_LOCK.acquire()
+                try:
+                    _WRITE_WORKER_STATE = (self, docPairs)
+                    try:
+                        for i in _workerMap(workers, _writeWorker, len(docPairs)):
+                            pass
+                    finally:
+                        _WRITE_WORKER_STATE = None
+                finally:
+                    _WRITE_WORKER_LOCK.release()
+        except:
+            self._removeTempFiles(docPairs)
+            raise
+        if self.transaction is not None:
+            self.transaction.addFilesToAdd([os.path.join(folder.dir, fileBasename)
+                                            for folder in self.folders
+                                            for fileBasename, doc in docPairs])
+        for folder in self.folders:
+            for fileBasename, doc in docPairs:
+                target = os.path.join(folder.dir, fileBasename)
+                if sys.platform == "win32" and os.path.exists(target):
+                    # No atomic replacement on Windows.
+                    os.remove(target)
+                os.rename(self._tempPath(folder, fileBasename), target)
+                db.addFolderDocument(folder._folderKey(), fileBasename)
+
+    def _removeTempFiles(self, docPairs):
+        for folder in self.folders:
+            for fileBasename, doc in docPairs:
+                p = self._tempPath(folder, fileBasename)
+                if os.path.exists(p):
+                    os.remove(p)
+
+# A page of a folder listing, for the tracked folders (see TrackedFolder).
+# Only on the command line for now: the web client's folder view still
+# gets the whole listing through list_workspace_folder.
+
+class FolderListOperation(WorkspaceOperation):
+
+    name = "list_page"
+
+    availability = CMDLINE_AVAILABLE
+
+    argList = [OpArgument("offset", hasArg = True, help = "the position of the first entry to list. Default is 0."),
+               OpArgument("limit", hasArg = True, help = "the maximum number of entries to list. Default is all of them."),
+               OpArgument("sort_key", hasArg = True,
+                          help = "sort the listing by this key, one of %s. Default is the workspace order." % ", ".join(["'%s'" % k for k in LISTING_SORT_KEYS]))]
+
+    def getAffectedFolders(self):
+        return []
+
+    def do(self, offset = None, limit = None, sort_key = None):
+        try:
+            if offset is not None:
+                offset = int(offset)
+            if limit is not None:
+                limit = int(limit)
+        except ValueError:
+            raise WorkspaceError, "offset and limit must be integers"
+        basenames = self.affectedBasenames or self.folder.workspace.getBasenames()
+        bPairs = self.folder.listAllContents(basenames, sort_key = sort_key)
+        self.total = len(bPairs)
+        self.offset = offset or 0
+        if limit is None:
+            self.page = bPairs[self.offset:]
+        else:
+            self.page = bPairs[self.offset:self.offset + limit]
+        if self.fromCmdline:
+            for info in self.page:
+                print info["basename"], " ".join(["%s=%s" % (k, v) for k, v in info.items() if k != "basename"])
+            print "Entries %d to %d of %d." % (min(self.offset + 1, self.total), self.offset + len(self.page), self.total)
+
+    def webResult(self):
+        d = WorkspaceOperation.webResult(self)
+        d["contents"] = self.page
+        d["offset"] = self.offset
+        d["total"] = self.total
+        return d
+
+# The version of the tables in deid_ws.sql. If you change them, bump
+# this, and add the migration from the previous version to
+# DeidentificationDB.migrate().
+
+DEID_WS_SCHEMA_VERSION = 2
 
 class DeidentificationDB(WorkspaceDB):
 
+    # Bring the deidentification tables up to date. This is done once
+    # per workspace per process (see DeidentificationDBPool).
+
+    def migrate(self):
+        if self._execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'deid_schema_version'"):
+            version = self._execute("SELECT MAX(version) FROM deid_schema_version")[0][0] or 0
+        else:
+            version = 0
+        if version < DEID_WS_SCHEMA_VERSION:
+            self.run_script(os.path.join(os.path.dirname(os.path.abspath(__file__)), "deid_ws.sql"))
+            self._execute("DELETE FROM deid_schema_version", retrieval = False)
+            self._execute("INSERT INTO deid_schema_version VALUES (?)",
+                          params = [DEID_WS_SCHEMA_VERSION], retrieval = False)
+
+    # The connections are kept (see DeidentificationDBPool), and
+    # sqlite keeps the statements it has prepared for a connection, so
+    # the statements here are prepared once per connection.
+
     def nominationDocumentLocked(self, docName):
         lockedByResult = self._execute("SELECT locked_by FROM nomination_lock WHERE doc_name = ?",
                                        params = [docName])
@@ -521,15 +851,9 @@ class DeidentificationDB(WorkspaceDB):
 
     def lockNominationDocument(self, lockId, docName, lockedBy):
         # If there's already one, we overwrite the original lock.
-        if self._execute("SELECT locked_by FROM nomination_lock WHERE doc_name = ?",
-                         params = [docName]):
-            self._execute("UPDATE nomination_lock SET lock_id = ?, locked_by = ? WHERE doc_name = ?",
-                          params = [lockId, lockedBy, docName],
-                          retrieval = False)
-        else:
-            self._execute("INSERT INTO nomination_lock VALUES (?, ?, ?)",
-                          params = [docName, lockedBy, lockId],
-                          retrieval = False)
+        self._execute("INSERT OR REPLACE INTO nomination_lock VALUES (?, ?, ?)",
+                      params = [docName, lockedBy, lockId],
+                      retrieval = False)
         
     def unlockNominationLock(self, lockId):
         self._execute("DELETE FROM nomination_lock WHERE lock_id = ?",
@@ -544,6 +868,47 @@ class DeidentificationDB(WorkspaceDB):
     def nominationLockInfo(self):
         return self._execute("SELECT doc_name, locked_by, lock_id FROM nomination_lock")
 
+    # doc_name is the primary key, so these are index lookups. In
+    # chunks, because sqlite allows 999 parameters per statement.
+
+    def nominationLockInfoForDocuments(self, docNames):
+        docNames = list(docNames)
+        result = []
+        for i in range(0, len(docNames), 400):
+            result += self._executeWithParamDict("SELECT doc_name, locked_by, lock_id FROM nomination_lock WHERE doc_name IN ($(docNames))",
+                                                 {"docNames": docNames[i:i+400]})
+        return result
+
+    # The folder contents (see TrackedFolder). Returns None if the
+    # folder's contents haven't been recorded yet.
+
+    def folderContents(self, folder):
+        if not self._execute("SELECT folder FROM folder_index WHERE folder = ?", params = [folder]):
+            return None
+        return set([r[0] for r in self._execute("SELECT doc_name FROM folder_contents WHERE folder = ?",
+                                                params = [folder])])
+
+    def recordFolderContents(self, folder, docNames):
+        self._execute("DELETE FROM folder_contents WHERE folder = ?", params = [folder], retrieval = False)
+        docNames = list(docNames)
+        # Two parameters per row; see nominationLockInfoForDocuments().
+        for i in range(0, len(docNames), 400):
+            chunk = docNames[i:i+400]
+            params = []
+            for docName in chunk:
+                params += [folder, docName]
+            self._execute("INSERT INTO folder_contents VALUES " + ", ".join(["(?, ?)"] * len(chunk)),
+                          params = params, retrieval = False)
+        self._execute("INSERT OR IGNORE INTO folder_index VALUES (?)", params = [folder], retrieval = False)
+
+    def addFolderDocument(self, folder, docName):
+        self._execute("INSERT OR IGNORE INTO folder_contents VALUES (?, ?)",
+                      params = [folder, docName], retrieval = False)
+
+    def removeFolderDocument(self, folder, docName):
+        self._execute("DELETE FROM folder_contents WHERE folder = ? AND doc_name = ?",
+                      params = [folder, docName], retrieval = False)
+
     def nominationGetLockIDInfo(self, lockId):
         v = self._execute("SELECT A.doc_name, B.basename, A.locked_by FROM nomination_lock A, document_info B WHERE A.lock_id = ? AND A.doc_name = B.doc_name",
                           params = [lockId])
@@ -559,6 +924,36 @@ class DeidentificationDB(WorkspaceDB):
             self._executeWithParamDict("DELETE FROM nomination_lock WHERE doc_name IN ($(docLocksToDelete))", {"docLocksToDelete": docLocksToDelete}, retrieval = False)
         return docLocksToDelete
 
+# Each workspace used to open a new connection, and run deid_ws.sql,
+# every time anything called getDB(). Now each thread gets a connection
+# of its own (sqlite connections can't be shared among threads), the
+# first time it asks, and keeps it; the tables are migrated the first
+# time any thread asks. The threads which ask are the MATWeb (CherryPy)
+# worker threads, so there are never more connections than workers.
+
+class DeidentificationDBPool:
+
+    def __init__(self, workspace):
+        self.workspace = workspace
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.migrated = False
+
+    def getDB(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = Workspace.getDB(self.workspace)
+            db.__class__ = DeidentificationDB
+            self.lock.acquire()
+            try:
+                if not self.migrated:
+                    db.migrate()
+                    self.migrated = True
+            finally:
+                self.lock.release()
+            self.local.db = db
+        return db
+
 class DeidTaskDescriptor(PluginTaskDescriptor):
 
     categories = {}
@@ -573,6 +968,7 @@ class DeidTaskDescriptor(PluginTaskDescriptor):
         self._rdirCache = None
         self._replacerCache = None        
         self._instantiatedReplacerCache = {}
+        self._sharedRepository = None
 
     def fromXML(self, *args):
         PluginTaskDescriptor.fromXML(self, *args)
@@ -715,13 +1111,10 @@ class DeidTaskDescriptor(PluginTaskDescriptor):
         workspace.folders['nominated'].addOperation("nominate_save", NominationSaveOperation)
         workspace.folders["nominated"].addOperation("release_lock", NominationReleaseLockOperation)
         workspace.folders["nominated"].addOperation("force_unlock", NominationForceUnlockOperation)
-        workspace.getDB = lambda: self._getEnhancedWorkspaceDB(workspace)
-
-    def _getEnhancedWorkspaceDB(self, ws):
-        db = Workspace.getDB(ws)
-        db.run_script(os.path.join(os.path.dirname(os.path.abspath(__file__)), "deid_ws.sql"))
-        db.__class__ = DeidentificationDB
-        return db
+        for folderName in ["nominated", "redacted, rich", "redacted, raw"]:
+            workspace.folders[folderName].addOperation("list_page", FolderListOperation)
+        pool = DeidentificationDBPool(workspace)
+        workspace.getDB = pool.getDB
 
     def workspaceUpdate1To2(self, workspace, oldWorkspaceDir, basenames, initialUser):
         import shutil
@@ -757,11 +1150,38 @@ class DeidTaskDescriptor(PluginTaskDescriptor):
             rPair = self.findReplacer(rName)
             if rPair is not None:
                 r = rPair[0]
+                if self._preloadReplacementResources() and \
+                   (not kw.get("resource_file_repl")) and (not kw.get("resource_snapshot")) and \
+                   (not kw.get("verify_resource_snapshot")):
+                    kw["repository"] = self._getSharedRepository()
                 c = r(self.getReplacerRDirs(), self.categories, **kw)
                 self._instantiatedReplacerCache[rName] = c
                 return c
             return None
 
+    # If the task setting preload_replacement_resources is "yes", all
+    # the replacers share a single resource repository, which is
+    # completely loaded and frozen (see Repository.freeze()) when the
+    # first replacer is instantiated. That's before any nominate workers
+    # are forked, and in a MATEngine or MATWeb process which forks
+    # its own workers, as long as it instantiates a replacer first,
+    # the workers share the resource pages instead of each having a
+    # copy. Separate processes share the pages only if the resources
+    # come from a snapshot file (see ResourceSnapshot.py). The
+    # repository depends on the resource_file_repl, resource_snapshot and
+    # verify_resource_snapshot arguments, so a replacer with any of those
+    # gets its own.
+
+    def _preloadReplacementResources(self):
+        return self.settings.get("preload_replacement_resources", "no").lower() == "yes"
+
+    def _getSharedRepository(self):
+        if self._sharedRepository is None:
+            repository = Repository(self.getReplacerRDirs())
+            repository.freeze()
+            self._sharedRepository = repository
+        return self._sharedRepository
+
     # Here, I'm going to try to add a column which reflects the
     # document-level probabilities.
     
@@ -788,17 +1208,150 @@ class DeidTaskDescriptor(PluginTaskDescriptor):
 # Here are the deidentification steps
 #
 
+# Replacement engine profiling (see ReplacementProfile.py in this
+# directory). The nominate and transform steps profile the engine if
+# they're asked to, or if MATEngine was invoked with
+# --subprocess_statistics. The report is JSON, and goes to the report
+# file, if there is one, or to stderr.
+
+def _startReplacementProfile(r, profileReplacement, profileFile):
+    if not (profileReplacement or profileFile):
+        try:
+            import MAT.ExecutionContext
+            profileReplacement = getattr(MAT.ExecutionContext, "_SUBPROCESS_STATISTICS", False)
+        except ImportError:
+            profileReplacement = False
+    if profileReplacement or profileFile:
+        r.enableProfiling()
+    elif r.profile is not None:
+        # The engines are cached by the task, so it may still be on
+        # from a previous batch.
+        r.disableProfiling()
+
+def _reportReplacementProfile(r, stepName, profileFile):
+    if r.profile is None:
+        return
+    from MAT import json
+    report = r.getProfileReport()
+    r.disableProfiling()
+    report["step"] = stepName
+    report["replacer"] = r.__rname__
+    s = json.dumps(report, indent = 2, sort_keys = True)
+    if profileFile:
+        fp = open(profileFile, "w")
+        fp.write(s)
+        fp.close()
+    else:
+        import sys
+        print >> sys.stderr, "Replacement engine statistics for step %s:" % stepName
+        print >> sys.stderr, s
+
+# The worker side of the two-pass nominate step (see NominateStep._twoPassNominate).
+# These have to be toplevel functions, and the state has to be global,
+# because that's how it gets to the forked workers.
+
+_NOMINATE_WORKER_STATE = None
+
+def _workerInit():
+    # Otherwise, all the workers start with the same random state.
+    import random
+    random.seed()
+
+# Returns the corpus statistics for the document, as (label, stats) pairs,
+# and the date shift, if the document chose one.
+
+def _nominateDigestWorker(i):
+    step, r, iDataPairs, annLists, dateDeltas = _NOMINATE_WORKER_STATE
+    f, annotSet = iDataPairs[i]
+    if hasattr(r, "dateDelta"):
+        del r.dateDelta
+    # The caller merges the statistics.
+    r.collectCorpusStatistics = False
+    try:
+        digestions = step._digestDocument(r, f, annotSet, annLists[i])
+    finally:
+        r.collectCorpusStatistics = True
+    stats = []
+    for lab, pat in digestions:
+        s = r.getReplacer(lab).getCorpusStatistics(pat)
+        if s is not None:
+            stats.append((lab, s))
+    return stats, getattr(r, "dateDelta", None)
+
+def _nominateReplaceWorker(i):
+    step, r, iDataPairs, annLists, dateDeltas = _NOMINATE_WORKER_STATE
+    f, annotSet = iDataPairs[i]
+    return step._replaceDocument(r, f, step._redigestDocument(r, f, annotSet, annLists[i], dateDeltas[i]))
+
+# The number of workers to use for numDocs documents, given the value
+# of an option like --nominate_workers. The workers are forked, so
+# where that's not possible, the work happens here. err builds the
+# exception for a bad value. Also used by BatchDocumentWriter.
+
+def _getWorkerCount(workers, numDocs, optName, err, activity):
+    if workers is None:
+        return 1
+    try:
+        workers = int(workers)
+    except ValueError:
+        raise err("%s must be an integer" % optName)
+    if workers < 1:
+        raise err("%s must be at least 1" % optName)
+    if workers == 1 or numDocs < 2:
+        return 1
+    import sys
+    if sys.platform == "win32":
+        print >> sys.stderr, "WARNING: %s requires fork(); %s serially" % (optName, activity)
+        return 1
+    try:
+        import multiprocessing
+    except ImportError:
+        print >> sys.stderr, "WARNING: %s requires the multiprocessing module; %s serially" % (optName, activity)
+        return 1
+    return min(workers, numDocs)
+
+# Yields fn(i) for each document, in order. With one worker, it all
+# happens right here. Also used by BatchDocumentWriter.
+
+def _workerMap(workers, fn, numDocs):
+    if workers == 1:
+        for i in range(numDocs):
+            yield fn(i)
+        return
+    import multiprocessing
+    pool = multiprocessing.Pool(workers, _workerInit)
+    try:
+        for res in pool.imap(fn, range(numDocs), max(1, min(100, numDocs / (workers * 4)))):
+            yield res
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
 class NominateStep(PluginStep):
 
     argList = [OpArgument("replacer", help = "specify the replacer to use. Obligatory if more than one replacer is available. See above for available replacers.", hasArg = True),
-               OpArgument("cache_scope", help = "specify the cache scope for particular tags. Argument is a semicolon-delimited sequence of <tag>,doc|batch|none, e.g. 'PERSON,batch;LOCATION;doc'. Default scope is document scope.", hasArg = True),
+               OpArgument("cache_scope", help = "specify the cache scope for particular tags. Argument is a semicolon-delimited sequence of <tag>,doc|batch|persistent|none, e.g. 'PERSON,batch;LOCATION;doc'. Default scope is document scope. The persistent scope is like the batch scope, but the cache is stored in the file specified by --persistent_cache_file, and is shared across batches and runs.", hasArg = True),
+               OpArgument("persistent_cache_file", help = "specify the SQLite file which stores the caches for tags with the persistent cache scope. In workspaces, the default is surrogate_cache.db in the workspace directory.", hasArg = True),
                OpArgument("cache_case_sensitivity", help = "specify which tags have case-sensitive caches. Argument is a semicolon-delimited sequence of tags, e.g., 'PERSON;LOCATION'.", hasArg = True),
                OpArgument("resource_file_repl", help="specify a replacement for one of the resource files used by the replacement engine. Argument is a semicolon-delimited sequence of <file>=<repl>. See the ReplacementEngine.py for details.", hasArg = True),
+               OpArgument("resource_snapshot", help="specify a precompiled resource snapshot for the replacement engine (see core/standalone/bin/buildResourceSnapshot.py). By default, the engine uses the file replacement_resources.snapshot in the task or core resource directory, if present. Use 'none' to always load the resource files.", hasArg = True),
+               OpArgument("verify_resource_snapshot", help="before using the resource snapshot, check the CRCs of the resource files it was built from, as well as their sizes and modification times."),
+               OpArgument("surrogate_key", help="specify a secret key from which the replacement choices are derived. With a key, the same input in the same document (or anywhere, for batch-scope caches) always gets the same replacement, no matter how the corpus is divided into batches or runs. Prefer --surrogate_key_file, since the key will be visible in process listings.", hasArg = True),
+               OpArgument("surrogate_key_file", help="specify a file containing the secret key for --surrogate_key.", hasArg = True),
                OpArgument("replacement_map_file", help="Specify a replacement map file to provide some detailed control over clear -> clear replacements. See documentation for details.", hasArg = True),
                OpArgument("replacement_map", help="Specify a replacement map to provide some detailed control over clear -> clear replacements. See documentation for details.", hasArg = True),
                OpArgument("dont_nominate", help = "A comma-separated list of labels for which nominations should not be proposed", hasArg = True),
+               OpArgument("nominate_workers", hasArg = True,
+                          help = "nominate using this many worker processes. The corpus statistics are merged after digestion, so the results are the same as a serial nomination, except for the random choices (see --surrogate_key). Not available on Windows. Implies --nominate_streaming."),
+               OpArgument("nominate_streaming",
+                          help = "nominate in two passes: the first collects only the corpus statistics, and the second digests and replaces each document in turn. Only one document's digested patterns are in memory at a time, at the cost of digesting everything twice. The documents themselves are all still in memory, so peak memory still grows with the size of the batch, just more slowly."),
                OpArgument("flag_unparseable_seeds", hasArg = True,
-                          help = "A comma-separated list of labels whose annotations should be flagged in clear -> clear replacement when the phrase in the original document could not be parsed appropriately (and thus whose replacements might not have the appropriate fidelity). Currently, only dates, URLs, phone numbers, and can be flagged in this way.")]
+                          help = "A comma-separated list of labels whose annotations should be flagged in clear -> clear replacement when the phrase in the original document could not be parsed appropriately (and thus whose replacements might not have the appropriate fidelity). Currently, only dates, URLs, phone numbers, and can be flagged in this way."),
+               OpArgument("profile_replacement",
+                          help = "profile the replacement engine, and print a JSON report of the per-label call counts and latencies, cache hit rates and resource load times on stderr. Also enabled by --subprocess_statistics. With --nominate_workers, the work done in the worker processes isn't included."),
+               OpArgument("replacement_profile_file", hasArg = True,
+                          help = "write the --profile_replacement report to this file instead of stderr. Implies --profile_replacement.")]
 
     def paramsSatisfactory(self, wfName, failureReasons, replacer = None, **params):
         if replacer is None:
@@ -822,7 +1375,9 @@ class NominateStep(PluginStep):
 
     # This drives the replacers.
 
-    def doBatch(self, iDataPairs, replacer = None, dont_nominate = None, flag_unparseable_seeds = None, **kw):
+    def doBatch(self, iDataPairs, replacer = None, dont_nominate = None, flag_unparseable_seeds = None,
+                nominate_workers = None, nominate_streaming = False, profile_replacement = False,
+                replacement_profile_file = None, **kw):
 
         # This needs to be a batch step, so that we can get corpus-level
         # weights to work.
@@ -838,6 +1393,8 @@ class NominateStep(PluginStep):
         if not r:
             raise Error.MATError("nominate", "couldn't find the replacer named " + replacer)
 
+        _startReplacementProfile(r, profile_replacement, replacement_profile_file)
+
         if dont_nominate is not None:
             dontNominate = set([x.strip() for x in dont_nominate.split(",")])
         else:
@@ -859,72 +1416,196 @@ class NominateStep(PluginStep):
         # Note that what we need for the replacement is the
         # effective label, as defined by the task.
 
-        nomMapping = {}
-
         # Apparently, you may have the same file more than once. This
         # is a bug in the bug queue, and the only instance of doBatch in the
-        # system where that problem might arise is this one. So let's fix it.
-        
-        for f, annotSet in iDataPairs:
+        # system where that problem might arise is this one. So we
+        # keep track of everything by position in the batch, not by file.
 
+        annLists = []
+        for f, annotSet in iDataPairs:
             annotSet.metadata["replacer_used"] = replacer
-            
-            # First, generate all the nominations.
+            annLists.append(self._collectNominationAnnots(annotSet, replaceableAnnots))
 
-            digestionDict = {}
-            annList = []
+        workers = self._getNominateWorkers(nominate_workers, len(iDataPairs))
 
-            for eName in replaceableAnnots:
-                try:
-                    eType = annotSet.anameDict[eName]
-                except KeyError:
-                    # There may not be any.
-                    continue
-                # If it's spanless, skip it.
-                if not eType.hasSpan:
-                    continue
-                annList = annList + annotSet.atypeDict[eType]
+        if (workers > 1) or nominate_streaming:
+            self._twoPassNominate(r, workers, replacer, flagUnparseableSeeds, iDataPairs, annLists)
+            r.EndReplacement()
+            _reportReplacementProfile(r, "nominate", replacement_profile_file)
+            return iDataPairs
 
-            # Sort them in order.
+        # Digest.
 
-            annList.sort(key = lambda ann: ann.start)
+        digestions = []
+        for (f, annotSet), annList in zip(iDataPairs, annLists):
+            digestions.append(self._digestDocument(r, f, annotSet, annList))
+            if hasattr(r,  "dateDelta"):
+                # This is an integer.
+                annotSet.metadata["dateDelta"] = r.dateDelta
+
+        # Replace.
 
-            # Digest.
+        for (f, annotSet), annList, docDigestions in zip(iDataPairs, annLists, digestions):
+            self._recordNominations(replacer, flagUnparseableSeeds, annotSet, annList,
+                                    self._replaceDocument(r, f, docDigestions))
 
-            for annot in annList:
-                lab = self.descriptor.getEffectiveAnnotationLabel(annot)
-                digestionDict[annot] = (lab, r.Digest(lab, annotSet.signal[annot.start:annot.end]))
+        r.EndReplacement()
+        _reportReplacementProfile(r, "nominate", replacement_profile_file)
+        return iDataPairs
+
+    def _collectNominationAnnots(self, annotSet, replaceableAnnots):
+        
+        annList = []
+
+        for eName in replaceableAnnots:
+            try:
+                eType = annotSet.anameDict[eName]
+            except KeyError:
+                # There may not be any.
+                continue
+            # If it's spanless, skip it.
+            if not eType.hasSpan:
+                continue
+            annList = annList + annotSet.atypeDict[eType]
+
+        # Sort them in order.
+
+        annList.sort(key = lambda ann: ann.start)
+        return annList
+
+    # Returns a list of (label, pattern) pairs, in the order of annList.
+    
+    def _digestDocument(self, r, f, annotSet, annList):
+
+        # If there's a surrogate key, the document scope contributes
+        # to the replacement choices. Use the basename, so that it
+        # doesn't matter where the file lives.
+        r.setDocumentScope(f and os.path.basename(f))
+
+        spans = []
+        for annot in annList:
+            lab = self.descriptor.getEffectiveAnnotationLabel(annot)
+            spans.append((lab, annotSet.signal[annot.start:annot.end]))
+        digestions = zip([lab for lab, seed in spans], r.DigestDocument(spans))
+
+        r.EndDocumentForDigestion()
+        return digestions
+
+    # Returns a list of (replacement, ctype) pairs, where the ctype
+    # is present only if the seed couldn't be parsed.
+    
+    def _replaceDocument(self, r, f, digestions):
 
-            r.EndDocumentForDigestion()
+        r.setDocumentScope(f and os.path.basename(f))
 
+        res = []
+        for lab, digestion in digestions:
+            repl = r.Replace(lab, digestion, filename = f)
+            if hasattr(digestion, "seed_unparseable") and digestion.seed_unparseable:
+                res.append((repl, digestion.__ctype__))
+            else:
+                res.append((repl, None))
+
+        r.EndDocumentForReplacement()
+        return res
+
+    def _recordNominations(self, replacer, flagUnparseableSeeds, annotSet, annList, replacements):
+
+        for annot, (repl, unparseableCtype) in zip(annList, replacements):
+            lab = self.descriptor.getEffectiveAnnotationLabel(annot)
+            annot[self.descriptor.REDACTION_ATTR] = repl
+            # ONLY if we're in clear -> clear. Otherwise, it doesn't matter
+            # that the seed is unparseable. Either it's not expected to be,
+            # or the target doesn't care. 
+            if (replacer == "clear -> clear") and (lab in flagUnparseableSeeds) and \
+               (unparseableCtype is not None):
+                import sys
+                print >> sys.stderr, "WARNING: the '%s' phrase '%s' from %d to %d could not be parsed for nomination, and its nomination must be reviewed before the transform step can apply" % (annot.atype.lab, annotSet.signal[annot.start:annot.end], annot.start, annot.end)
+                annot[self.descriptor.SEED_UNPARSEABLE_ATTR] = unparseableCtype
+
+    # Two-pass nomination. In the first pass, we digest the documents
+    # and keep only what each document contributes to the corpus
+    # statistics (e.g., the address pattern distribution), merged in
+    # document order, so the statistics are exactly what they would be
+    # otherwise. In the second pass, we digest each document again (it's
+    # cheaper than storing the digested patterns somewhere) and replace.
+    # So the digested patterns for only one document exist at a time.
+    # That's all this saves: the caller (e.g., MATEngine) holds every
+    # document in the batch, so peak memory still grows with the batch.
+    # Each pass can be farmed out to worker processes. They're forked,
+    # so they inherit the engine and the documents; all that goes back
+    # and forth is document positions, corpus statistics and replacements.
+
+    def _getNominateWorkers(self, nominateWorkers, numDocs):
+        return _getWorkerCount(nominateWorkers, numDocs, "nominate_workers",
+                               lambda msg: Error.MATError("nominate", msg), "nominating")
+
+    def _twoPassNominate(self, r, workers, replacer, flagUnparseableSeeds, iDataPairs, annLists):
+        global _NOMINATE_WORKER_STATE
+
+        if workers > 1:
+            # Make sure the workers don't each have to load the resources.
+            r.repository.preloadAll()
+
+        # Digest. The digest worker clobbers the engine's date shift,
+        # which matters if we're not forking.
+
+        hadDateDelta = hasattr(r, "dateDelta")
+        oldDateDelta = getattr(r, "dateDelta", None)
+        dateDeltas = []
+        _NOMINATE_WORKER_STATE = (self, r, iDataPairs, annLists, None)
+        try:
+            for stats, dateDelta in _workerMap(workers, _nominateDigestWorker, len(iDataPairs)):
+                for lab, s in stats:
+                    r.getReplacer(lab).mergeCorpusStatistics(s)
+                dateDeltas.append(dateDelta)
+        finally:
+            _NOMINATE_WORKER_STATE = None
+            if hadDateDelta:
+                r.dateDelta = oldDateDelta
+            elif hasattr(r, "dateDelta"):
+                del r.dateDelta
+
+        for (f, annotSet), dateDelta in zip(iDataPairs, dateDeltas):
+            if dateDelta is not None:
+                r.dateDelta = dateDelta
             if hasattr(r,  "dateDelta"):
-                # This is an integer.
                 annotSet.metadata["dateDelta"] = r.dateDelta
 
-            nomMapping[(f, annotSet)] = (annList, digestionDict)
-            
-        # Replace.
+        # Finish the corpus distributions here, rather than in each worker.
+        r.EndDigestion()
 
-        for f, annotSet in iDataPairs:
+        # Replace. A batch-scoped cache has to be shared across all the
+        # documents, so in that case, the replacement happens here.
 
-            annList, digestionDict = nomMapping[(f, annotSet)]
-
-            for annot in annList:
-                lab, digestions = digestionDict[annot]
-                repl = r.Replace(lab, digestions, filename = f)
-                annot[self.descriptor.REDACTION_ATTR] = repl
-                # ONLY if we're in clear -> clear. Otherwise, it doesn't matter
-                # that the seed is unparseable. Either it's not expected to be,
-                # or the target doesn't care. 
-                if (replacer == "clear -> clear") and (lab in flagUnparseableSeeds) and \
-                   hasattr(digestions, "seed_unparseable") and digestions.seed_unparseable:
-                    import sys
-                    print >> sys.stderr, "WARNING: the '%s' phrase '%s' from %d to %d could not be parsed for nomination, and its nomination must be reviewed before the transform step can apply" % (annot.atype.lab, annotSet.signal[annot.start:annot.end], annot.start, annot.end)
-                    annot[self.descriptor.SEED_UNPARSEABLE_ATTR] = digestions.__ctype__
-
-            r.EndDocumentForReplacement()
-            
-        return iDataPairs
+        batchCaches = [rep.label for rep in r._replacers.values()
+                       if (rep._useCache or rep._useSeedCache) and not rep.flushAtDocBoundary]
+        if batchCaches and (workers > 1):
+            import sys
+            print >> sys.stderr, "WARNING: batch-scoped caches for %s; replacing serially" % ", ".join(batchCaches)
+            workers = 1
+
+        _NOMINATE_WORKER_STATE = (self, r, iDataPairs, annLists, dateDeltas)
+        try:
+            i = 0
+            for replacements in _workerMap(workers, _nominateReplaceWorker, len(iDataPairs)):
+                f, annotSet = iDataPairs[i]
+                self._recordNominations(replacer, flagUnparseableSeeds, annotSet, annLists[i], replacements)
+                i += 1
+        finally:
+            _NOMINATE_WORKER_STATE = None
+
+    # Digest a document whose statistics have already been collected,
+    # with the date shift which was chosen the first time.
+    
+    def _redigestDocument(self, r, f, annotSet, annList, dateDelta):
+        r.collectCorpusStatistics = False
+        r.forcedDateDelta = dateDelta
+        try:
+            return self._digestDocument(r, f, annotSet, annList)
+        finally:
+            r.collectCorpusStatistics = True
+            r.forcedDateDelta = None
 
     def undo(self, annotSet, **kw):
         try:
@@ -978,7 +1659,11 @@ class TransformStep(PluginStep):
 
     argList = [OpArgument("prologue", help = "Specify the text of a prologue to insert into the transformed document. You may wish to do this, e.g., to assert that all names in the document are fake. This option takes preference over --prologue_file.", hasArg = True),
                OpArgument("prologue_file", help = "Specify a file which contains the text of a prologue to insert into the transformed document. You may wish to do this, e.g., to assert that all names in the document are fake. The file is assumed to be in UTF-8 encoding. --prologue takes preference over this option.", hasArg = True),
-               OpArgument("dont_transform", help = "A comma-separated list of labels that should not be transformed", hasArg = True)]    
+               OpArgument("dont_transform", help = "A comma-separated list of labels that should not be transformed", hasArg = True),
+               OpArgument("profile_replacement",
+                          help = "profile the replacement engine, and print a JSON report of the transformation latencies on stderr. Also enabled by --subprocess_statistics."),
+               OpArgument("replacement_profile_file", hasArg = True,
+                          help = "write the --profile_replacement report to this file instead of stderr. Implies --profile_replacement.")]
 
     def __init__(self, *args, **kw):
         PluginStep.__init__(self, *args, **kw)
@@ -1047,7 +1732,8 @@ class TransformStep(PluginStep):
     # do it in batch, and within the batch process, do the individual file
     # replacements.
             
-    def doBatch(self, iDataPairs, replacer = None, prologue = None, prologue_file = None, dont_transform = None, **kw):
+    def doBatch(self, iDataPairs, replacer = None, prologue = None, prologue_file = None, dont_transform = None,
+                profile_replacement = False, replacement_profile_file = None, **kw):
 
         if (prologue is None) and (prologue_file is not None):
             if not os.path.isabs(prologue_file):
@@ -1081,6 +1767,7 @@ class TransformStep(PluginStep):
         r = self.descriptor.instantiateReplacer(replacer, **kw)
         if not r:
             raise Error.MATError("transform", "couldn't find the replacer named " + replacer)
+        _startReplacementProfile(r, profile_replacement, replacement_profile_file)
         if isinstance(r.renderingStrategy, ClearRenderingStrategy):
             clearTarget = True
         else:
@@ -1100,14 +1787,30 @@ class TransformStep(PluginStep):
 
         annotNames = self.descriptor.getAnnotationTypesByCategory("content")
 
+        # A document which can't be transformed is skipped, and
+        # reported; the rest of the batch is still transformed. Most of
+        # them are found before we start (see findUntransformableDocuments()).
+
+        untransformable = self.findUntransformableDocuments(iDataPairs, annotNames)
         outPairs = []
-        for fname, annotSet in iDataPairs:
-            try:
-                newSet = self._transformAnnotSet(r, annotSet, annotNames, dontTransform, prologue)
-                outPairs.append((fname, newSet))
-            except OverlapError:
-                sys.stderr.write("Can't transform document %s because there's an overlap\n" % fname)
-                return []
+        skipped = []
+        for i, (fname, annotSet) in enumerate(iDataPairs):
+            reason = untransformable.get(i)
+            if reason is None:
+                try:
+                    outPairs.append((fname, self._transformAnnotSet(r, annotSet, annotNames, dontTransform, prologue)))
+                    continue
+                except OverlapError:
+                    reason = "there's an overlap"
+                except PluginError, e:
+                    reason = str(e)
+            sys.stderr.write("Can't transform document %s: %s\n" % (fname, reason))
+            skipped.append(fname)
+
+        _reportReplacementProfile(r, "transform", replacement_profile_file)
+
+        if skipped:
+            print >> sys.stderr, "WARNING: skipped %d of %d documents in the transform step" % (len(skipped), len(iDataPairs))
             
         if clearTarget:
             self.augmentClearZones(outPairs)
@@ -1120,6 +1823,40 @@ class TransformStep(PluginStep):
 
         return outPairs
 
+    # Returns a dictionary from the index of each document in iDataPairs
+    # which can't be transformed to the reason why not: either some
+    # of its content annotations overlap (which orderAnnotations() would
+    # raise OverlapError for), or some seed couldn't be parsed during
+    # nomination and hasn't been reviewed. The annotations in each
+    # document are sorted once, and then checked in a single pass.
+
+    def findUntransformableDocuments(self, iDataPairs, annotNames):
+        unparseableAttr = self.descriptor.SEED_UNPARSEABLE_ATTR
+        untransformable = {}
+        for i, (fname, annotSet) in enumerate(iDataPairs):
+            annots = []
+            for aname in annotNames:
+                try:
+                    t = annotSet.anameDict[aname]
+                except KeyError:
+                    # There may not be any.
+                    continue
+                if t.hasSpan:
+                    annots += annotSet.atypeDict[t]
+            annots.sort(key = lambda a: (a.start, a.end))
+            # The annotation which ends last so far.
+            last = None
+            for a in annots:
+                if a.get(unparseableAttr) is not None:
+                    untransformable[i] = "the '%s' phrase '%s' from %d to %d could not be parsed for nomination, and its nomination must be reviewed before the transform step can apply" % (a.atype.lab, annotSet.signal[a.start:a.end], a.start, a.end)
+                    break
+                if (last is not None) and (a.start < last.end):
+                    untransformable[i] = "the '%s' annotation from %d to %d overlaps the '%s' annotation from %d to %d" % (a.atype.lab, a.start, a.end, last.atype.lab, last.start, last.end)
+                    break
+                if (last is None) or (a.end > last.end):
+                    last = a
+        return untransformable
+
     def _transformAnnotSet(self, engine, annotSet, annotNames, dontTransform, prologue):
 
         # Seed it with mapings into the original signal.
@@ -1135,11 +1872,7 @@ class TransformStep(PluginStep):
         # Note that orderAnnotations will filter out the spanless types.
         # This might generate an overlap error; see caller.
         
-        try:
-            annots = annotSet.orderAnnotations(annotNames)
-        except OverlapError:
-            sys.stderr.write("Can't transform document because there's an overlap\n")
-            return None
+        annots = annotSet.orderAnnotations(annotNames)
 
         atypeIndexDict = {}
 
@@ -1181,7 +1914,11 @@ class TransformStep(PluginStep):
             else:
                 preservationTuples.append((a.atype.lab, a.start, a.end))
 
-        output, finalTuples = engine.Transform(signal, prologue, replacementTuples, preservationTuples)
+        output, finalTuples, offsetMap = engine.TransformWithOffsetMap(signal, prologue, replacementTuples,
+                                                                       preservationTuples)
+        # So annotations on the original document can be projected
+        # onto this one without realigning (see OffsetMap).
+        d.metadata["offset_map"] = offsetMap.toJSON()
 
         for lab, start, end in finalTuples:
 
@@ -1278,6 +2015,160 @@ class ResynthTagStep(TagStep):
         except Exception, e:
             raise Error.MATError("tag", str(e), show_tb = True)
 
+# A Carafe tag step which uses the resident taggers in CarafeTaggerPool.py
+# instead of starting jCarafe for each run. It uses them when the
+# step has a tagger_server_jar setting (the jcarafe_xmlrpc jar, which
+# provides jCarafe's XML-RPC tagging service); otherwise, or if
+# tagger_local is set, or there's no model, it's the Carafe tag
+# step. The taggers last as long as the process, so the MATWeb requests
+# share them; if tagger_pool_dir is set, the taggers are recorded there
+# and outlive the process, so successive MATEngine runs share them
+# too (CarafeTaggerPool.stopRegistered() stops them). Each document
+# goes to the tagger in a call of its own, so jCarafe gets the same
+# input the Carafe tag step would give it. The task's Demo workflow
+# still uses the Carafe tag step; to use this one, name it as the
+# step class (see task.xml).
+
+# The tagger only tags inside the SEGMENTs whose annotator is MACHINE
+# or null, just like the local one, and we mark those SEGMENTs as
+# MACHINE afterward. Only the zone and token annotations are sent,
+# and only the content annotations are copied back.
+
+# Either way, the batch can be tagged by several jCarafe processes at
+# once: tagger_workers of them, but no more than fit in
+# tagger_memory_budget if it's set (which requires heap_size, since
+# each process gets a heap that size). With the resident taggers, the
+# model's tagger gets that many processes. Otherwise, the batch is
+# divided into that many consecutive shards, which are tagged by the
+# Carafe tag step at the same time, each by its own jCarafe. Each
+# document is tagged on its own either way, so the zones are respected
+# just as they are without the workers, and the documents come back
+# in the order they went in.
+
+class PooledCarafeTagStep(CarafeTagStep):
+
+    argList = CarafeTagStep.argList + \
+              [OpArgument("tagger_server_jar", hasArg = True,
+                          help = "the jcarafe_xmlrpc jar. If present, the documents are tagged by a resident jCarafe tagging service for the model, which is started the first time it's needed."),
+               OpArgument("tagger_pool_dir", hasArg = True,
+                          help = "a directory in which to record the resident taggers, so that later runs can reuse them. They run until they're stopped."),
+               OpArgument("tagger_workers", hasArg = True,
+                          help = "tag using this many jCarafe processes at once. Default is 1."),
+               OpArgument("tagger_memory_budget", hasArg = True,
+                          help = "the memory available to the jCarafe processes, in the form of the heap_size (e.g., 4G). The number of processes is limited to the ones whose heaps fit. Requires heap_size. With no tagger_workers, the number of processors is the limit.")]
+
+    def doBatch(self, iDataPairs, tagger_server_jar = None, tagger_pool_dir = None,
+                tagger_workers = None, tagger_memory_budget = None, **kw):
+        model = kw.get("tagger_model")
+        workers = _getTaggerWorkers(tagger_workers, tagger_memory_budget, kw.get("heap_size"), len(iDataPairs))
+        if (not tagger_server_jar) or (not model) or kw.get("tagger_local"):
+            if workers == 1:
+                return CarafeTagStep.doBatch(self, iDataPairs, **kw)
+            return self._doShardedBatch(iDataPairs, workers, **kw)
+        import CarafeTaggerPool, MAT.DocumentIO
+        try:
+            import json
+        except ImportError:
+            import simplejson as json
+        pool = CarafeTaggerPool.getPool(registryDir = tagger_pool_dir)
+        options = []
+        if kw.get("prior_adjust") is not None:
+            options += ["--prior-adjust", str(kw["prior_adjust"])]
+        tagger = pool.getTagger(tagger_server_jar, model, heapSize = kw.get("heap_size"), options = options,
+                                processes = workers)
+        sendTypes = set(self.descriptor.getAnnotationTypesByCategory("zone") +
+                        self.descriptor.getAnnotationTypesByCategory("token") + ["SEGMENT"])
+        contentTypes = set(self.descriptor.getAnnotationTypesByCategory("content"))
+        _jsonIO = MAT.DocumentIO.getDocumentIO("mat-json", task = self.descriptor)
+        docs = []
+        for fname, annotSet in iDataPairs:
+            d = json.loads(_jsonIO.writeToUnicodeString(annotSet))
+            d["asets"] = [aset for aset in d.get("asets", []) if aset["type"] in sendTypes]
+            docs.append(d)
+        try:
+            results = tagger.tagDocuments(docs)
+        except CarafeTaggerPool.CarafeTaggerPoolError, e:
+            raise Error.MATError("tag", str(e))
+        for (fname, annotSet), asets in zip(iDataPairs, results):
+            present = set([(a.start, a.end, a.atype.lab) for a in annotSet.getAnnotations(list(contentTypes))])
+            for aset in asets:
+                if aset["type"] not in contentTypes:
+                    continue
+                for annot in aset["annots"]:
+                    if (annot[0], annot[1], aset["type"]) not in present:
+                        annotSet.createAnnotation(annot[0], annot[1], aset["type"])
+            for seg in annotSet.getAnnotations(["SEGMENT"]):
+                if seg.get("annotator") in (None, "MACHINE"):
+                    seg["annotator"] = "MACHINE"
+        return iDataPairs
+
+    def _doShardedBatch(self, iDataPairs, workers, **kw):
+        size = (len(iDataPairs) + workers - 1) / workers
+        shards = [iDataPairs[i:i + size] for i in range(0, len(iDataPairs), size)]
+        results = [None] * len(shards)
+        errors = []
+        def tagShard(i):
+            try:
+                results[i] = CarafeTagStep.doBatch(self, shards[i], **kw)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target = tagShard, args = (i,)) for i in range(len(shards))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        outPairs = []
+        for r in results:
+            outPairs += r
+        return outPairs
+
+# The number of jCarafe processes for the tag step (see
+# PooledCarafeTagStep).
+
+def _getTaggerWorkers(taggerWorkers, memoryBudget, heapSize, numDocs):
+    if taggerWorkers is None:
+        workers = None
+    else:
+        try:
+            workers = int(taggerWorkers)
+        except ValueError:
+            raise Error.MATError("tag", "tagger_workers must be an integer")
+        if workers < 1:
+            raise Error.MATError("tag", "tagger_workers must be at least 1")
+    if memoryBudget is not None:
+        if not heapSize:
+            raise Error.MATError("tag", "tagger_memory_budget requires heap_size")
+        fit = max(1, _javaMemorySize(memoryBudget) / _javaMemorySize(heapSize))
+        if workers is None:
+            try:
+                import multiprocessing
+                workers = multiprocessing.cpu_count()
+            except (ImportError, NotImplementedError):
+                workers = 1
+        workers = min(workers, fit)
+    if workers is None:
+        return 1
+    return max(1, min(workers, numDocs))
+
+# Java memory sizes, as in -Xmx: a number of bytes, optionally followed
+# by k, m or g.
+
+def _javaMemorySize(s):
+    num = s.strip().lower()
+    mult = 1
+    if num and num[-1] in "kmg":
+        mult = {"k": 1024, "m": 1024 * 1024, "g": 1024 * 1024 * 1024}[num[-1]]
+        num = num[:-1]
+    try:
+        v = int(num) * mult
+    except ValueError:
+        v = 0
+    if v <= 0:
+        raise Error.MATError("tag", "bad Java memory size '%s'" % s)
+    return v
+
 # Undocumented utility for expanding the documentation in-line.
 
 class DocEnhancer(PluginDocInstaller):
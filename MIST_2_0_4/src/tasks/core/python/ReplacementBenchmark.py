@@ -0,0 +1,329 @@
+# Copyright (C) 2012 The MITRE Corporation. See the toplevel
+# file LICENSE for license terms.
+
+# This file implements a benchmark for the replacement engines. It
+# generates a synthetic corpus from the replacement engine's own
+# resources (names, towns, streets, hospitals, URLs), runs an engine
+# over it the way the nominate step does (digest everything, then
+# replace everything), and reports:
+#
+# - the cold start time: constructing the engine and processing a
+#   warmup document with one span of each label, which is when the
+#   resources are loaded
+# - for each label, the number of spans and the time spent in Digest()
+#   and Replace(), and the resulting spans per second
+# - the peak resident set size of the process, where the platform
+#   reports it
+# - the change in the number of live objects the garbage collector
+#   tracks. Python 2 has no allocation tracing, so this is
+#   the closest we can get to the engine's allocations.
+#
+# The reports are dictionaries which can be written as JSON, and
+# compareReports() compares two of them. Like the rest of the replacement
+# engine, this uses nothing from MAT; see
+# core/standalone/bin/benchmarkReplacers.py for the command line.
+
+import sys, gc, random, inspect, timeit
+
+from ReplacementEngine import Repository, PIIPersonPattern, PIIPhonePattern, \
+     PIILocationPattern, PIIHospitalPattern, PIIDatePattern, PIIAgePattern, \
+     PIIEmailPattern, PIIURLPattern, PIIIDPattern, PIISSNPattern, \
+     PIIIPAddressPattern, PIICountryPattern
+
+REPORT_VERSION = 1
+
+_timer = timeit.default_timer
+
+# The categories for the core engines, which don't have any of their own.
+
+CORE_CATEGORIES = {"PERSON": (PIIPersonPattern, {}),
+                   "PHONE": (PIIPhonePattern, {}),
+                   "LOCATION": (PIILocationPattern, {}),
+                   "HOSPITAL": (PIIHospitalPattern, {}),
+                   "DATE": (PIIDatePattern, {}),
+                   "AGE": (PIIAgePattern, {}),
+                   "EMAIL": (PIIEmailPattern, {}),
+                   "URL": (PIIURLPattern, {}),
+                   "ID": (PIIIDPattern, {}),
+                   "SSN": (PIISSNPattern, {}),
+                   "IPADDRESS": (PIIIPAddressPattern, {})}
+
+class BenchmarkError(Exception):
+    pass
+
+#
+# The corpus.
+#
+
+class SyntheticCorpus:
+
+    DATE_FORMATS = ["%(m)02d/%(d)02d/%(y)04d", "%(m)d/%(d)d/%(yy)02d", "%(m)d/%(d)d",
+                    "%(y)04d-%(m)02d-%(d)02d", "%(mname)s %(d)d, %(y)04d", "%(d)d %(mname)s %(y)04d"]
+    MONTHS = ["January", "February", "March", "April", "May", "June", "July",
+              "August", "September", "October", "November", "December"]
+
+    def __init__(self, dataDirs, seed = 0):
+        # A separate repository, so that generating the corpus doesn't
+        # load the resources for the engine being measured.
+        self.repository = Repository(dataDirs)
+        self.rng = random.Random(seed)
+        self.seed = seed
+
+    # Generators, by pattern class. The first one the category's pattern
+    # class inherits from wins.
+
+    def _generators(self):
+        return [(PIIPersonPattern, self.person),
+                (PIIPhonePattern, self.phone),
+                (PIILocationPattern, self.location),
+                (PIIHospitalPattern, self.hospital),
+                (PIIDatePattern, self.date),
+                (PIIAgePattern, self.age),
+                (PIIEmailPattern, self.email),
+                (PIIURLPattern, self.url),
+                (PIIIDPattern, self.id),
+                (PIISSNPattern, self.ssn),
+                (PIIIPAddressPattern, self.ipAddress),
+                (PIICountryPattern, self.country)]
+
+    def generatorForCategory(self, cls):
+        for patCls, gen in self._generators():
+            if inspect.isclass(cls) and issubclass(cls, patCls):
+                return gen
+        return self.other
+
+    def _cap(self, s):
+        return s[0].upper() + s[1:].lower()
+
+    def person(self):
+        names = self.repository.loadNames()
+        if self.rng.random() < 0.5:
+            first = names.maleFirstNameDist.WeightedChoice(rng = self.rng)[0]
+        else:
+            first = names.femaleFirstNameDist.WeightedChoice(rng = self.rng)[0]
+        last = self._cap(names.lastNameDist.WeightedChoice(rng = self.rng))
+        r = self.rng.random()
+        if r < 0.4:
+            return "%s %s" % (self._cap(first), last)
+        elif r < 0.6:
+            return "%s, %s" % (last, self._cap(first))
+        elif r < 0.8:
+            return "Dr. " + last
+        else:
+            return last
+
+    def phone(self):
+        areaCode = self.rng.choice(self.repository.loadAreaCodes())
+        exchange, number = self.rng.randint(200, 999), self.rng.randint(0, 9999)
+        if self.rng.random() < 0.5:
+            return "(%s) %d-%04d" % (areaCode, exchange, number)
+        else:
+            return "%s-%d-%04d" % (areaCode, exchange, number)
+
+    def location(self):
+        city, state, zipCode = self.rng.choice(self.repository.loadZipsCitiesStates())
+        stateAbbr = state.alts["shortabbr"][0]
+        r = self.rng.random()
+        if r < 0.4:
+            streetNames, postfixDist = self.repository.loadStreetNames()
+            street = "%d %s %s" % (self.rng.randint(1, 999), self._cap(self.rng.choice(streetNames)),
+                                   self._cap(postfixDist.WeightedChoice(rng = self.rng)[0]))
+            return "%s, %s, %s %s" % (street, city, stateAbbr, zipCode)
+        elif r < 0.7:
+            return "%s, %s" % (city, stateAbbr)
+        else:
+            return city
+
+    def hospital(self):
+        hospitals, postSeqDist = self.repository.loadHospitals()
+        return " ".join(hospitals.WeightedChoice(rng = self.rng) + [postSeqDist.WeightedChoice(rng = self.rng)])
+
+    def date(self):
+        y = self.rng.randint(1970, 2012)
+        m = self.rng.randint(1, 12)
+        return self.rng.choice(self.DATE_FORMATS) % {"y": y, "yy": y % 100, "m": m, "d": self.rng.randint(1, 28),
+                                                    "mname": self.MONTHS[m - 1]}
+
+    def age(self):
+        return str(self.rng.randint(1, 99))
+
+    def email(self):
+        names = self.repository.loadNames()
+        return "%s@%s" % (names.lastNameDist.WeightedChoice(rng = self.rng).lower(),
+                          self.rng.choice(self.repository.loadURLs()[0]).replace("www.", ""))
+
+    def url(self):
+        hostList, pathSuffs = self.repository.loadURLs()
+        return "http://%s%s" % (self.rng.choice(hostList), self.rng.choice(pathSuffs))
+
+    def id(self):
+        return "%s%d" % ("".join([chr(self.rng.randint(65, 90)) for i in range(2)]), self.rng.randint(10000, 9999999))
+
+    def ssn(self):
+        return "%03d-%02d-%04d" % (self.rng.randint(1, 899), self.rng.randint(1, 99), self.rng.randint(1, 9999))
+
+    def ipAddress(self):
+        return ".".join([str(self.rng.randint(1, 254)) for i in range(4)])
+
+    def country(self):
+        return self.rng.choice(["Canada", "France", "Brazil", "Japan", "Kenya"])
+
+    def other(self):
+        return self.id()
+
+    # Returns a list of (name, [(label, string), ...]).
+
+    def generate(self, categories, numDocs, spansPerDoc):
+        labels = categories.keys()
+        labels.sort()
+        gens = [(label, self.generatorForCategory(categories[label][0])) for label in labels]
+        docs = []
+        for i in range(numDocs):
+            spans = []
+            for j in range(spansPerDoc):
+                label, gen = self.rng.choice(gens)
+                spans.append((label, gen()))
+            docs.append(("doc%d" % i, spans))
+        return docs
+
+    # One span of each label.
+
+    def warmupDocument(self, categories):
+        labels = categories.keys()
+        labels.sort()
+        return ("warmup", [(label, self.generatorForCategory(categories[label][0])()) for label in labels])
+
+#
+# Measurement.
+#
+
+def _peakRSSKb():
+    try:
+        import resource
+    except ImportError:
+        # Windows, Jython.
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # Bytes, not kilobytes.
+        rss = rss / 1024
+    return rss
+
+def _liveObjects():
+    gc.collect()
+    return len(gc.get_objects())
+
+# Process the documents the way the nominate step does. If times is
+# provided, it's a dictionary from label to [digest seconds, replace seconds, spans].
+
+def _processDocuments(engine, docs, times = None):
+    digestions = []
+    for name, spans in docs:
+        engine.setDocumentScope(name)
+        pats = []
+        for label, s in spans:
+            t = _timer()
+            pats.append((label, engine.Digest(label, s)))
+            if times is not None:
+                entry = times.setdefault(label, [0.0, 0.0, 0])
+                entry[0] += _timer() - t
+                entry[2] += 1
+        engine.EndDocumentForDigestion()
+        digestions.append((name, pats))
+    engine.EndDigestion()
+    for name, pats in digestions:
+        engine.setDocumentScope(name)
+        for label, pat in pats:
+            t = _timer()
+            engine.Replace(label, pat, filename = name)
+            if times is not None:
+                times[label][1] += _timer() - t
+        engine.EndDocumentForReplacement()
+    engine.EndReplacement()
+
+def benchmarkEngine(engineCls, categories, dataDirs, numDocs = 200, spansPerDoc = 20,
+                    seed = 0, engineName = None, **engineKw):
+    corpus = SyntheticCorpus(dataDirs, seed)
+    docs = corpus.generate(categories, numDocs, spansPerDoc)
+    warmup = corpus.warmupDocument(categories)
+    # Don't count the corpus.
+    corpus = None
+    liveBefore = _liveObjects()
+    random.seed(seed)
+    t = _timer()
+    engine = engineCls(dataDirs, categories, **engineKw)
+    constructSeconds = _timer() - t
+    _processDocuments(engine, [warmup])
+    coldStartSeconds = _timer() - t
+    times = {}
+    t = _timer()
+    _processDocuments(engine, docs, times)
+    totalSeconds = _timer() - t
+    labels = {}
+    totalSpans = 0
+    for label, (digestSeconds, replaceSeconds, spans) in times.items():
+        totalSpans += spans
+        labels[label] = {"spans": spans,
+                         "digest_seconds": digestSeconds,
+                         "replace_seconds": replaceSeconds,
+                         "spans_per_second": _rate(spans, digestSeconds + replaceSeconds)}
+    return {"engine": engineName or ("%s.%s" % (engineCls.__module__, engineCls.__name__)),
+            "rname": engineCls.__rname__,
+            "construct_seconds": constructSeconds,
+            "cold_start_seconds": coldStartSeconds,
+            "total_seconds": totalSeconds,
+            "spans": totalSpans,
+            "spans_per_second": _rate(totalSpans, totalSeconds),
+            "labels": labels,
+            "peak_rss_kb": _peakRSSKb(),
+            "live_objects_delta": _liveObjects() - liveBefore}
+
+def _rate(n, seconds):
+    if seconds > 0:
+        return n / seconds
+    else:
+        return None
+
+def newReport(numDocs, spansPerDoc, seed):
+    import platform
+    return {"version": REPORT_VERSION,
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "corpus": {"docs": numDocs, "spans_per_doc": spansPerDoc, "seed": seed},
+            "engines": []}
+
+#
+# Comparison.
+#
+
+# Returns a list of (engine, label, measure, old, new, ratio) for the
+# cold start time and each throughput figure present in both reports.
+# The ratio is new / old for throughput and old / new for the cold
+# start time, so in both cases less than 1 means the new version is slower.
+
+def compareReports(oldReport, newReport):
+    if oldReport.get("corpus") != newReport.get("corpus"):
+        print >> sys.stderr, "Warning: the reports were generated from different corpora"
+    oldEngines = dict([(e["engine"], e) for e in oldReport["engines"] if not e.has_key("error")])
+    rows = []
+    for e in newReport["engines"]:
+        old = oldEngines.get(e["engine"])
+        if (old is None) or e.has_key("error"):
+            continue
+        rows.append((e["engine"], None, "cold_start_seconds", old["cold_start_seconds"], e["cold_start_seconds"],
+                     _ratio(e["cold_start_seconds"], old["cold_start_seconds"])))
+        rows.append((e["engine"], None, "spans_per_second", old["spans_per_second"], e["spans_per_second"],
+                     _ratio(old["spans_per_second"], e["spans_per_second"])))
+        labels = e["labels"].keys()
+        labels.sort()
+        for label in labels:
+            if old["labels"].has_key(label):
+                o, n = old["labels"][label]["spans_per_second"], e["labels"][label]["spans_per_second"]
+                rows.append((e["engine"], label, "spans_per_second", o, n, _ratio(o, n)))
+    return rows
+
+def _ratio(denom, num):
+    if denom and num:
+        return float(num) / denom
+    else:
+        return None
@@ -37,7 +37,7 @@
 # an engine: the engine maps tags in a domain to pattern classes, and
 # also has a strategy.
 
-import random, sys, re, os, datetime
+import random, sys, re, os, datetime, array, bisect, copy, threading
 random.seed()
 
 #
@@ -250,19 +250,61 @@ class XMLResource:
         except KeyError:
             return []
 
-    def choose(self, altType = None, noneVal = None):
+    def choose(self, altType = None, noneVal = None, rng = random):
         if self.weighted:
-            c = self.distSet.WeightedChoice(noneVal = None)
+            c = self.distSet.WeightedChoice(noneVal = None, rng = rng)
         elif self.distSet:
-            c = random.choice(self.distSet)
+            c = rng.choice(self.distSet)
         else:
             c = None
         if c is None:
             return noneVal
         elif (altType is not None) and c.alts.has_key(altType):
-            return random.choice(c.alts[altType])
+            return rng.choice(c.alts[altType])
         else:
-            return random.choice(c.heads)            
+            return rng.choice(c.heads)            
+
+# A trie over token sequences, stored in reverse, so that the entries
+# which end a list of tokens can be found by walking the list from the
+# end. Each node is a dictionary from token to node; the value of the
+# entry which ends at a node, if any, is stored under None.
+
+class ReverseTokenTrie:
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, toks, value):
+        node = self.root
+        for i in range(len(toks) - 1, -1, -1):
+            try:
+                node = node[toks[i]]
+            except KeyError:
+                child = {}
+                node[toks[i]] = child
+                node = child
+        # The first value for a sequence wins.
+        if not node.has_key(None):
+            node[None] = value
+
+    # Returns (n, value) for the shortest entry formed by the last n
+    # tokens, n <= maxToks, or None. If provided, normalize is applied
+    # to each token before it's looked up.
+
+    def shortestSuffix(self, toks, maxToks, normalize = None):
+        node = self.root
+        n = 0
+        for i in range(len(toks) - 1, max(-1, len(toks) - maxToks - 1), -1):
+            t = toks[i]
+            if normalize is not None:
+                t = normalize(t)
+            node = node.get(t)
+            if node is None:
+                return None
+            n += 1
+            if node.has_key(None):
+                return n, node[None]
+        return None
 
 class NameResource:
 
@@ -433,13 +475,16 @@ class NameResource:
         if self.firstNameHash is None:
             # This will overwrite, because nicknames
             # can map to multiple things, but it really doesn't matter.
-            self.firstNameHash = {}
+            # Build it before publishing it, since another thread
+            # may be looking (see PIIReplacementEngine.newContext()).
+            h = {}
             self.loadNames()
             for dist, gender in ((self.maleFirstNameDist, "M"), (self.femaleFirstNameDist, "F"),
                                  (self.neutralFirstNameDist, "N")):
-                for names in dist.items.keys():
+                for names in dist.itemKeys():
                     for name in names:
-                        self.firstNameHash[name] = (gender, dist, names)
+                        h[name] = (gender, dist, names)
+            self.firstNameHash = h
         return self.firstNameHash
 
     def getFirstNameDist(self, gender):
@@ -452,15 +497,29 @@ class NameResource:
 
 class Repository:
 
-    def __init__(self, data_dirs, resourceReplacements = None):
+    # If it's present in one of the data dirs, this file is
+    # used as the resource snapshot. See ResourceSnapshot.py.
+
+    SNAPSHOT_FILE = "replacement_resources.snapshot"
+
+    # If compact is true, groups which are loaded from the resource
+    # files are stored the way a snapshot stores them, if that's
+    # smaller (see loadNames()).
+
+    def __init__(self, data_dirs, resourceReplacements = None,
+                 snapshotPath = None, findSnapshot = True, compact = True,
+                 verifySnapshot = False):
         self.dataDirs = data_dirs
+        self.compact = compact
         self.countries = None
         self.areaCodes = None
         # For hospitals.
         self.hospitalPostSeqDist = None
         self.hospitals = None
         self.states = None
+        self.stateTrie = None
         self.streetPostfixes = None
+        self.streetPostfixHash = None
         self.townTuples = None
         self.streetNames = None
         self.streetPostfixDist = None
@@ -469,18 +528,119 @@ class Repository:
         self.pathSuffs = None
         self.datePatternDist = None
         self.resourceReplacements = resourceReplacements
+        # None means we haven't looked yet, False means there isn't one.
+        self.snapshot = None
+        self.snapshotPath = snapshotPath
+        self.findSnapshot = findSnapshot
+        self.verifySnapshot = verifySnapshot
+        self._preloadLock = threading.Lock()
+        self._preloaded = False
+        self._frozen = False
+        # The snapshot groups (see ResourceSnapshot.SNAPSHOT_GROUPS)
+        # which are stored in the snapshot representation.
+        self._compactGroups = set()
+
+    # The snapshot is consulted group by group, so that if, e.g.,
+    # resource_file_repl replaces the hospitals, the snapshot
+    # names are still used.
+    
+    def _getSnapshot(self):
+        if self.snapshot is None:
+            self.snapshot = False
+            p = self.snapshotPath
+            if (p is None) and self.findSnapshot:
+                for d in self.dataDirs:
+                    if os.path.exists(os.path.join(d, self.SNAPSHOT_FILE)):
+                        p = os.path.join(d, self.SNAPSHOT_FILE)
+                        break
+            if p is not None:
+                import ResourceSnapshot
+                try:
+                    self.snapshot = ResourceSnapshot.ResourceSnapshot(p, verifyChecksums = self.verifySnapshot)
+                except (IOError, ResourceSnapshot.ResourceSnapshotError), e:
+                    print >> sys.stderr, "Ignoring resource snapshot %s: %s" % (p, e)
+        return self.snapshot
+
+    def _loadFromSnapshot(self, group):
+        snapshot = self._getSnapshot()
+        if snapshot and snapshot.isCurrent(group, self):
+            snapshot.populate(group, self)
+            self._compactGroups.add(group)
+            return True
+        return False
 
     def loadNames(self):
-        if self.nameResource is None:
+        if (self.nameResource is None) and (not self._loadFromSnapshot("names")):
             self.nameResource = NameResource(self)
             self.nameResource.loadNames()
+            if self.compact:
+                # The dictionaries take several hundred times the space
+                # of the snapshot representation, so switch to that.
+                import ResourceSnapshot
+                ResourceSnapshot.compactGroup(self, "names")
+                self._compactGroups.add("names")
         return self.nameResource
 
     def getFirstNameHash(self):
-        if self.nameResource is None:
-            self.nameResource = NameResource(self)
-            self.nameResource.loadNames()
-        return self.nameResource.getFirstNameHash()
+        return self.loadNames().getFirstNameHash()
+
+    # Load everything. Ordinarily, the resources are loaded the first
+    # time they're needed, but if the engine is going to be forked
+    # (see the nominate step), it's better to load them before, so
+    # the children share them. Once everything's loaded, nothing in the
+    # repository changes, so it can be shared among threads (see
+    # PIIReplacementEngine.newContext()).
+
+    def preloadAll(self):
+        self._preloadLock.acquire()
+        try:
+            if not self._preloaded:
+                self.loadNames()
+                self.loadAreaCodes()
+                self.loadHospitals()
+                self.loadStates()
+                self.loadStreetPostfixes()
+                self.loadZipsCitiesStates()
+                self.loadStreetNames()
+                self.loadURLs()
+                self.loadDatePatterns()
+                self.loadCountries()
+                self.getFirstNameHash()
+                self.getStateTrie()
+                self.getStreetPostfixHash()
+                self._preloaded = True
+        finally:
+            self._preloadLock.release()
+
+    # Load everything, and store every group in the snapshot
+    # representation, even the ones compact doesn't cover. This is for
+    # processes which fork workers (see the preload_replacement_resources
+    # task setting in Deidentification.py). The children share the
+    # parent's pages until one of them writes to a page, and in CPython
+    # reading an object writes to it (the reference count), as does
+    # the garbage collector's traversal of lists and dictionaries. So
+    # the hundreds of thousands of strings and floats in the parsed
+    # resources end up copied into each child. A frozen group is a
+    # handful of objects over a single string buffer; reading from it
+    # creates new objects, but leaves the buffer alone. If the groups
+    # come from a snapshot file, the buffer is the mapped file, so even
+    # unrelated processes on the host share it.
+
+    def freeze(self):
+        self.preloadAll()
+        self._preloadLock.acquire()
+        try:
+            if not self._frozen:
+                import ResourceSnapshot
+                for group, sources, compileFn in ResourceSnapshot.SNAPSHOT_GROUPS:
+                    if group not in self._compactGroups:
+                        ResourceSnapshot.compactGroup(self, group)
+                        self._compactGroups.add(group)
+                # Compacting the names replaces the name resource.
+                self.getFirstNameHash()
+                self._frozen = True
+        finally:
+            self._preloadLock.release()
 
     def _getPath(self, resourceFile):
         if (self.resourceReplacements is not None) and \
@@ -524,7 +684,7 @@ class Repository:
     # Comment line is #.
 
     def loadAreaCodes(self):
-        if self.areaCodes is None:
+        if (self.areaCodes is None) and (not self._loadFromSnapshot("areaCodes")):
             self.areaCodes = []
             lines = self.loadLines("area_codes.txt")
             for l in lines:
@@ -552,7 +712,7 @@ class Repository:
     # or the hospital entry is length 0.
     
     def loadHospitals(self):
-        if self.hospitals is None:
+        if (self.hospitals is None) and (not self._loadFromSnapshot("hospitals")):
             posttokD = dict(map(lambda x: (x, 0), self.HOSP_POST_TOKENS))
             postStrD = CountDistributionSet()
             self.hospitals = LengthDistributionSet()
@@ -590,6 +750,20 @@ class Repository:
             self.states = self.loadXMLResource("states.xml")
         return self.states
 
+    # The states, as a ReverseTokenTrie, so that the LOCATION digester
+    # can peel the state off the end of an address in one pass
+    # (see ClearDigestionStrategy.LOCATIONDigest). The tokens are
+    # uppercase, as in the lookUp() index, and the value is the way the
+    # first entry matches (None for the head, otherwise the alt type).
+
+    def getStateTrie(self):
+        if self.stateTrie is None:
+            trie = ReverseTokenTrie()
+            for k, eList in self.loadStates().entryMap.items():
+                trie.add(k.split(" "), eList[0][0])
+            self.stateTrie = trie
+        return self.stateTrie
+
     # Street postfixes. File format is comma-delimited. Entries are
     # all caps. Comment character is #. Abbrevs don't end in a period.
     # The first token is the full name, the rest are abbrevs.
@@ -604,13 +778,35 @@ class Repository:
                 self.streetPostfixes.append(toks)
         return self.streetPostfixes
 
+    # A map from each way a postfix can appear as a token, in lowercase
+    # (period/no period for abbr, comma/no comma for all), to the postfix.
+    # It's here rather than on the location replacer so it's only
+    # built once, no matter how many engines (or engine contexts)
+    # share the repository.
+
+    def getStreetPostfixHash(self):
+        if self.streetPostfixHash is None:
+            h = {}
+            for postfix in self.loadStreetPostfixes():
+                fullName = postfix[0].lower()
+                h[fullName] = postfix
+                h[fullName + ","] = postfix
+                for abbr in postfix[1:]:
+                    abbr = abbr.lower()
+                    h[abbr] = postfix
+                    h[abbr + "."] = postfix
+                    h[abbr + ","] = postfix
+                    h[abbr + ".,"] = postfix
+            self.streetPostfixHash = h
+        return self.streetPostfixHash
+
     # Zips, towns, states. We can randomly select these, and they'll
     # probably be of equal weight. It also gives us a decent list of
     # towns. File format is zip:town:2-letter state abbr. # is
     # comment character.
 
     def loadZipsCitiesStates(self):
-        if self.townTuples is None:
+        if (self.townTuples is None) and (not self._loadFromSnapshot("townTuples")):
             self.townTuples = []
             states = self.loadStates()
             sDict = {}
@@ -634,7 +830,7 @@ class Repository:
     # token in the postfixes and strip it.
 
     def loadStreetNames(self):
-        if self.streetNames is None:
+        if (self.streetNames is None) and (not self._loadFromSnapshot("streetNames")):
             self.streetNames = []
             postFixes = self.loadStreetPostfixes()
             dist = CountDistributionSet()
@@ -656,7 +852,7 @@ class Repository:
         return self.streetNames, self.streetPostfixDist
 
     def loadURLs(self):        
-        if self.hostList is None:
+        if (self.hostList is None) and (not self._loadFromSnapshot("urls")):
             import urlparse
             d = {}
             self.pathSuffs = []
@@ -673,10 +869,14 @@ class Repository:
             self.hostList = d.keys()
         return self.hostList, self.pathSuffs
 
+    # The items in the date pattern distribution are the token
+    # sequences of the sample dates (see PIIDatePattern).
+
     def loadDatePatterns(self):
-        if self.datePatternDist is None:
+        if (self.datePatternDist is None) and (not self._loadFromSnapshot("datePatterns")):
             # Import here rather than earlier because we need
             # path information which may not be available at module load
+            _addDateutilPath(self.dataDirs)
             import dateutil.parser
             self.datePatternDist = FloatDistributionSet()
             for line in self.loadLines("date_patterns.txt"):
@@ -687,7 +887,7 @@ class Repository:
                 if len(toks) == 2:
                     try:
                         fnum = float(toks[0])
-                        dateSeed = dateutil.parser.digest(toks[1].strip())
+                        dateSeed = _dateTokSeq(dateutil.parser.digest(toks[1].strip()))
                     except ValueError:
                         # Something failed to parse.
                         print >> sys.stderr, "Couldn't use date pattern line", line
@@ -747,11 +947,46 @@ class Repository:
 class DistributionSetError(Exception):
     pass
 
+# The distribution sets draw using Walker's alias method (with
+# Vose's construction of the table), which takes constant time
+# per draw. Given n items whose frequencies sum to the overall
+# frequency, the table assigns each slot i a probability and an
+# alias; a draw picks a slot uniformly, and then returns the slot's
+# own item with its probability, and the alias otherwise. Both
+# halves of the table are flat arrays.
+
+def _buildAliasTable(freqs, total):
+    n = len(freqs)
+    probs = array.array("d", [1.0] * n)
+    aliases = array.array("i", range(n))
+    if (n == 0) or (total <= 0):
+        return probs, aliases
+    scaled = [(f * n) / total for f in freqs]
+    small = [i for i in range(n) if scaled[i] < 1.0]
+    large = [i for i in range(n) if scaled[i] >= 1.0]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        probs[s] = scaled[s]
+        aliases[s] = l
+        scaled[l] = (scaled[l] + scaled[s]) - 1.0
+        if scaled[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+    # Whatever's left is at 1 (modulo rounding), and
+    # has already been initialized that way.
+    return probs, aliases
+
 class DistributionSet:
     def __init__(self):
         # items contains total numbers of items.
         self.items = {}
-        self.cumFreqPairs = None
+        # These are built by Finish(): the items to choose
+        # among, and the alias table over them.
+        self.choiceItems = None
+        self.aliasProbs = None
+        self.aliasIndices = None
         self.overallFreq = 0.0
         self._finished = False
         self.totalAdded = 0
@@ -780,55 +1015,75 @@ class DistributionSet:
             # globalTotal is the total number of possible items
             # out of which these items were chosen.
             globalTotal = float(globalTotal)
-            self.cumFreqPairs = []
+            self.choiceItems = []
+            freqs = []
             self.overallFreq = 0.0
             for k, v in self.items.items():
                 localFreq = self._ItemFreq(v, globalTotal)
                 self.overallFreq += localFreq
-                self.cumFreqPairs.append((k, self.overallFreq))
+                self.choiceItems.append(k)
+                freqs.append(localFreq)
+            self.aliasProbs, self.aliasIndices = _buildAliasTable(freqs, self.overallFreq)
             self._finished = True
-            
-    def WeightedChoice(self, noneVal = ""):
+
+    def itemKeys(self):
+        return self.items.keys()
+
+    # What to return for the ith choice. Specialize if the
+    # choice isn't simply the item. The rng is there in case
+    # the specialization has to make a further choice.
+    
+    def _getChoice(self, i, rng):
+        return self.choiceItems[i]
+
+    # The rng can be anything with a random() method (and choice(),
+    # for the length distributions): the random module, which is the
+    # default, or a KeyedRandom (see below).
+    
+    def WeightedChoice(self, noneVal = "", rng = random):
         # If it hasn't been finished, finish it. This is
         # a bit risky.
         self.Finish()
-        # The idea is that we generate a frequency and then
-        # return a choice based on it. The idea is that all the
-        # choices are ratios against the global total, and
-        # a cumulative frequency has been assigned to each item
-        # in the list. When the frequency exceeds the random
-        # fraction generated, you've found your choice. This
-        # algorithm is taken from Ozlem's code, and is less
-        # random than it could be; a better "random" way would
-        # be to call random.shuffle() on the list of candidates
-        # and sum as we go along. But that would be unbelievably
-        # expensive. So let's just do a binary search and
-        # be done with it.
-        if len(self.cumFreqPairs) == 0:
+        # All the choices are ratios against the global total.
+        # This used to be Ozlem's algorithm: generate a number between
+        # 0 and the overall frequency, and binary search a list of
+        # cumulative frequencies for it. Now, we use the alias table.
+        # We only need one random number: the integer part picks the
+        # slot, and the fractional part decides between the slot and
+        # its alias.
+        n = len(self.aliasProbs)
+        if n == 0:
             return noneVal
-        # If I just get a random number between 0 and 1, it may
-        # be larger than the overall frequency, which is stupid.
-        # So use random.uniform() instead. Actually, I don't even
-        # need to generate the floats - I should do a random.uniform()
-        # OR random.randint() depending on what kind of distribution set
-        # it is.
-        r = random.uniform(0, self.overallFreq)
-        # This will never happen now.
-        # if r > self.overallFreq:
-        #    return noneVal
-        # Do a binary search.
-        minI = 0
-        maxI = len(self.cumFreqPairs) - 1
-        # Gotta be between the element and its predecessor.
-        while True:
-            if maxI == minI:
-                return self.cumFreqPairs[maxI][0]
-            candMax = ((maxI - minI)/2) + minI
-            if r < self.cumFreqPairs[candMax][1]:
-                maxI = candMax
-            else:
-                minI = candMax + 1
-        return noneVal
+        u = rng.random() * n
+        i = int(u)
+        # Guard against rounding.
+        if i >= n:
+            i = n - 1
+        if (u - i) >= self.aliasProbs[i]:
+            i = self.aliasIndices[i]
+        return self._getChoice(i, rng)
+
+    # Returns a list of n draws.
+
+    def WeightedChoices(self, n, noneVal = "", rng = random):
+        self.Finish()
+        numSlots = len(self.aliasProbs)
+        if numSlots == 0:
+            return [noneVal] * n
+        probs = self.aliasProbs
+        aliases = self.aliasIndices
+        getChoice = self._getChoice
+        rand = rng.random
+        res = []
+        for j in range(n):
+            u = rand() * numSlots
+            i = int(u)
+            if i >= numSlots:
+                i = numSlots - 1
+            if (u - i) >= probs[i]:
+                i = aliases[i]
+            res.append(getChoice(i, rng))
+        return res
 
 class CountDistributionSet(DistributionSet):
     def _Add(self, item):
@@ -888,20 +1143,103 @@ class LengthDistributionSet(DistributionSet):
         # The frequency is the number of items collected
         # divided by the total
         return float(len(item)) / globalTotal
-    def WeightedChoice(self, noneVal = ""):
-        v = DistributionSet.WeightedChoice(self, noneVal = None)
-        # k is a number of tokens, or None
-        if v is None:
-            return noneVal
+    def _getChoice(self, i, rng):
+        # The choice is a number of tokens. Get all the possible
+        # choices for that length, and randomly select one.
+        return rng.choice(self.items[self.choiceItems[i]])
+
+# An array distribution set is a finished, read-only distribution
+# set whose items and alias table live in flat tables (e.g., the
+# string tables and arrays of a resource snapshot) rather than
+# in a dictionary and lists. The tables only need to support
+# len() and indexing. If there's a decoder, it's applied to the
+# table entry to get the item.
+
+class ArrayDistributionSet(DistributionSet):
+    def __init__(self, itemTable, aliasProbs, aliasIndices, overallFreq, decoder = None):
+        DistributionSet.__init__(self)
+        self.itemTable = itemTable
+        self.aliasProbs = aliasProbs
+        self.aliasIndices = aliasIndices
+        self.overallFreq = overallFreq
+        self.decoder = decoder
+        self.totalAdded = len(itemTable)
+        self._finished = True
+
+    def _getChoice(self, i, rng = None):
+        if self.decoder is None:
+            return self.itemTable[i]
         else:
-            # Get all the possible choices for that length, and
-            # randomly select one.
-            return random.choice(self.items[v]) 
+            return self.decoder(self.itemTable[i])
+
+    def itemKeys(self):
+        return [self._getChoice(i) for i in range(len(self.itemTable))]
+
+# The array version of the length distribution set. The itemTable
+# contains the lengths; the members for the ith length are
+# members[starts[i]:starts[i + 1]], as space-separated strings.
+
+class ArrayLengthDistributionSet(ArrayDistributionSet):
+    def __init__(self, lengths, aliasProbs, aliasIndices, overallFreq, members, starts):
+        ArrayDistributionSet.__init__(self, lengths, aliasProbs, aliasIndices, overallFreq)
+        self.members = members
+        self.starts = starts
+
+    def _getChoice(self, i, rng):
+        start = self.starts[i]
+        return self.members[start + int(rng.random() * (self.starts[i + 1] - start))].split(" ")
 
 #
 # Utilities
 #
 
+# The modified dateutil lives in the resource directory.
+
+def _addDateutilPath(resourceDirs):
+    for p in resourceDirs:
+        dateutilPath = os.path.join(p, "python-dateutil-1.3")
+        if os.path.isdir(dateutilPath):
+            if dateutilPath not in sys.path:
+                sys.path.insert(0, dateutilPath)
+            break
+
+# The pattern of a digested date: a tuple of (type, feature, ...)
+# tuples, where the features of literals start with the literal.
+
+def _dateTokSeq(dateObj):
+    # Import here rather than earlier because we need
+    # path information which may not be available at module load
+    import dateutil.parser
+    tokSeq = []
+    for t in dateObj.pseq.ordered_toks():
+        features = t.features
+        if t.__class__ in [dateutil.parser._ptoken, dateutil.parser._ptok_literal]:
+            features = [t.literal] + features
+        tokSeq.append((t.__tname__,) + tuple(features))
+    return tuple(tokSeq)
+
+# A keyed random number generator. Ordinarily, every choice the
+# engine makes comes from the global random module, so the
+# surrogates depend on the order in which the engine sees things,
+# and they change from run to run. If the engine has a surrogate
+# key, each replacement gets its own generator instead, seeded with
+# an HMAC over the parts which identify the decision (label,
+# normalized input, document scope). The same input with the same
+# key always makes the same choices, no matter which process sees
+# it or what came before it.
+
+class KeyedRandom(random.Random):
+
+    # The C base class looks at the constructor arguments too.
+    
+    def __new__(cls, key, *parts):
+        return random.Random.__new__(cls)
+
+    def __init__(self, key, *parts):
+        import hmac, hashlib
+        msg = "\0".join([((type(p) is unicode) and p.encode("utf-8")) or str(p) for p in parts])
+        random.Random.__init__(self, long(hmac.new(key, msg, hashlib.sha256).hexdigest(), 16))
+
 #
 # Toplevel classes
 #
@@ -929,6 +1267,9 @@ class PIIPatternReplacer:
         self.engine = engine
         self.catClass = cat_class
         self.label = label
+        # If the cache scope is persistent, this is the SurrogateStore
+        # which backs the caches.
+        self.persistentStore = None
         self.useCache(use_cache)
         self.cacheIsCaseSensitive = cache_is_case_sensitive
         self.useSeedCache(use_seed_cache)
@@ -941,19 +1282,61 @@ class PIIPatternReplacer:
         self.flushAtDocBoundary = flush_cache_at_doc_boundary
         self.patternDist = None
 
+    # The random number generator for the pattern. If the engine
+    # has a surrogate key, the choices depend on the label, the
+    # normalized input, and (if the cache is flushed at document
+    # boundaries, so the same input may legitimately map to different
+    # things in different documents) the document scope.
+
+    def getRandom(self, pattern):
+        if pattern.input is None:
+            input = ""
+        else:
+            input = " ".join(pattern.input.split())
+            if not self.cacheIsCaseSensitive:
+                input = input.lower()
+        if self.flushAtDocBoundary:
+            return self.engine.getRandom(self.label, self.engine.documentScope, input)
+        else:
+            return self.engine.getRandom(self.label, "", input)
+
+    # The random number generator for the replacement seed, and for
+    # whatever the rendering strategy fills into the seed later. The
+    # seed is shared by variants (e.g., "John Smith" and "Smith" in
+    # the same document), so its choices can't depend on which variant
+    # happens to reach the seed cache first. With a surrogate key, they
+    # depend on the label, the scope and the canonical storage key:
+    # the smallest of the longest keys the seed is stored under.
+    # Without seed cache keys, the seed belongs to this input alone.
+
+    def getSeedRandom(self, pattern):
+        keys = [((type(k) is tuple) and k) or (k,) for k in pattern.getReplacementCacheKeysForStorage()]
+        if not keys:
+            return pattern.rng
+        maxLen = max([len(k) for k in keys])
+        key = min([k for k in keys if len(k) == maxLen])
+        if self.flushAtDocBoundary:
+            return self.engine.getRandom(self.label, self.engine.documentScope, "seed", *key)
+        else:
+            return self.engine.getRandom(self.label, "", "seed", *key)
+
     def useCache(self, useIt):
         self._useCache = useIt and self.engine.digestionStrategy.canCache(self.catClass.__ctype__)
-        if self._useCache:
-            self.cache = {}
-        else:
+        if not self._useCache:
             self.cache = None
+        elif self.persistentStore is not None:
+            self.cache = self.persistentStore.getMapping(self.label, "cache")
+        else:
+            self.cache = {}
 
     def useSeedCache(self, useIt):
         self._useSeedCache = useIt and self.engine.digestionStrategy.canCache(self.catClass.__ctype__)
-        if self._useSeedCache:
-            self.seedCache = {}
-        else:
+        if not self._useSeedCache:
             self.seedCache = None
+        elif self.persistentStore is not None:
+            self.seedCache = self.persistentStore.getMapping(self.label, "seed")
+        else:
+            self.seedCache = {}
 
     # Maybe use the seed cache, maybe not.
 
@@ -972,13 +1355,18 @@ class PIIPatternReplacer:
     # with the same seed. Check the clear replacement strategy for more details.
 
     def getReplacementSeed(self, pattern, meth):
+        pattern.seedRng = self.getSeedRandom(pattern)
         if not self._useSeedCache:
             return meth()
         keys = pattern.getReplacementCacheKeys()
         for k in keys:
             if self.seedCache.has_key(k):
+                if self.engine.profile is not None:
+                    self.engine.profile.recordCacheLookup(self.label, "seed", True)
                 return self.seedCache[k]
         # Didn't find any entries (or there aren't any keys)
+        if self.engine.profile is not None:
+            self.engine.profile.recordCacheLookup(self.label, "seed", False)
         seed = meth()
         for k in pattern.getReplacementCacheKeysForStorage():
             self.seedCache[k] = seed
@@ -987,19 +1375,85 @@ class PIIPatternReplacer:
     def Digest(self, seed):
         # By default, we just build an instance of the class we hold.
         res = self.catClass(self, seed = seed)
-        self.engine.digestionStrategy.Digest(res, seed)
+        if self.canSkipDigestion(res):
+            return res
+        if self.engine.profile is None:
+            self.engine.digestionStrategy.Digest(res, seed)
+        else:
+            t = self.engine.profile.start()
+            self.engine.digestionStrategy.Digest(res, seed)
+            self.engine.profile.record("DigestionStrategy", self.label, t)
+        if self.engine.collectCorpusStatistics:
+            self.mergeCorpusStatistics(self.getCorpusStatistics(res))
+        return res
+
+    # Same as Digest(), for a list of seeds; returns a list of
+    # patterns. The digestion strategy gets them all at once (see
+    # DigestionStrategy.DigestMany()). When the engine is profiled,
+    # each seed is digested separately, so the latencies are per seed.
+
+    def DigestMany(self, seeds):
+        if self.engine.profile is not None:
+            return [self.Digest(seed) for seed in seeds]
+        res = []
+        toDigest = []
+        toDigestSeeds = []
+        for seed in seeds:
+            pat = self.catClass(self, seed = seed)
+            res.append(pat)
+            if not self.canSkipDigestion(pat):
+                toDigest.append(pat)
+                toDigestSeeds.append(seed)
+        self.engine.digestionStrategy.DigestMany(toDigest, toDigestSeeds)
+        if self.engine.collectCorpusStatistics:
+            for pat in toDigest:
+                self.mergeCorpusStatistics(self.getCorpusStatistics(pat))
+        return res
+
+    # If the persistent cache already has a replacement for the seed,
+    # Replace() will never look at the digestion, so don't bother.
+    # This probe isn't counted as a cache lookup in the profile;
+    # Replace() counts the real one.
+    # The cache can't change between digestion and replacement, since
+    # it's never flushed. Patterns which contribute to the corpus
+    # statistics still have to be digested.
+
+    def canSkipDigestion(self, pattern):
+        return self._useCache and (self.persistentStore is not None) and \
+               (self.patternSource is PS_SELF) and (pattern.input is not None) and \
+               (self._cacheReplace(pattern) is not None)
+
+    # What a digested pattern contributes to the corpus-level statistics.
+    # These are separate from Digest() so that the statistics can be
+    # collected somewhere else (e.g., in a worker process; see the nominate
+    # step) and merged here. If they're merged in document order, the
+    # result is the same as if the digestion had happened here.
+    # getCorpusStatistics() must return something picklable, or None.
+
+    def getCorpusStatistics(self, pattern):
         if self.patternSource is PS_CORP_DIST:
+            return pattern.toPatternSequence()
+        else:
+            return None
+
+    def mergeCorpusStatistics(self, stats):
+        if stats is not None:
             if self.patternDist is None:
                 self.patternDist = self.getPatternDist()
-            pat = res.toPatternSequence()
-            self.patternDist.Add(pat)
-        return res
+            self.patternDist.Add(stats)
 
     # Implement if PS_CORP_DIST is your type.
     
     def getPatternDist(self):        
         raise PIIPatternReplacerError, "unimplemented"
 
+    # Discard the corpus statistics, so that the next batch is
+    # digested from scratch. The external distributions stay.
+
+    def resetCorpusStatistics(self):
+        if self.patternSource is PS_CORP_DIST:
+            self.patternDist = None
+
     def EndDocumentForReplacement(self):
         # Don't flush the digest index; it needs to
         # store the whole corpus, potentially, so we don't
@@ -1045,7 +1499,10 @@ class PIIPatternReplacer:
         cacheUsed = False
         if self._useCache and pattern.input is not None:
             res = self._cacheReplace(pattern)
+            if self.engine.profile is not None:
+                self.engine.profile.recordCacheLookup(self.label, "cache", res is not None)
         if res is None:
+            pattern.rng = self.getRandom(pattern)
             res = self._coreReplace(pattern, **kw)
             if self._useCache and pattern.input is not None:
                 self._cacheAdd(pattern, res)
@@ -1082,10 +1539,17 @@ class PIIPatternReplacer:
         # use it directly for replacement, or do you generate one
         # from the corpus? 
         if self.patternSource in [PS_EXT_DIST, PS_CORP_DIST]:
-            pat = self.patternDist.WeightedChoice(noneVal = None)
+            pat = self.patternDist.WeightedChoice(noneVal = None, rng = pattern.rng)
+            rng = pattern.rng
             pattern = pattern.__class__(pattern.replacer, pattern.input).fromPatternSequence(pat)
+            pattern.rng = rng
         pattern.finish(overrideDict = freqOverrides)
-        return self.engine.renderingStrategy.Replace(pattern, **kw)
+        if self.engine.profile is None:
+            return self.engine.renderingStrategy.Replace(pattern, **kw)
+        t = self.engine.profile.start()
+        res = self.engine.renderingStrategy.Replace(pattern, **kw)
+        self.engine.profile.record("RenderingStrategy", self.label, t)
+        return res
 
     def _addReplacementNewline(self, pattern, repl):
         # Sometimes the seed has a newline in it, and it would be ideal
@@ -1190,6 +1654,12 @@ class PIIPattern:
         # newline comparison.
         self.input = seed
         self.freqDict = {}
+        # Where the random choices come from. The replacer
+        # resets this before replacement.
+        self.rng = random
+        # Where the choices for the replacement seed come from (see
+        # PIIPatternReplacer.getSeedRandom()).
+        self.seedRng = random
         if self.__pattern_desc__ is not None:
             self._digestPatternDesc(self.__pattern_desc__)
         self._keyOrder = None
@@ -1273,7 +1743,7 @@ class PIIPattern:
                 continue
             if factor == 0:
                 setattr(self, k, False)
-            elif random.random() < ( d[k] / factor ):
+            elif self.rng.random() < ( d[k] / factor ):
                 setattr(self, k, True)
             else:
                 setattr(self, k, False)
@@ -1318,8 +1788,10 @@ class PIIPattern:
     def setReplacementCacheKeys(self, keys):
         self.replacementCacheKeys = keys
         # Better make sure it's using the cache -
-        # otherwise, what's the point of cacheing?
-        self.replacer.useSeedCache(True)
+        # otherwise, what's the point of cacheing? But don't
+        # start a new one if it already is.
+        if not self.replacer._useSeedCache:
+            self.replacer.useSeedCache(True)
 
     @classmethod
     def newReplacer(cls, engine, label, **kw):
@@ -1463,18 +1935,18 @@ class PIIIDPattern(PIIPattern):
         if self.prefix is None:
             self.prefix = self.defaultPrefix
     
-def _IDReplace(seed):
+def _IDReplace(seed, rng = random):
     import string
     # If we do have a seed, replace each uppercase character
     # with another one, same for lowercase and digits.
     chars = []
     for c in seed:
         if c in string.uppercase:
-            chars.append(random.choice(string.uppercase))
+            chars.append(rng.choice(string.uppercase))
         elif c in string.lowercase:
-            chars.append(random.choice(string.lowercase))
+            chars.append(rng.choice(string.lowercase))
         elif c in string.digits:
-            chars.append(random.choice(string.digits))
+            chars.append(rng.choice(string.digits))
         else:
             chars.append(c)
     return "".join(chars)
@@ -1535,11 +2007,11 @@ class PIIAgePattern(PIIPattern):
         if self.postS is None:
             self.postS = ""
         if self.ageLb is None and self.ageUb is None:
-            self.ageLb = self.ageUb = random.randint(1, 120)
+            self.ageLb = self.ageUb = self.rng.randint(1, 120)
         elif self.ageLb is None:
-            self.ageLb = random.randint(1, 120)
+            self.ageLb = self.rng.randint(1, 120)
         elif self.ageUb is None:
-            self.ageUb = random.randint(1, 120)
+            self.ageUb = self.rng.randint(1, 120)
             
 
 # Date replacer.
@@ -1568,6 +2040,18 @@ class PIIDateReplacer(PIIPatternReplacer):
         self.docDates.append(res)
         return res
 
+    def DigestMany(self, seeds):
+        if self.engine.profile is not None:
+            return [self.Digest(seed) for seed in seeds]
+        res = PIIPatternReplacer.DigestMany(self, seeds)
+        self.docDates += res
+        return res
+
+    # Every date in the document contributes to the date shift.
+
+    def canSkipDigestion(self, pattern):
+        return False
+
     def EndDocumentForDigestion(self):
         replacers = [(k, v) for k, v in self.engine._replacers.items() if isinstance(v, PIIDateReplacer)]
         replacers.sort(key = lambda x: x[0])
@@ -1601,15 +2085,22 @@ class PIIDateReplacer(PIIPatternReplacer):
                             endDelta = edelta.days
                     except TypeError:
                         pass
+                # The shift is keyed on the document's dates, so it's
+                # stable if there's a surrogate key.
+                rng = self.engine.getRandom(self.label + ":delta", self.engine.documentScope,
+                                            "\0".join(sorted([" ".join((d.input or "").split()) for d in docDates])))
                 # OK, now we have deltas on each end. If the end delta 
-                # has reasonable room, shift after.
-                if endDelta > 15:
-                    deltaDays = random.randint(5, endDelta)
+                # has reasonable room, shift after. Unless someone's
+                # already decided (see the nominate step).
+                if self.engine.forcedDateDelta is not None:
+                    deltaDays = self.engine.forcedDateDelta
+                elif endDelta > 15:
+                    deltaDays = rng.randint(5, endDelta)
                 elif startDelta > 15:
-                    deltaDays = - random.randint(5, startDelta)
+                    deltaDays = - rng.randint(5, startDelta)
                 else:
                     # Just pick something.
-                    deltaDays = random.randint(5, 45)
+                    deltaDays = rng.randint(5, 45)
                 for d in docDates:
                     if d.dateObj:
                         # Only assign a delta to the things that have dateObjs.
@@ -1630,16 +2121,8 @@ class PIIDatePattern(PIIPattern):
     __ctype__ = "DATE"
     
     def _fillPattern(self, dateObj):
-        # Import here rather than earlier because we need
-        # path information which may not be available at module load
-        import dateutil.parser
         # The pattern is derived from the sequence.
-        self.tok_seq = []
-        for t in dateObj.pseq.ordered_toks():
-            features = t.features
-            if t.__class__ in [dateutil.parser._ptoken, dateutil.parser._ptok_literal]:
-                features = [t.literal] + features
-            self.tok_seq.append((t.__tname__,) + tuple(features))
+        self.tok_seq = list(_dateTokSeq(dateObj))
 
     def finish(self, overrideDict = None):
         PIIPattern.finish(self, overrideDict)
@@ -1651,8 +2134,7 @@ class PIIDatePattern(PIIPattern):
         # If the pattern has no token sequence, grab a seed.
         if self.tok_seq is None:
             dateDist = self.repository.loadDatePatterns()
-            d = dateDist.WeightedChoice(None)
-            self._fillPattern(d)
+            self.tok_seq = list(dateDist.WeightedChoice(None, rng = self.rng))
 
 # Location replacer.
 
@@ -1667,33 +2149,38 @@ class PIILocationReplacer(PIIPatternReplacer):
         PIIPatternReplacer.__init__(self, engine, cat_class, label, **kw)
         self.postfixHash = None
         self.streetNumSeeds = []
+
+    # The street numbers the digestion finds are corpus statistics too.
+
+    def getCorpusStatistics(self, pattern):
+        parse = getattr(pattern, "parse", None)
+        streetNum = (parse and parse.get("streetNum")) or None
+        patStats = PIIPatternReplacer.getCorpusStatistics(self, pattern)
+        if (patStats is None) and (streetNum is None):
+            return None
+        return (patStats, streetNum)
+
+    def mergeCorpusStatistics(self, stats):
+        if stats is not None:
+            patStats, streetNum = stats
+            PIIPatternReplacer.mergeCorpusStatistics(self, patStats)
+            if streetNum is not None:
+                self.streetNumSeeds.append(streetNum)
+
+    def resetCorpusStatistics(self):
+        PIIPatternReplacer.resetCorpusStatistics(self)
+        self.streetNumSeeds = []
     
-    # Give the address pattern dist to the repository too.
+    # The address pattern dist belongs to the replacer, not the
+    # repository, since the repository may be shared.
 
     def getPatternDist(self):
-        dist = CountDistributionSet()
-        self.repository.addressPatternDist = dist
-        return dist
+        return CountDistributionSet()
 
     def getPostfixHash(self):
         if self.postfixHash is None:
-            self.postfixHash = {}
-            postfixes = self.repository.loadStreetPostfixes()
-            for postfix in postfixes:
-                fullName = postfix[0]
-                abbrs = postfix[1:]
-                # Get the full range: period/no period for abbr,
-                # comma/no comma for all.
-                fullName = fullName.lower()
-                self.postfixHash[fullName] = postfix
-                self.postfixHash[fullName + ","] = postfix
-                for abbr in abbrs:
-                    abbr = abbr.lower()                    
-                    self.postfixHash[abbr] = postfix
-                    self.postfixHash[abbr + "."] = postfix
-                    self.postfixHash[abbr + ","] = postfix
-                    self.postfixHash[abbr + ".,"] = postfix
-        return self.postfixHash                    
+            self.postfixHash = self.repository.getStreetPostfixHash()
+        return self.postfixHash
 
 # Locations. There's nothing special in AMIA.
 
@@ -1770,7 +2257,7 @@ class PIILocationPattern(PIIPattern):
         PIIPattern.finish(self, overrideDict)
         if self.street_num_seed is None and \
            self.replacer.streetNumSeeds:
-            self.street_num_seed = random.choice(self.replacer.streetNumSeeds)
+            self.street_num_seed = self.rng.choice(self.replacer.streetNumSeeds)
 
     STATE_KEY_ORDER = [None, 'longabbr', 'longabbrnodot', 'shortabbr']
 
@@ -1825,9 +2312,9 @@ class PIIPersonReplacer(PIIPatternReplacer):
         self.midNameDist = FloatDistributionSet().fromFrequencyPairs((0, .8), (1, .15), (2, .05))
         self.isMidInitDist = FloatDistributionSet().fromFrequencyPairs((True, .7), (False, .3))
 
-    def _Capitalize(self, ntoks):
+    def _Capitalize(self, ntoks, rng = random):
         nameResource = self.repository.loadNames()
-        return " ".join([(random.choice(nameResource.capitalizationHash.get(p, [False])) or \
+        return " ".join([(rng.choice(nameResource.capitalizationHash.get(p, [False])) or \
                           PIIPatternReplacer._Capitalize(self, p))
                          for p in ntoks])
 
@@ -1858,13 +2345,13 @@ class PIIPersonPattern(PIIPattern):
         PIIPattern.finish(self, overrideDict)
         # Check cap_status, mid_initials, name_ext, gender.
         if self.cap_status is None:
-            self.cap_status = self.replacer.capDist.WeightedChoice(noneVal = MIXED)
+            self.cap_status = self.replacer.capDist.WeightedChoice(noneVal = MIXED, rng = self.rng)
         if self.name_ext is None:
             # Don't worry about it right now.
             self.name_ext = ""
         if self.mid_initials is None:
-            numNames = self.replacer.midNameDist.WeightedChoice(noneVal = 0)
-            isInit = self.replacer.isMidInitDist.WeightedChoice(noneVal = True)
+            numNames = self.replacer.midNameDist.WeightedChoice(noneVal = 0, rng = self.rng)
+            isInit = self.replacer.isMidInitDist.WeightedChoice(noneVal = True, rng = self.rng)
             self.mid_initials = numNames * [isInit]
         if self.gender is None:
             # I'm pretty sure that if I don't get a gender, I'd better
@@ -1913,6 +2400,22 @@ class DigestionStrategy(object):
         if hasattr(self, mName):
             getattr(self, mName)(pat, seed)
 
+    # Digest a list of patterns of the same type (i.e., from the same
+    # replacer), so the method is looked up once rather than once
+    # per pattern. If a strategy overrides Digest(), we use that.
+
+    def DigestMany(self, pats, seeds):
+        if not pats:
+            return
+        if self.__class__.Digest.im_func is not DigestionStrategy.Digest.im_func:
+            for pat, seed in zip(pats, seeds):
+                self.Digest(pat, seed)
+            return
+        meth = getattr(self, pats[0].__ctype__ + "Digest", None)
+        if meth is not None:
+            for pat, seed in zip(pats, seeds):
+                meth(pat, seed)
+
     # The digestion strategy is responsible for finding those
     # things that have already been marked up. This is used
     # when we take raw output of a digestion process and
@@ -1939,7 +2442,7 @@ class RenderingStrategy(object):
 
 # Main engine.
 
-DOC_CACHE_SCOPE, BATCH_CACHE_SCOPE, NO_CACHE_SCOPE = range(3)
+DOC_CACHE_SCOPE, BATCH_CACHE_SCOPE, NO_CACHE_SCOPE, PERSISTENT_CACHE_SCOPE = range(4)
 
 class PIIReplacementEngine:
 
@@ -1965,10 +2468,47 @@ class PIIReplacementEngine:
     def __init__(self, resource_dirs, categories,
                  cache_scope = None, cache_case_insensitivity = None,
                  resource_file_repl = None, replacement_map_file = None,
-                 replacement_map = None, **cmdlineKw):
+                 replacement_map = None, resource_snapshot = None,
+                 verify_resource_snapshot = None,
+                 surrogate_key = None, surrogate_key_file = None,
+                 persistent_cache_file = None, profile_replacement = None,
+                 repository = None, **cmdlineKw):
         self.categories = categories
         self.resourceDirs = resource_dirs
 
+        # If there's a surrogate key, the replacement choices are
+        # derived from it (see KeyedRandom), so the output is reproducible
+        # and doesn't depend on how the documents are batched. The
+        # key file is better, since the key won't show up in
+        # process listings.
+
+        if surrogate_key_file and not surrogate_key:
+            fp = open(surrogate_key_file, "r")
+            surrogate_key = fp.read().strip()
+            fp.close()
+        if type(surrogate_key) is unicode:
+            surrogate_key = surrogate_key.encode("utf-8")
+        self.surrogateKey = surrogate_key or None
+        # The document scope is set by the caller at each document
+        # boundary.
+        self.documentScope = ""
+        # If the digestion is being redone, the statistics have already
+        # been collected, and the date shift has already been chosen.
+        self.collectCorpusStatistics = True
+        self.forcedDateDelta = None
+        # The persistent cache file is opened only if some label
+        # has the persistent cache scope.
+        self.persistentCacheFile = persistent_cache_file
+        self.persistentStore = None
+        self._storeLock = threading.Lock()
+        # See enableProfiling().
+        self.profile = None
+        # Without a surrogate key, the random choices come from here.
+        # Contexts have their own (see newContext()).
+        self.rng = random
+        # The cache settings, in order, so contexts can repeat them.
+        self._cacheSettings = []
+
         if type(replacement_map) is not type({}):
             if replacement_map_file:
                 if not replacement_map:
@@ -1997,15 +2537,31 @@ class PIIReplacementEngine:
                     raise Error.MATError("nominate", "bad resource_file_repl pair '%s'" % pair)
                 resourceReplacements[toks[0]] = toks[1]
         
-        self.repository = Repository(resource_dirs, resourceReplacements)
+        # resource_snapshot is the path of a precompiled resource
+        # snapshot (see ResourceSnapshot.py). By default, we look for
+        # one in the resource dirs; "none" disables snapshots. The
+        # snapshot is used if the resource files have the size and
+        # modification time it recorded; if verify_resource_snapshot
+        # is set, their CRCs must match too.
+        # repository isn't a command line argument; it's for
+        # callers which share one Repository among several engines
+        # (see Deidentification.DeidTaskDescriptor.instantiateReplacer()).
+        # It must have been built from the same resource dirs.
+
+        if repository is not None:
+            self.repository = repository
+        elif resource_snapshot == "none":
+            self.repository = Repository(resource_dirs, resourceReplacements, findSnapshot = False)
+        else:
+            self.repository = Repository(resource_dirs, resourceReplacements,
+                                         snapshotPath = resource_snapshot,
+                                         verifySnapshot = bool(verify_resource_snapshot))
+        if profile_replacement:
+            self.enableProfiling()
         self.digestionStrategy = self.createDigestionStrategy()
         self.renderingStrategy = self.createRenderingStrategy()
         # Use the date stuff.
-        for p in resource_dirs:
-            dateutilPath = os.path.join(p, "python-dateutil-1.3")
-            if os.path.isdir(dateutilPath):
-                sys.path.insert(0, dateutilPath)
-                break
+        _addDateutilPath(resource_dirs)
         self._replacers = {}
 
         # The cache_scope argument suggests scopes for the various
@@ -2014,26 +2570,104 @@ class PIIReplacementEngine:
         # The cache_case_insensitivity argument is just label;label...
 
         if cache_scope:
-            pairs = cache_scope.split(";")
-            for pair in pairs:
-                toks = pair.split(",", 1)
-                if len(toks) != 2:
-                    raise Error.MATError("nominate", "bad cache scope pair '%s'" % pair)
-                if toks[1] == "doc":
-                    scope = DOC_CACHE_SCOPE
-                elif toks[1] == "batch":
-                    scope = BATCH_CACHE_SCOPE
-                elif toks[1] == "none":
-                    scope = NO_CACHE_SCOPE
-                else:
-                    raise Error.MATError("nominate", "bad cache scope '%s'" % toks[1])
-                self.setCacheScope(toks[0], scope)
+            for label, scope in self._parseCacheScope(cache_scope):
+                self.setCacheScope(label, scope)
 
         if cache_case_insensitivity:
             labels = cache_case_insensitivity.split(";")
             for label in labels:
                 self.setCacheCaseInsensitive(label)
 
+    def _parseCacheScope(self, cache_scope):
+        res = []
+        pairs = cache_scope.split(";")
+        for pair in pairs:
+            toks = pair.split(",", 1)
+            if len(toks) != 2:
+                raise Error.MATError("nominate", "bad cache scope pair '%s'" % pair)
+            if toks[1] == "doc":
+                scope = DOC_CACHE_SCOPE
+            elif toks[1] == "batch":
+                scope = BATCH_CACHE_SCOPE
+            elif toks[1] == "none":
+                scope = NO_CACHE_SCOPE
+            elif toks[1] == "persistent":
+                scope = PERSISTENT_CACHE_SCOPE
+            else:
+                raise Error.MATError("nominate", "bad cache scope '%s'" % toks[1])
+            res.append((toks[0], scope))
+        return res
+
+    def setDocumentScope(self, scope):
+        self.documentScope = scope or ""
+
+    # Contexts. An engine is not thread-safe: the replacers (and their
+    # caches), the strategies (e.g., the DE-ID name counters), the
+    # document scope, the date shift and the random number generator
+    # all change as documents are converted. A context is an engine which
+    # has its own copy of all of these, but shares everything that
+    # doesn't change once it's loaded (the repository, the replacement
+    # map, the settings, the persistent store) with the engine it was
+    # created from. So any number of threads can convert documents at
+    # once, each in a context of its own, with the resources loaded
+    # only once. Contexts are cheap; typically, there's one per call.
+    # The context has the same cache settings as the engine, unless
+    # cache_scope is provided, in which case it replaces the engine's
+    # cache scopes.
+
+    def newContext(self, cache_scope = None):
+        self.repository.preloadAll()
+        settings = self._cacheSettings
+        if cache_scope is not None:
+            settings = [s for s in settings if s[0] != "scope"] + \
+                       [("scope", label, scope) for label, scope in self._parseCacheScope(cache_scope)]
+        if [s for s in settings if s[0] == "scope" and s[2] == PERSISTENT_CACHE_SCOPE]:
+            # Open it here, so the contexts share it.
+            self.getPersistentStore()
+        ctx = copy.copy(self)
+        ctx._replacers = {}
+        ctx._cacheSettings = []
+        ctx.documentScope = ""
+        ctx.collectCorpusStatistics = True
+        ctx.forcedDateDelta = None
+        if ctx.__dict__.has_key("dateDelta"):
+            del ctx.dateDelta
+        ctx.profile = None
+        ctx.rng = random.Random()
+        ctx.digestionStrategy = ctx.createDigestionStrategy()
+        ctx.renderingStrategy = ctx.createRenderingStrategy()
+        for s in settings:
+            if s[0] == "scope":
+                ctx.setCacheScope(s[1], s[2])
+            else:
+                ctx.setCacheCaseInsensitive(s[1])
+        return ctx
+
+    # Profiling (see ReplacementProfile.py). enableProfiling() starts
+    # a new profile, discarding the old one, if any; getProfileReport()
+    # returns the report for the current one, or None.
+
+    def enableProfiling(self):
+        import ReplacementProfile
+        self.profile = ReplacementProfile.ReplacementProfile()
+        ReplacementProfile.instrumentRepository(self.repository)
+
+    def disableProfiling(self):
+        self.profile = None
+
+    def getProfileReport(self):
+        if self.profile is None:
+            return None
+        return self.profile.report()
+
+    # Returns something which behaves like the random module.
+
+    def getRandom(self, *parts):
+        if self.surrogateKey is None:
+            return self.rng
+        else:
+            return KeyedRandom(self.surrogateKey, *parts)
+
     def getReplacer(self, label):
         try:
             return self._replacers[label]
@@ -2043,6 +2677,7 @@ class PIIReplacementEngine:
             return r
 
     def setCacheScope(self, label, scope):
+        self._cacheSettings.append(("scope", label, scope))
         # Depends on whether the replacer is already
         # created or not. Let's invent it if it
         # isn't.
@@ -2053,8 +2688,27 @@ class PIIReplacementEngine:
             replacer.useCache(True)
             if scope == BATCH_CACHE_SCOPE:
                 replacer.flushAtDocBoundary = False
+        elif scope == PERSISTENT_CACHE_SCOPE:
+            replacer.persistentStore = self.getPersistentStore()
+            replacer.flushAtDocBoundary = False
+            replacer.useCache(True)
+            if replacer._useSeedCache:
+                replacer.useSeedCache(True)
+
+    def getPersistentStore(self):
+        self._storeLock.acquire()
+        try:
+            if self.persistentStore is None:
+                if not self.persistentCacheFile:
+                    raise PIIPatternReplacerError, "persistent cache scope requires a persistent cache file"
+                import SurrogateStore
+                self.persistentStore = SurrogateStore.SurrogateStore(self.persistentCacheFile)
+            return self.persistentStore
+        finally:
+            self._storeLock.release()
 
     def setCacheCaseInsensitive(self, label):
+        self._cacheSettings.append(("case", label))
         replacer = self.getReplacer(label)
         replacer.cacheIsCaseSensitive = False
 
@@ -2068,7 +2722,40 @@ class PIIReplacementEngine:
             raise PIIPatternReplacerError, "label unknown"
 
     def Digest(self, label, seed):
-        return self.getReplacer(label).Digest(seed)
+        if self.profile is None:
+            return self.getReplacer(label).Digest(seed)
+        return self.profile.run("Digest", label, self.getReplacer(label).Digest, seed)
+
+    # Digest all the seeds for a label in a document at once. The
+    # result is a list of patterns, in the order of the seeds, and
+    # it's the same as calling Digest() on each, in order.
+
+    def DigestMany(self, label, seeds):
+        if self.profile is None:
+            return self.getReplacer(label).DigestMany(seeds)
+        return [self.Digest(label, seed) for seed in seeds]
+
+    # Digest a document's spans, as (label, seed) pairs, a label at a
+    # time; returns a list of patterns, in the order of the spans.
+    # Digestion doesn't depend on the order of the spans of different
+    # labels, only on the order of the spans of each label.
+
+    def DigestDocument(self, spans):
+        res = [None] * len(spans)
+        byLabel = {}
+        labels = []
+        for i in range(len(spans)):
+            label = spans[i][0]
+            try:
+                byLabel[label].append(i)
+            except KeyError:
+                byLabel[label] = [i]
+                labels.append(label)
+        for label in labels:
+            indices = byLabel[label]
+            for i, pat in zip(indices, self.DigestMany(label, [spans[i][1] for i in indices])):
+                res[i] = pat
+        return res
 
     def EndDocumentForDigestion(self):
         for v in self._replacers.values():
@@ -2078,12 +2765,25 @@ class PIIReplacementEngine:
         for v in self._replacers.values():
             v.EndDigestion()
 
+    def resetCorpusStatistics(self):
+        for v in self._replacers.values():
+            v.resetCorpusStatistics()
+
     def EndDocumentForReplacement(self):
         for v in self._replacers.values():
             v.EndDocumentForReplacement()
 
+    # Called at the end of the batch. Anything the persistent
+    # caches haven't written yet gets written now.
+    
+    def EndReplacement(self):
+        if self.persistentStore is not None:
+            self.persistentStore.flush()
+
     def Replace(self, label, pattern, **kw):
-        return self.getReplacer(label).Replace(pattern, **kw)
+        if self.profile is None:
+            return self.getReplacer(label).Replace(pattern, **kw)
+        return self.profile.run("Replace", label, self.getReplacer(label).Replace, pattern, **kw)
 
     def FindReplacedElements(self, s):
         # This method does the inverse, in the cases
@@ -2103,12 +2803,29 @@ class PIIReplacementEngine:
     # preservationTuples are label, start, end
     
     def Transform(self, signal, prologue, replacementTuples, preservationTuples):
+        output, finalTuples, offsetMap = self.TransformWithOffsetMap(signal, prologue, replacementTuples,
+                                                                     preservationTuples)
+        return output, finalTuples
+
+    # Same as Transform, but also returns an OffsetMap between the
+    # original signal and the output. Transform() isn't labeled, so
+    # the profile records it under "*".
+    
+    def TransformWithOffsetMap(self, signal, prologue, replacementTuples, preservationTuples):
+        if self.profile is None:
+            return self._transformWithOffsetMap(signal, prologue, replacementTuples, preservationTuples)
+        return self.profile.run("Transform", "*", self._transformWithOffsetMap,
+                                signal, prologue, replacementTuples, preservationTuples)
+
+    def _transformWithOffsetMap(self, signal, prologue, replacementTuples, preservationTuples):
+        offsetMap = OffsetMap()
         stringList = []
         finalIndex = None
         curStartIndex = 0
         if prologue is not None:
             stringList.append(prologue)
             curStartIndex += len(prologue)
+            offsetMap.prologueLength = len(prologue)
         replacementTuples = replacementTuples or []
         preservationTuples = preservationTuples or []
         tuples = replacementTuples + [p + (None,) for p in preservationTuples]
@@ -2125,17 +2842,90 @@ class PIIReplacementEngine:
 
             if replacement is None:
                 replacement = signal[start:end]
+            else:
+                offsetMap._addSpan(start, end, curStartIndex, curStartIndex + len(replacement))
             stringList.append(replacement)
             endIndex = curStartIndex + len(replacement)
             finalTuples.append((lab, curStartIndex, endIndex))
             finalIndex = end
             curStartIndex = endIndex
         if finalIndex is None:
+            # Nothing to do; the prologue isn't added, either.
             output = signal
+            offsetMap.prologueLength = 0
         else:
             stringList.append(signal[finalIndex:])
             output = "".join(stringList)
-        return output, finalTuples
+        return output, finalTuples, offsetMap
+
+# The offset map between a signal and its transformed version. Outside
+# the replaced spans, the map is a shift: the transformed offset is the
+# original offset plus the prologue length plus the change in length of
+# all the preceding replacements. So all we store is the replaced spans,
+# as four sorted arrays, and lookups in either direction are a bisection.
+# An offset strictly inside a replaced span maps to the start of the
+# corresponding span, or the end, if it's the end of something
+# (so an annotation inside a replaced span maps to the whole replacement).
+# The prologue maps to the beginning of the original signal.
+
+# toJSON() produces something which can be stored in document metadata.
+
+class OffsetMap:
+
+    def __init__(self):
+        self.prologueLength = 0
+        self.srcStarts = array.array("l")
+        self.srcEnds = array.array("l")
+        self.tgtStarts = array.array("l")
+        self.tgtEnds = array.array("l")
+
+    # Spans must be added in order.
+    
+    def _addSpan(self, srcStart, srcEnd, tgtStart, tgtEnd):
+        self.srcStarts.append(srcStart)
+        self.srcEnds.append(srcEnd)
+        self.tgtStarts.append(tgtStart)
+        self.tgtEnds.append(tgtEnd)
+
+    def _map(self, pos, fromStarts, fromEnds, toStarts, toEnds, before, isEnd):
+        i = bisect.bisect_right(fromStarts, pos) - 1
+        if i < 0:
+            return before(pos)
+        elif pos == fromStarts[i]:
+            return toStarts[i]
+        elif pos < fromEnds[i]:
+            if isEnd:
+                return toEnds[i]
+            else:
+                return toStarts[i]
+        else:
+            return toEnds[i] + (pos - fromEnds[i])
+
+    def toTarget(self, pos, isEnd = False):
+        return self._map(pos, self.srcStarts, self.srcEnds, self.tgtStarts, self.tgtEnds,
+                         lambda p: p + self.prologueLength, isEnd)
+
+    def toSource(self, pos, isEnd = False):
+        return self._map(pos, self.tgtStarts, self.tgtEnds, self.srcStarts, self.srcEnds,
+                         lambda p: max(0, p - self.prologueLength), isEnd)
+
+    def spanToTarget(self, start, end):
+        return self.toTarget(start), self.toTarget(end, isEnd = True)
+
+    def spanToSource(self, start, end):
+        return self.toSource(start), self.toSource(end, isEnd = True)
+
+    def toJSON(self):
+        return {"prologue_length": self.prologueLength,
+                "spans": [list(t) for t in zip(self.srcStarts, self.srcEnds, self.tgtStarts, self.tgtEnds)]}
+
+    @classmethod
+    def fromJSON(cls, d):
+        m = cls()
+        m.prologueLength = d["prologue_length"]
+        for srcStart, srcEnd, tgtStart, tgtEnd in d["spans"]:
+            m._addSpan(srcStart, srcEnd, tgtStart, tgtEnd)
+        return m
 
 # The classes below are implemented separately, to support standalone engines,
 # including the ability to call these engines from Java via Jython.
@@ -2151,6 +2941,15 @@ class StandaloneReplacementEngineEvent:
         self.preservationTuples = []
         self.signal = signal
         self.prologue = prologue
+        self.documentScope = ""
+
+    # The document scope for the replacement choices (see
+    # PIIReplacementEngine.setDocumentScope()). It's set for each event
+    # as it's converted, whether it's converted alone or in a batch, so
+    # an event gets the same replacements either way.
+
+    def setDocumentScope(self, scope):
+        self.documentScope = scope or ""
 
     def addTuple(self, lab, start, end):
         if lab in self.standaloneEngine.labelsToConvert:
@@ -2158,25 +2957,39 @@ class StandaloneReplacementEngineEvent:
         elif lab in self.standaloneEngine.labelsToPreserve:
             self.preservationTuples.append((lab, start, end))
 
-    # This can't be used if any of the replacers are PS_CORP_DIST.
+    # This can't be used if any of the replacers are PS_CORP_DIST;
+    # use StandaloneReplacementEngine.convertBatch() instead.
 
     def convert(self, rName):
-        self.replacedSignal = self.replacedTuples = None
-        signal = self.signal
-        rEngine = self.standaloneEngine.getReplacementEngine(rName)
+        self.convertWithEngine(self.standaloneEngine.getConversionEngine(rName))
+
+    # Same as convert(), but with a specific engine (e.g., one with
+    # different cache scopes; see newReplacementEngine()).
+
+    def convertWithEngine(self, rEngine):
         # replacementTuples and preservationTuples are label, start, end.
-        rDict = {}
         for lab in set([t[0] for t in self.replacementTuples]):
-            r = rEngine.getReplacer(lab)
-            rDict[lab] = r
-            if r.patternSource == PS_CORP_DIST:
+            if rEngine.getReplacer(lab).patternSource == PS_CORP_DIST:
                 raise StandaloneReplacementEngineError, ("can't do document-by-document conversion because label '%s' uses a corpus-based distribution for replacement" % lab)
-        tuplesToProcess = [(lab, start, end, rDict[lab]) for lab, start, end in self.replacementTuples]
-        digestions = [(lab, start, end, r, r.Digest(signal[start:end])) for lab, start, end, r in tuplesToProcess]
+        digestions = self._digest(rEngine)
         rEngine.EndDocumentForDigestion()
+        self._replace(rEngine, digestions)
+        rEngine.EndReplacement()
+
+    def _digest(self, rEngine):
+        self.replacedSignal = self.replacedTuples = self.offsetMap = None
+        rEngine.setDocumentScope(self.documentScope)
+        signal = self.signal
+        pats = rEngine.DigestDocument([(lab, signal[start:end]) for lab, start, end in self.replacementTuples])
+        return [(lab, start, end, rEngine.getReplacer(lab), p)
+                for (lab, start, end), p in zip(self.replacementTuples, pats)]
+
+    def _replace(self, rEngine, digestions):
+        rEngine.setDocumentScope(self.documentScope)
         nominations = [(lab, start, end, r.Replace(p)) for lab, start, end, r, p in digestions]
         rEngine.EndDocumentForReplacement()
-        self.replacedSignal, self.replacedTuples = rEngine.Transform(signal, self.prologue, nominations, self.preservationTuples)
+        self.replacedSignal, self.replacedTuples, self.offsetMap = \
+                             rEngine.TransformWithOffsetMap(self.signal, self.prologue, nominations, self.preservationTuples)
 
     def getReplacedSignal(self):
         return self.replacedSignal
@@ -2184,6 +2997,9 @@ class StandaloneReplacementEngineEvent:
     def getReplacedTuples(self):
         return self.replacedTuples
 
+    def getOffsetMap(self):
+        return self.offsetMap
+
 class StandaloneReplacementEngine:
 
     # These initializations should both be set in a subclass,
@@ -2199,6 +3015,8 @@ class StandaloneReplacementEngine:
                 self.labelsToPreserve.discard(lab)
         self.definedReplacers = {}
         self.resourceDirs = []
+        self.threadSafe = False
+        self.lock = threading.Lock()
 
     def getReplaceableLabels(self):
         return self.categories.keys()
@@ -2210,16 +3028,73 @@ class StandaloneReplacementEngine:
     
     evtClass = StandaloneReplacementEngineEvent
     
-    def newEvent(self, signal, prologue = None):
-        return self.evtClass(self, signal, prologue)
+    def newEvent(self, signal, prologue = None, documentScope = None):
+        evt = self.evtClass(self, signal, prologue)
+        if documentScope is not None:
+            evt.setDocumentScope(documentScope)
+        return evt
+
+    # Converts a list of events the way the nominate step converts a
+    # batch: all the events are digested, the corpus statistics are
+    # finalized, and then all the events are replaced. So unlike
+    # convert(), this works for labels which use a corpus-based
+    # distribution (e.g., LOCATION), and a Java caller crosses into
+    # Python once per batch rather than once per document. Each event
+    # is a separate document, as far as the caches are concerned, with
+    # its own document scope.
+    # Returns a list of [replaced signal, replaced tuples], in the
+    # order of the events; the results are also available from the
+    # events themselves.
+
+    def convertBatch(self, events, rName):
+        rEngine = self.getConversionEngine(rName)
+        rEngine.resetCorpusStatistics()
+        allDigestions = []
+        for evt in events:
+            allDigestions.append(evt._digest(rEngine))
+            rEngine.EndDocumentForDigestion()
+        rEngine.EndDigestion()
+        for evt, digestions in zip(events, allDigestions):
+            evt._replace(rEngine, digestions)
+        rEngine.EndReplacement()
+        return [[evt.getReplacedSignal(), evt.getReplacedTuples()] for evt in events]
+
+    # If the standalone engine is thread-safe, any number of threads
+    # can call convert() and convertBatch() at once. Each call converts
+    # in a context of its own (see PIIReplacementEngine.newContext()),
+    # which shares the resources of the replacement engine, but not its
+    # caches; so the cache scope is effectively the call. Otherwise,
+    # each call uses the replacement engine itself, and the batch
+    # and persistent caches last from one call to the next.
+
+    def setThreadSafe(self, threadSafe):
+        self.threadSafe = threadSafe
+
+    def getConversionEngine(self, rName):
+        rEngine = self.getReplacementEngine(rName)
+        if self.threadSafe:
+            return rEngine.newContext()
+        else:
+            return rEngine
 
     def getReplacementEngine(self, rName):
+        self.lock.acquire()
         try:
-            return self.definedReplacers[rName]
-        except KeyError:
             try:
-                r = self.replacerDir[rName](self.resourceDirs, self.categories)
+                return self.definedReplacers[rName]
+            except KeyError:
+                r = self.newReplacementEngine(rName)
                 self.definedReplacers[rName] = r
                 return r
-            except KeyError:
-                raise StandaloneReplacementEngineError, str(e)
+        finally:
+            self.lock.release()
+
+    # Returns an engine which isn't shared with getReplacementEngine().
+    # The keywords are engine arguments, e.g., cache_scope.
+
+    def newReplacementEngine(self, rName, **kw):
+        try:
+            rClass = self.replacerDir[rName]
+        except KeyError:
+            raise StandaloneReplacementEngineError, ("unknown replacer '%s'" % rName)
+        return rClass(self.resourceDirs, self.categories, **kw)
@@ -0,0 +1,153 @@
+# Copyright (C) 2012 The MITRE Corporation. See the toplevel
+# file LICENSE for license terms.
+
+# This file implements the optional profiling of the replacement
+# engine. When it's enabled (PIIReplacementEngine.enableProfiling(),
+# or the profile_replacement engine argument), the engine records:
+
+# - for each operation and label, the number of calls and the latency of
+#   each one. The operations are the engine's Digest, Replace and
+#   Transform, and the dispatch to the digestion and rendering
+#   strategies ("DigestionStrategy" and "RenderingStrategy").
+# - for each label, the hits and misses in the replacement cache
+#   and the seed cache.
+# - the number of calls to each of the repository's load methods made
+#   during those operations, and the time spent in them. The first call
+#   is the one which actually loads the resource. Some load methods call
+#   others, so the times overlap.
+
+# When it's not enabled, the only cost is a test in each of the
+# instrumented methods. Like the rest of the replacement engine, this
+# doesn't use anything from MAT; report() returns something which can
+# be written as JSON.
+
+import array, timeit, threading
+
+_timer = timeit.default_timer
+
+PERCENTILES = [50, 90, 99]
+
+class ReplacementProfile:
+
+    def __init__(self):
+        # (operation, label) -> array of seconds
+        self.latencies = {}
+        # (label, cache) -> [hits, misses]
+        self.cacheCounts = {}
+        # load method -> [calls, seconds]
+        self.resourceLoads = {}
+
+    def start(self):
+        return _timer()
+
+    # Runs fn(*args, **kw) as the given operation, with this as
+    # the current profile (see below).
+
+    def run(self, operation, label, fn, *args, **kw):
+        t = _timer()
+        prev = _setCurrentProfile(self)
+        try:
+            res = fn(*args, **kw)
+        finally:
+            _setCurrentProfile(prev)
+        self.record(operation, label, t)
+        return res
+
+    def record(self, operation, label, startTime):
+        elapsed = _timer() - startTime
+        try:
+            self.latencies[(operation, label)].append(elapsed)
+        except KeyError:
+            self.latencies[(operation, label)] = array.array("d", [elapsed])
+
+    # cache is "cache" or "seed".
+
+    def recordCacheLookup(self, label, cache, hit):
+        try:
+            counts = self.cacheCounts[(label, cache)]
+        except KeyError:
+            counts = self.cacheCounts[(label, cache)] = [0, 0]
+        if hit:
+            counts[0] += 1
+        else:
+            counts[1] += 1
+
+    def recordResourceLoad(self, method, startTime):
+        elapsed = _timer() - startTime
+        try:
+            entry = self.resourceLoads[method]
+        except KeyError:
+            entry = self.resourceLoads[method] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += elapsed
+
+    def report(self):
+        operations = {}
+        for (operation, label), samples in self.latencies.items():
+            samples = sorted(samples)
+            n = len(samples)
+            total = sum(samples)
+            d = {"calls": n,
+                 "total_seconds": total,
+                 "mean_seconds": total / n,
+                 "max_seconds": samples[-1]}
+            for p in PERCENTILES:
+                # Nearest rank.
+                d["p%d_seconds" % p] = samples[max(0, int(round(p * n / 100.0)) - 1)]
+            operations.setdefault(operation, {})[label] = d
+        caches = {}
+        for (label, cache), (hits, misses) in self.cacheCounts.items():
+            caches.setdefault(label, {})[cache] = {"hits": hits, "misses": misses,
+                                                   "hit_rate": float(hits) / (hits + misses)}
+        resources = {}
+        for method, (calls, seconds) in self.resourceLoads.items():
+            resources[method] = {"calls": calls, "seconds": seconds}
+        return {"operations": operations, "caches": caches, "resources": resources}
+
+# The repository may be shared by several engines (see
+# Repository.freeze()), each with its own profile or none, so it
+# doesn't hold a profile itself. The resource loads are recorded in
+# the profile of the engine operation which is running in the
+# current thread (see ReplacementProfile.run()), if any.
+
+_current = threading.local()
+
+def _setCurrentProfile(profile):
+    prev = getattr(_current, "profile", None)
+    _current.profile = profile
+    return prev
+
+# The repository isn't instrumented method by method; rather, each
+# of its load methods is shadowed by a wrapper on the instance, which
+# consults the current profile. So the instrumentation is only
+# installed once, and there's no cost at all unless it is.
+
+_instrumentLock = threading.Lock()
+
+def instrumentRepository(repository):
+    _instrumentLock.acquire()
+    try:
+        if getattr(repository, "_profiledLoads", False):
+            return
+        for name in dir(repository.__class__):
+            if name.startswith("load") and callable(getattr(repository, name)):
+                setattr(repository, name, _ProfiledLoad(name, getattr(repository, name)))
+        repository._profiledLoads = True
+    finally:
+        _instrumentLock.release()
+
+class _ProfiledLoad:
+
+    def __init__(self, name, meth):
+        self.name = name
+        self.meth = meth
+
+    def __call__(self, *args, **kw):
+        profile = getattr(_current, "profile", None)
+        if profile is None:
+            return self.meth(*args, **kw)
+        t = profile.start()
+        try:
+            return self.meth(*args, **kw)
+        finally:
+            profile.recordResourceLoad(self.name, t)
@@ -0,0 +1,242 @@
+# Copyright (C) 2012 The MITRE Corporation. See the toplevel
+# file LICENSE for license terms.
+
+# This file implements a resident replacement server for the
+# standalone replacement engine. docReplace.py starts Python, loads
+# the resources and processes a single document; the server does the
+# first two once, and then processes documents until its input is
+# exhausted. See core/standalone/bin/replacementServer.py for the
+# command line. Like the rest of the replacement engine, this doesn't
+# use anything from MAT.
+
+# The protocol is JSON lines, either on stdin/stdout or on a local
+# socket. Each request is a JSON object on a single line, and each
+# response is a JSON object on a single line. Requests look like this:
+
+# {"id": ..., "replacer": "clear -> clear", "signal": "...",
+#  "tuples": [[label, start, end], ...], "prologue": "...", "session": "...",
+#  "document": "..."}
+
+# "id" is optional, and is copied into the response. "replacer" may
+# be omitted if the engine has only one replacer. "document" is
+# optional; it's the document scope for the replacement choices (see
+# PIIReplacementEngine.setDocumentScope()), e.g., the file name. Instead of "tuples",
+# the request may contain "asets", as in MAT JSON documents (see
+# docReplace.py). The response is
+
+# {"id": ..., "signal": "...", "tuples": [[label, start, end], ...]}
+
+# or {"id": ..., "error": "..."}.
+
+# The server has a single standalone engine, in thread-safe mode, so
+# the resources for each replacer are loaded once no matter how many
+# workers there are; each request converts in an engine context of its
+# own (see PIIReplacementEngine.newContext()), and at most "workers"
+# requests are converted at once. Without a session, the replacement
+# caches last for the request only (i.e., the document cache
+# scope). Requests with the same "session" share a context of their
+# own, whose caches last until the session ends, so
+# the same name gets the same replacement in all the documents in the
+# session. The cache scope of that engine can be set by the
+# "cache_scope" element of the first request in the session, in the
+# same format as the cache_scope engine argument; the default is the
+# batch scope for all labels. Requests in the same session are
+# processed one at a time, but with more than one worker, not
+# necessarily in the order they were sent. The request
+
+# {"id": ..., "command": "end_session", "session": "..."}
+
+# discards the session; wait for the responses to the session's
+# requests before sending it.
+
+import threading, Queue
+
+try:
+    import json
+except ImportError:
+    # Python 2.5, or Jython. The caller has to make sure it's
+    # on the path.
+    import simplejson as json
+
+from ReplacementEngine import StandaloneReplacementEngineError
+
+class ReplacementServerError(Exception):
+    pass
+
+class _Session:
+
+    def __init__(self, cacheScope):
+        self.lock = threading.Lock()
+        self.cacheScope = cacheScope
+        # replacer name -> engine context
+        self.engines = {}
+
+class ReplacementServer:
+
+    # engineFactory returns a fully configured StandaloneReplacementEngine
+    # (i.e., with its resource dirs added).
+
+    def __init__(self, engineFactory, workers = 1):
+        self.workers = max(1, workers)
+        self.engine = engineFactory()
+        self.engine.setThreadSafe(True)
+        self.slots = threading.Semaphore(self.workers)
+        self.sessions = {}
+        self.sessionLock = threading.Lock()
+
+    # Load the resources for the named replacers, so the first
+    # requests don't pay for it.
+
+    def preload(self, rNames):
+        for rName in rNames:
+            self.engine.getReplacementEngine(rName).repository.preloadAll()
+
+    # Returns the response dictionary.
+
+    def handleRequest(self, req):
+        if type(req) is not dict:
+            return {"error": "request is not a JSON object"}
+        try:
+            resp = self._handleRequest(req)
+        except (StandaloneReplacementEngineError, ReplacementServerError), e:
+            resp = {"error": str(e)}
+        except Exception, e:
+            resp = {"error": "%s: %s" % (e.__class__.__name__, e)}
+        if req.has_key("id"):
+            resp["id"] = req["id"]
+        return resp
+
+    def handleLine(self, line):
+        try:
+            req = json.loads(line)
+        except ValueError, e:
+            return {"error": "bad JSON: %s" % e}
+        return self.handleRequest(req)
+
+    def _handleRequest(self, req):
+        command = req.get("command", "replace")
+        if command == "end_session":
+            self.sessionLock.acquire()
+            try:
+                if self.sessions.has_key(req.get("session")):
+                    del self.sessions[req["session"]]
+            finally:
+                self.sessionLock.release()
+            return {}
+        elif command != "replace":
+            raise ReplacementServerError, ("unknown command '%s'" % command)
+        if not req.has_key("signal"):
+            raise ReplacementServerError, "no signal in request"
+        rName = self._getReplacerName(self.engine, req.get("replacer"))
+        evt = self._newEvent(self.engine, req)
+        session = req.get("session")
+        self.slots.acquire()
+        try:
+            if session is None:
+                evt.convert(rName)
+            else:
+                s = self._getSession(session, req.get("cache_scope"))
+                s.lock.acquire()
+                try:
+                    try:
+                        rEngine = s.engines[rName]
+                    except KeyError:
+                        rEngine = s.engines[rName] = \
+                                  self.engine.getReplacementEngine(rName).newContext(cache_scope = s.cacheScope)
+                    evt.convertWithEngine(rEngine)
+                finally:
+                    s.lock.release()
+        finally:
+            self.slots.release()
+        return {"signal": evt.getReplacedSignal(),
+                "tuples": [list(t) for t in evt.getReplacedTuples()]}
+
+    def _getReplacerName(self, e, rName):
+        if rName is not None:
+            return rName
+        if len(e.replacerDir) == 1:
+            return e.replacerDir.keys()[0]
+        raise ReplacementServerError, "no replacer specified"
+
+    def _newEvent(self, e, req):
+        evt = e.newEvent(req["signal"], req.get("prologue"), req.get("document"))
+        if req.has_key("tuples"):
+            for lab, start, end in req["tuples"]:
+                evt.addTuple(lab, start, end)
+        else:
+            for aset in req.get("asets", []):
+                for annot in aset["annots"]:
+                    evt.addTuple(aset["type"], annot[0], annot[1])
+        return evt
+
+    def _getSession(self, session, cacheScope):
+        self.sessionLock.acquire()
+        try:
+            try:
+                return self.sessions[session]
+            except KeyError:
+                if cacheScope is None:
+                    cacheScope = ";".join(["%s,batch" % lab for lab in self.engine.getReplaceableLabels()])
+                s = self.sessions[session] = _Session(cacheScope)
+                return s
+        finally:
+            self.sessionLock.release()
+
+    # Serve JSON lines from one stream to another. With more than one
+    # worker, the responses may not be in the order of the requests;
+    # use the "id" element to match them up.
+
+    def serveStream(self, inStream, outStream):
+        outLock = threading.Lock()
+        def respond(line):
+            s = json.dumps(self.handleLine(line))
+            outLock.acquire()
+            try:
+                outStream.write(s + "\n")
+                outStream.flush()
+            finally:
+                outLock.release()
+        if self.workers == 1:
+            for line in iter(inStream.readline, ""):
+                if line.strip():
+                    respond(line)
+            return
+        lines = Queue.Queue(self.workers * 2)
+        def work():
+            while True:
+                line = lines.get()
+                if line is None:
+                    return
+                respond(line)
+        threads = [threading.Thread(target = work) for i in range(self.workers)]
+        for t in threads:
+            t.start()
+        for line in iter(inStream.readline, ""):
+            if line.strip():
+                lines.put(line)
+        for t in threads:
+            lines.put(None)
+        for t in threads:
+            t.join()
+
+    # Serve JSON lines on a local TCP socket. Each connection is
+    # handled in its own thread; the concurrency is still limited
+    # by the number of workers.
+
+    def serveSocket(self, port, host = "127.0.0.1"):
+        import SocketServer
+        server = self
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                for line in iter(self.rfile.readline, ""):
+                    if line.strip():
+                        self.wfile.write(json.dumps(server.handleLine(line)) + "\n")
+                        self.wfile.flush()
+        class Server(SocketServer.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+        tcpServer = Server((host, port), Handler)
+        try:
+            tcpServer.serve_forever()
+        finally:
+            tcpServer.server_close()
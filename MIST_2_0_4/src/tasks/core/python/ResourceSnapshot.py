@@ -0,0 +1,548 @@
+# Copyright (C) 2007 - 2009 The MITRE Corporation. See the toplevel
+# file LICENSE for license terms.
+
+# This file implements precompiled snapshots of the replacement engine
+# resource repository. Loading the names, streets, zip codes and
+# hospitals from their text files means parsing about 260K lines and
+# rebuilding all the distribution sets in Python dictionaries, which
+# costs seconds before the first replacement. A snapshot is a single
+# binary file which contains the results of that parse: string tables
+# and the flat arrays of the distribution sets' alias tables. The engine maps the file
+# (using mmap, if it's available) and reads directly from it.
+
+# Snapshot format (all integers little-endian):
+#
+# header:    8-byte magic, uint32 version, uint32 directory length
+# directory: a marshalled dictionary {"meta": ..., "sections": ...}
+# sections:  8-byte aligned, starting right after the directory.
+#
+# Each section is one of:
+#
+# "s": a string table. count + 1 uint32 offsets, followed by the bytes.
+# "d": an array of count float64s.
+# "i": an array of count int32s.
+#
+# The metadata records, for each group of resources in the snapshot,
+# the resource files it was compiled from, and a fingerprint
+# (size, modification time, CRC-32) of each of those files. When the
+# repository asks for a group, we compare the size and modification
+# time against the files the repository would actually have read
+# (taking resource_file_repl into account); if anything's changed, the
+# repository falls back to parsing the resource files. That's just a
+# stat() per file. Reading the files to compare the CRCs as well is
+# optional (see the verifyChecksums argument), since it costs a fair
+# fraction of what the snapshot saves. Note that copying the resource
+# files usually changes their modification times, so rebuild the
+# snapshot after installing them somewhere else.
+
+# The date patterns are stored as the token sequences the date parser
+# produces for them, so the parser isn't needed at startup. The small
+# XML resources (states, countries) are still loaded from their source files.
+
+# The same representation is also much smaller than the dictionaries
+# and lists the repository builds when it parses the resource files
+# (one string pool instead of a Python string per item, flat arrays
+# instead of lists of floats). So when there's no snapshot, the
+# repository compacts the names after it loads them (see compactGroup()).
+
+import struct, marshal, os, sys, zlib, bisect
+
+from ReplacementEngine import Repository, NameResource, \
+     ArrayDistributionSet, ArrayLengthDistributionSet
+
+try:
+    import mmap
+except ImportError:
+    # Jython, for instance. We'll just read the file.
+    mmap = None
+
+SNAPSHOT_MAGIC = "MISTSNAP"
+SNAPSHOT_VERSION = 3
+
+_HEADER_FMT = "<8sII"
+_HEADER_SIZE = struct.calcsize(_HEADER_FMT)
+
+# Tuple-valued items (e.g., first name + nicknames) are stored
+# as single strings with this separator.
+
+TUPLE_SEP = "\x1f"
+
+def _decodeTuple(s):
+    return tuple(s.split(TUPLE_SEP))
+
+# Date token sequences are sequences of tuples.
+
+TOKSEQ_SEP = "\x1e"
+
+def _encodeTokSeq(tokSeq):
+    return TOKSEQ_SEP.join([_encodeTuple(t) for t in tokSeq])
+
+def _decodeTokSeq(s):
+    return tuple([_decodeTuple(t) for t in s.split(TOKSEQ_SEP)])
+
+def _encodeTuple(t):
+    return TUPLE_SEP.join(t)
+
+def _align(n):
+    return (n + 7) & ~7
+
+class ResourceSnapshotError(Exception):
+    pass
+
+#
+# Views on the snapshot buffer.
+#
+
+# These behave like (read-only) sequences, so random.choice()
+# and bisect work on them.
+
+class StringTable:
+
+    def __init__(self, buf, offset, count):
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+        self.dataStart = offset + (4 * (count + 1))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if (i < 0) or (i >= self.count):
+            raise IndexError, "string table index out of range"
+        s, e = struct.unpack_from("<II", self.buf, self.offset + (4 * i))
+        return self.buf[self.dataStart + s:self.dataStart + e]
+
+class NumberArray:
+
+    def __init__(self, buf, offset, count, code):
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+        self.fmt = "<" + code
+        self.itemSize = struct.calcsize(self.fmt)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if (i < 0) or (i >= self.count):
+            raise IndexError, "array index out of range"
+        return struct.unpack_from(self.fmt, self.buf, self.offset + (self.itemSize * i))[0]
+
+# A map from a sorted string table to lists of strings. The
+# values for key i are values[starts[i]:starts[i + 1]]. This
+# stands in for the capitalization hash, which is only
+# ever accessed via get().
+
+class SortedStringMap:
+
+    def __init__(self, keys, starts, values):
+        self.keys = keys
+        self.starts = starts
+        self.values = values
+
+    def _find(self, k):
+        if type(k) is unicode:
+            k = k.encode("utf-8")
+        i = bisect.bisect_left(self.keys, k)
+        if (i < len(self.keys)) and (self.keys[i] == k):
+            return i
+        return -1
+
+    def __len__(self):
+        return len(self.keys)
+
+    def has_key(self, k):
+        return self._find(k) > -1
+
+    __contains__ = has_key
+
+    def get(self, k, default = None):
+        i = self._find(k)
+        if i < 0:
+            return default
+        return [self.values[j] for j in range(self.starts[i], self.starts[i + 1])]
+
+    def __getitem__(self, k):
+        v = self.get(k)
+        if v is None:
+            raise KeyError, k
+        return v
+
+# The town tuples are (city, state entry, zip). The state entries
+# come from states.xml, which we don't snapshot.
+
+class TownTupleTable:
+
+    def __init__(self, cities, stateAbbrs, zips, stateDict):
+        self.cities = cities
+        self.stateAbbrs = stateAbbrs
+        self.zips = zips
+        self.stateDict = stateDict
+
+    def __len__(self):
+        return len(self.cities)
+
+    def __getitem__(self, i):
+        return (self.cities[i], self.stateDict[self.stateAbbrs[i]], self.zips[i])
+
+#
+# Writing.
+#
+
+class SnapshotWriter:
+
+    def __init__(self):
+        self.sections = []
+        self.meta = {}
+
+    def addStrings(self, name, strs):
+        offsets = [0]
+        pieces = []
+        cur = 0
+        for s in strs:
+            if type(s) is unicode:
+                s = s.encode("utf-8")
+            pieces.append(s)
+            cur += len(s)
+            offsets.append(cur)
+        self.sections.append((name, "s", len(strs),
+                              struct.pack("<%dI" % len(offsets), *offsets) + "".join(pieces)))
+
+    def addDoubles(self, name, nums):
+        self.sections.append((name, "d", len(nums), struct.pack("<%dd" % len(nums), *nums)))
+
+    def addInts(self, name, nums):
+        self.sections.append((name, "i", len(nums), struct.pack("<%di" % len(nums), *nums)))
+
+    # A finished distribution set becomes an item table and the two
+    # halves of its alias table; the overall frequency goes in the metadata.
+
+    def addAliasTable(self, name, dist):
+        self.addDoubles(name + ".probs", dist.aliasProbs)
+        self.addInts(name + ".aliases", dist.aliasIndices)
+        self.meta.setdefault("overallFreqs", {})[name] = dist.overallFreq
+
+    def addDistributionSet(self, name, dist, encoder = None):
+        dist.Finish()
+        if encoder is None:
+            self.addStrings(name + ".items", dist.choiceItems)
+        else:
+            self.addStrings(name + ".items", [encoder(k) for k in dist.choiceItems])
+        self.addAliasTable(name, dist)
+
+    # The whole snapshot, as a string.
+
+    def getBuffer(self):
+        sectionDir = {}
+        relOffset = 0
+        for name, kind, count, data in self.sections:
+            sectionDir[name] = (kind, relOffset, count)
+            relOffset = _align(relOffset + len(data))
+        directory = marshal.dumps({"meta": self.meta, "sections": sectionDir})
+        dataStart = _align(_HEADER_SIZE + len(directory))
+        pieces = [struct.pack(_HEADER_FMT, SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(directory)),
+                  directory, "\0" * (dataStart - (_HEADER_SIZE + len(directory)))]
+        for name, kind, count, data in self.sections:
+            pieces.append(data)
+            pieces.append("\0" * (_align(len(data)) - len(data)))
+        return "".join(pieces)
+
+    def write(self, path):
+        buf = self.getBuffer()
+        # Write to a temporary file, and then move it into place, so that
+        # nobody maps a partial snapshot.
+        tmpPath = path + ".tmp"
+        fp = open(tmpPath, "wb")
+        fp.write(buf)
+        fp.close()
+        if os.path.exists(path) and (sys.platform == "win32"):
+            os.remove(path)
+        os.rename(tmpPath, path)
+
+#
+# Reading.
+#
+
+class ResourceSnapshot:
+
+    # If buf is provided (see SnapshotWriter.getBuffer()), it's the
+    # snapshot, and the path is only used in messages. If verifyChecksums
+    # is true, isCurrent() compares the CRCs of the resource files too.
+
+    def __init__(self, path, buf = None, verifyChecksums = False):
+        self.path = path
+        self.verifyChecksums = verifyChecksums
+        if buf is not None:
+            if len(buf) < _HEADER_SIZE:
+                raise ResourceSnapshotError, ("%s is not a resource snapshot" % path)
+            self.buf = buf
+        else:
+            fp = open(path, "rb")
+            try:
+                size = os.fstat(fp.fileno()).st_size
+                if size < _HEADER_SIZE:
+                    raise ResourceSnapshotError, ("%s is not a resource snapshot" % path)
+                if mmap is not None:
+                    self.buf = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+                else:
+                    self.buf = fp.read()
+            finally:
+                # The map keeps its own reference to the file.
+                fp.close()
+        magic, version, dirLen = struct.unpack_from(_HEADER_FMT, self.buf, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ResourceSnapshotError, ("%s is not a resource snapshot" % path)
+        if version != SNAPSHOT_VERSION:
+            raise ResourceSnapshotError, ("resource snapshot %s has version %d, but version %d is required; rebuild it" % (path, version, SNAPSHOT_VERSION))
+        directory = marshal.loads(self.buf[_HEADER_SIZE:_HEADER_SIZE + dirLen])
+        self.meta = directory["meta"]
+        self.sections = directory["sections"]
+        self.dataStart = _align(_HEADER_SIZE + dirLen)
+        self._currentGroups = {}
+
+    def _section(self, name, kind):
+        try:
+            sKind, relOffset, count = self.sections[name]
+        except KeyError:
+            raise ResourceSnapshotError, ("resource snapshot %s has no section %s" % (self.path, name))
+        if sKind != kind:
+            raise ResourceSnapshotError, ("section %s of resource snapshot %s has the wrong type" % (name, self.path))
+        return self.dataStart + relOffset, count
+
+    def strings(self, name):
+        offset, count = self._section(name, "s")
+        return StringTable(self.buf, offset, count)
+
+    def doubles(self, name):
+        offset, count = self._section(name, "d")
+        return NumberArray(self.buf, offset, count, "d")
+
+    def ints(self, name):
+        offset, count = self._section(name, "i")
+        return NumberArray(self.buf, offset, count, "i")
+
+    def distributionSet(self, name, decoder = None):
+        return ArrayDistributionSet(self.strings(name + ".items"), self.doubles(name + ".probs"),
+                                    self.ints(name + ".aliases"), self.meta["overallFreqs"][name],
+                                    decoder = decoder)
+
+    # Is the group current with respect to the files this
+    # repository would load?
+
+    def isCurrent(self, group, repository):
+        try:
+            return self._currentGroups[group]
+        except KeyError:
+            pass
+        isCurrent = True
+        try:
+            sources = self.meta["groups"][group]
+        except KeyError:
+            isCurrent = False
+        else:
+            for resourceFile in sources:
+                if not _matchesFingerprint(repository._getPath(resourceFile),
+                                           self.meta["sources"][resourceFile],
+                                           self.verifyChecksums):
+                    print >> sys.stderr, "Resource snapshot %s is out of date with respect to %s; loading from resource files instead" % (self.path, resourceFile)
+                    isCurrent = False
+                    break
+        self._currentGroups[group] = isCurrent
+        return isCurrent
+
+    # Populating the repository. These set the same
+    # attributes the Repository.load* methods do.
+
+    def populate(self, group, repository):
+        getattr(self, "_populate" + group[0].upper() + group[1:])(repository)
+
+    def _populateNames(self, repository):
+        nameResource = NameResource(repository)
+        for attr, decoder in _NAME_DISTS:
+            setattr(nameResource, attr, self.distributionSet("names." + attr, decoder = decoder))
+        nameResource.capitalizationHash = SortedStringMap(self.strings("names.cap.keys"),
+                                                          self.ints("names.cap.starts"),
+                                                          self.strings("names.cap.values"))
+        repository.nameResource = nameResource
+
+    def _populateHospitals(self, repository):
+        repository.hospitals = ArrayLengthDistributionSet(self.ints("hospitals.lengths"),
+                                                          self.doubles("hospitals.probs"),
+                                                          self.ints("hospitals.aliases"),
+                                                          self.meta["overallFreqs"]["hospitals"],
+                                                          self.strings("hospitals.members"),
+                                                          self.ints("hospitals.starts"))
+        repository.hospitalPostSeqDist = self.distributionSet("hospitals.postSeq")
+
+    def _populateStreetNames(self, repository):
+        repository.streetNames = self.strings("streets.names")
+        repository.streetPostfixDist = self.distributionSet("streets.postfix", decoder = _decodeTuple)
+
+    def _populateTownTuples(self, repository):
+        sDict = {}
+        for stateEntry in repository.loadStates().entries:
+            sDict[stateEntry.alts["shortabbr"][0]] = stateEntry
+        repository.townTuples = TownTupleTable(self.strings("towns.cities"), self.strings("towns.states"),
+                                               self.strings("towns.zips"), sDict)
+
+    def _populateUrls(self, repository):
+        repository.hostList = self.strings("urls.hosts")
+        repository.pathSuffs = self.strings("urls.pathSuffs")
+
+    def _populateAreaCodes(self, repository):
+        repository.areaCodes = self.strings("areaCodes")
+
+    def _populateDatePatterns(self, repository):
+        repository.datePatternDist = self.distributionSet("datePatterns", decoder = _decodeTokSeq)
+
+_NAME_DISTS = [("maleFirstNameDist", _decodeTuple),
+               ("femaleFirstNameDist", _decodeTuple),
+               ("neutralFirstNameDist", _decodeTuple),
+               ("lastNameDist", None),
+               ("exclusivelyLastNameDist", None)]
+
+# The modification time is truncated to seconds, since some
+# file systems don't store any more than that.
+
+def _stat(path):
+    st = os.stat(path)
+    return (st.st_size, int(st.st_mtime))
+
+def _crc(path):
+    crc = 0
+    fp = open(path, "rb")
+    while True:
+        block = fp.read(1 << 16)
+        if not block:
+            break
+        crc = zlib.crc32(block, crc)
+    fp.close()
+    return crc & 0xffffffff
+
+def _fingerprint(path):
+    if path is None:
+        return None
+    return _stat(path) + (_crc(path),)
+
+def _matchesFingerprint(path, fingerprint, verifyChecksums):
+    if (path is None) or (fingerprint is None):
+        return path is fingerprint
+    try:
+        if _stat(path) != fingerprint[:2]:
+            return False
+        return (not verifyChecksums) or (_crc(path) == fingerprint[2])
+    except (IOError, OSError):
+        return False
+
+#
+# Compiling.
+#
+
+def _compileNames(w, repository):
+    nameResource = repository.loadNames()
+    for attr, decoder in _NAME_DISTS:
+        if decoder is None:
+            w.addDistributionSet("names." + attr, getattr(nameResource, attr))
+        else:
+            w.addDistributionSet("names." + attr, getattr(nameResource, attr), encoder = _encodeTuple)
+    capKeys = nameResource.capitalizationHash.keys()
+    capKeys.sort()
+    starts = [0]
+    values = []
+    for k in capKeys:
+        values += nameResource.capitalizationHash[k]
+        starts.append(len(values))
+    w.addStrings("names.cap.keys", capKeys)
+    w.addInts("names.cap.starts", starts)
+    w.addStrings("names.cap.values", values)
+
+def _compileHospitals(w, repository):
+    hospitals, postSeqDist = repository.loadHospitals()
+    starts = [0]
+    members = []
+    for length in hospitals.choiceItems:
+        members += [" ".join(toks) for toks in hospitals.items[length]]
+        starts.append(len(members))
+    w.addInts("hospitals.lengths", hospitals.choiceItems)
+    w.addAliasTable("hospitals", hospitals)
+    w.addStrings("hospitals.members", members)
+    w.addInts("hospitals.starts", starts)
+    w.addDistributionSet("hospitals.postSeq", postSeqDist)
+
+def _compileStreetNames(w, repository):
+    streetNames, streetPostfixDist = repository.loadStreetNames()
+    w.addStrings("streets.names", streetNames)
+    w.addDistributionSet("streets.postfix", streetPostfixDist, encoder = _encodeTuple)
+
+def _compileTownTuples(w, repository):
+    townTuples = repository.loadZipsCitiesStates()
+    w.addStrings("towns.cities", [t[0] for t in townTuples])
+    w.addStrings("towns.states", [t[1].alts["shortabbr"][0] for t in townTuples])
+    w.addStrings("towns.zips", [t[2] for t in townTuples])
+
+def _compileUrls(w, repository):
+    hostList, pathSuffs = repository.loadURLs()
+    w.addStrings("urls.hosts", hostList)
+    w.addStrings("urls.pathSuffs", pathSuffs)
+
+def _compileAreaCodes(w, repository):
+    w.addStrings("areaCodes", repository.loadAreaCodes())
+
+def _compileDatePatterns(w, repository):
+    w.addDistributionSet("datePatterns", repository.loadDatePatterns(), encoder = _encodeTokSeq)
+
+# The groups in the snapshot, the resource files each of
+# them is compiled from, and the function which compiles them.
+
+SNAPSHOT_GROUPS = [("names", ["nicknames.txt", "dist.common.first", "dist.female.first",
+                              "dist.male.first", "dist.all.last", "capitalization_guide.txt"],
+                    _compileNames),
+                   ("hospitals", ["hospitals.txt"], _compileHospitals),
+                   ("streetNames", ["street_suffs.txt", "mass_roads.txt"], _compileStreetNames),
+                   ("townTuples", ["states.xml", "zipcodes"], _compileTownTuples),
+                   ("urls", ["google_urls.txt"], _compileUrls),
+                   ("areaCodes", ["area_codes.txt"], _compileAreaCodes),
+                   ("datePatterns", ["date_patterns.txt"], _compileDatePatterns)]
+
+# Replace a group the repository has already loaded from its resource
+# files with the snapshot representation of the same data, built in
+# memory. The choices the engine makes don't change: the items and alias
+# tables are the ones the loaded distribution sets built.
+
+def compactGroup(repository, group):
+    for g, sources, compileFn in SNAPSHOT_GROUPS:
+        if g == group:
+            w = SnapshotWriter()
+            compileFn(w, repository)
+            ResourceSnapshot("<%s>" % group, buf = w.getBuffer()).populate(group, repository)
+            return
+    raise ResourceSnapshotError, ("unknown resource group '%s'" % group)
+
+# dataDirs and resourceReplacements are exactly what you'd pass
+# to the Repository (or, as resource_dirs and resource_file_repl,
+# to the replacement engine).
+
+def compileSnapshot(dataDirs, path, resourceReplacements = None):
+    # Make sure we're parsing the resource files, not reading
+    # some other snapshot (or the compacted version of them).
+    repository = Repository(dataDirs, resourceReplacements, findSnapshot = False, compact = False)
+    w = SnapshotWriter()
+    w.meta["groups"] = {}
+    w.meta["sources"] = {}
+    w.meta["replacements"] = dict(resourceReplacements or {})
+    for group, sources, compileFn in SNAPSHOT_GROUPS:
+        paths = [repository._getPath(resourceFile) for resourceFile in sources]
+        if None in paths:
+            print >> sys.stderr, "Skipping resource group '%s', because not all of %s can be found" % (group, ", ".join(sources))
+            continue
+        compileFn(w, repository)
+        w.meta["groups"][group] = sources
+        for resourceFile, p in zip(sources, paths):
+            w.meta["sources"][resourceFile] = _fingerprint(p)
+    w.write(path)
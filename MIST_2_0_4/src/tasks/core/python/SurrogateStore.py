@@ -0,0 +1,354 @@
+# Copyright (C) 2007 - 2009 The MITRE Corporation. See the toplevel
+# file LICENSE for license terms.
+
+# This file implements the persistent surrogate store, which backs
+# the replacer caches for labels whose cache scope is "persistent"
+# (see PIIReplacementEngine.setCacheScope). The batch cache scope
+# only lasts as long as the engine does; with the persistent scope,
+# the same patient gets the same pseudonym across batches and runs,
+# e.g., nightly increments of the same corpus.
+
+# The store is a single SQLite file. Each replacer cache (the
+# input -> replacement cache, and the seed cache) is a
+# PersistentCacheMapping, which supports the part of the dictionary
+# interface the replacers use. Lookups go through a bounded in-memory
+# LRU, which also remembers misses, since most lookups of new
+# inputs will miss. Writes are buffered and committed in batches;
+# the engine commits whatever's left at the end of each batch
+# (PIIReplacementEngine.EndReplacement()).
+
+# The values are pickled. The keys may be strings or tuples of strings,
+# and the in-memory caches don't distinguish between str and unicode,
+# so we store a canonical representation of them.
+
+# The seeds need more care. The strategies fill in parts of a seed
+# after it's stored (e.g., the middle names of a name, or the area
+# code of a phone number; see ClearReplacementStrategy), and several
+# keys share the same seed object, so later variants see what the
+# earlier ones filled in. So each seed is stored once, in its own
+# table, and the seed cache rows refer to it. Every seed which the
+# seed caches hand out (or are given) during a batch stays live until
+# the end of the batch, when flush() pickles it in its final form;
+# until then, fetching it again gives back the same object. Writes in
+# the middle of the batch only add the rows for new keys and seeds.
+
+# The store may be shared by engine contexts in different threads (see
+# PIIReplacementEngine.newContext()), so everything which touches the
+# LRUs, the pending writes or the connection holds the store's lock.
+
+# The store may also be inherited by forked workers (see the nominate
+# step's --nominate_workers), and an SQLite connection can't be used
+# on both sides of a fork. So a store which finds itself in a new
+# process opens a connection of its own. The workers only read from
+# the store; the parent does all the writing.
+
+# Other processes may be using the same file (e.g., two MATEngine runs
+# against the same workspace). SQLite waits up to timeout seconds for
+# a lock, but it can also give up immediately (e.g., when two readers
+# both want to write), so a statement or a batch of writes which fails
+# with "database is locked" is rolled back and retried a few times.
+
+import cPickle, threading, weakref, os, time
+
+try:
+    import sqlite3
+except ImportError:
+    # Jython, for instance.
+    sqlite3 = None
+
+class SurrogateStoreError(Exception):
+    pass
+
+_MISSING = object()
+
+def _canonicalKey(k):
+    if type(k) is str:
+        return k.decode("utf-8", "replace")
+    elif type(k) in (tuple, list):
+        return tuple([_canonicalKey(x) for x in k])
+    else:
+        return k
+
+def _storageKey(k):
+    return repr(_canonicalKey(k))
+
+# A dictionary which forgets its least recently used entries. Rather
+# than maintaining the order on every access, we let the dictionary
+# grow to twice its size and then discard the oldest half.
+
+class _LRUDict:
+
+    def __init__(self, size):
+        self.size = max(1, size)
+        self.d = {}
+        self.tick = 0
+
+    def get(self, k, default = None):
+        try:
+            entry = self.d[k]
+        except KeyError:
+            return default
+        self.tick += 1
+        entry[1] = self.tick
+        return entry[0]
+
+    def put(self, k, v):
+        self.tick += 1
+        self.d[k] = [v, self.tick]
+        if len(self.d) > 2 * self.size:
+            entries = self.d.items()
+            entries.sort(key = lambda p: p[1][1])
+            for k, entry in entries[:-self.size]:
+                del self.d[k]
+
+# A stored seed. The seed caches hold these rather than the seeds
+# themselves, so that the store can find the live seed for a row, and
+# the row for a live seed. rowid is None until the seed is written.
+
+class _SeedRef(object):
+
+    __slots__ = ["seed", "rowid", "__weakref__"]
+
+    def __init__(self, seed, rowid = None):
+        self.seed = seed
+        self.rowid = rowid
+
+class PersistentCacheMapping:
+
+    def __init__(self, store, label, kind):
+        self.store = store
+        self.label = label
+        self.kind = kind
+        self.lru = _LRUDict(store.lruSize)
+
+    def _lookup(self, k):
+        key = _storageKey(k)
+        self.store.lock.acquire()
+        try:
+            v = self.lru.get(key, _MISSING)
+            if v is _MISSING:
+                v = self.store._fetch(self.label, self.kind, key)
+                if v is None:
+                    v = _MISSING
+                else:
+                    v = v[0]
+                self.lru.put(key, v)
+            if (v is not _MISSING) and (self.kind == "seed"):
+                v = self.store._touchSeed(v)
+            return v
+        finally:
+            self.store.lock.release()
+
+    def has_key(self, k):
+        return self._lookup(k) is not _MISSING
+
+    __contains__ = has_key
+
+    def __getitem__(self, k):
+        v = self._lookup(k)
+        if v is _MISSING:
+            raise KeyError, k
+        return v
+
+    def get(self, k, default = None):
+        v = self._lookup(k)
+        if v is _MISSING:
+            return default
+        return v
+
+    def __setitem__(self, k, v):
+        key = _storageKey(k)
+        self.store.lock.acquire()
+        try:
+            if self.kind == "seed":
+                v = self.store._seedRef(v)
+            self.lru.put(key, v)
+            self.store._store(self.label, self.kind, key, v)
+        finally:
+            self.store.lock.release()
+
+class SurrogateStore:
+
+    def __init__(self, path, lruSize = 10000, batchSize = 1000,
+                 timeout = 30.0, retries = 5):
+        if sqlite3 is None:
+            raise SurrogateStoreError, "persistent surrogate store requires sqlite3"
+        self.path = path
+        self.lruSize = lruSize
+        self.batchSize = batchSize
+        self.timeout = timeout
+        self.retries = retries
+        self.lock = threading.RLock()
+        self.conn = None
+        self._connect()
+        self._retry(self._createTables)
+        # (label, kind, key) -> value, or _SeedRef for seeds.
+        self.pending = {}
+        self.mappings = {}
+        # id(seed) -> _SeedRef, for the seeds which are live in this batch.
+        self.liveSeeds = {}
+        # rowid -> _SeedRef, for every seed anyone still holds, so
+        # that a row is never loaded twice.
+        self.seedsByRowid = weakref.WeakValueDictionary()
+
+    def _connect(self):
+        try:
+            self.conn = sqlite3.connect(self.path, timeout = self.timeout, check_same_thread = False)
+        except sqlite3.Error, e:
+            raise SurrogateStoreError, ("can't open persistent surrogate store %s: %s" % (self.path, e))
+        self.conn.text_factory = str
+        self.pid = os.getpid()
+
+    def _createTables(self):
+        self.conn.execute("CREATE TABLE IF NOT EXISTS surrogates (label TEXT NOT NULL, kind TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, PRIMARY KEY (label, kind, key))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS seeds (id INTEGER PRIMARY KEY, value BLOB NOT NULL)")
+        self.conn.commit()
+
+    # The connection for this process. The one inherited across
+    # a fork is abandoned rather than closed, since closing it
+    # might touch the parent's state in the file.
+
+    def _getConn(self):
+        if self.pid != os.getpid():
+            self._inheritedConn = self.conn
+            self._connect()
+        return self.conn
+
+    # Calls fn(*args), retrying if the database is locked. fn
+    # must leave the connection as it found it if it fails.
+
+    def _retry(self, fn, *args):
+        delay = 0.1
+        i = 0
+        while True:
+            try:
+                return fn(*args)
+            except sqlite3.OperationalError, e:
+                i += 1
+                if ("locked" not in str(e)) or (i > self.retries):
+                    raise SurrogateStoreError, ("persistent surrogate store %s: %s" % (self.path, e))
+                time.sleep(delay)
+                delay *= 2
+            except sqlite3.Error, e:
+                raise SurrogateStoreError, ("persistent surrogate store %s: %s" % (self.path, e))
+
+    def _query(self, sql, args):
+        return self._getConn().execute(sql, args).fetchone()
+
+    # kind is "cache" or "seed".
+
+    def getMapping(self, label, kind):
+        self.lock.acquire()
+        try:
+            try:
+                return self.mappings[(label, kind)]
+            except KeyError:
+                m = PersistentCacheMapping(self, label, kind)
+                self.mappings[(label, kind)] = m
+                return m
+        finally:
+            self.lock.release()
+
+    # Returns a singleton tuple, or None if there's no entry. For
+    # seeds, the value is a _SeedRef.
+
+    def _fetch(self, label, kind, key):
+        v = self.pending.get((label, kind, key))
+        if v is not None:
+            return (v,)
+        row = self._retry(self._query, "SELECT value FROM surrogates WHERE label = ? AND kind = ? AND key = ?",
+                          (label, kind, key))
+        if row is None:
+            return None
+        v = cPickle.loads(str(row[0]))
+        if kind == "seed":
+            v = self._loadSeed(v)
+        return (v,)
+
+    def _loadSeed(self, rowid):
+        ref = self.seedsByRowid.get(rowid)
+        if ref is None:
+            row = self._retry(self._query, "SELECT value FROM seeds WHERE id = ?", (rowid,))
+            ref = _SeedRef(cPickle.loads(str(row[0])), rowid)
+            self.seedsByRowid[rowid] = ref
+        return ref
+
+    # The seed is handed out, so it may be modified before
+    # the end of the batch.
+
+    def _touchSeed(self, ref):
+        self.liveSeeds[id(ref.seed)] = ref
+        return ref.seed
+
+    # The seed is stored. If it's already live (e.g., it's being
+    # stored under several keys), it keeps its ref.
+
+    def _seedRef(self, seed):
+        try:
+            return self.liveSeeds[id(seed)]
+        except KeyError:
+            ref = _SeedRef(seed)
+            self.liveSeeds[id(seed)] = ref
+            return ref
+
+    def _store(self, label, kind, key, value):
+        self.pending[(label, kind, key)] = value
+        if len(self.pending) >= self.batchSize:
+            self._write(False)
+
+    # Writes the new seeds, and the pending rows. At the end of
+    # the batch, rewrites every live seed as well, and forgets them.
+
+    def _write(self, endOfBatch):
+        newSeeds = [ref for ref in self.liveSeeds.values() if ref.rowid is None]
+        if not (self.pending or newSeeds or (endOfBatch and self.liveSeeds)):
+            return
+        self._retry(self._writeRows, newSeeds, endOfBatch)
+        for ref in newSeeds:
+            self.seedsByRowid[ref.rowid] = ref
+        self.pending = {}
+        if endOfBatch:
+            self.liveSeeds = {}
+
+    # One transaction. If it fails, the new seeds are unwritten again.
+
+    def _writeRows(self, newSeeds, endOfBatch):
+        conn = self._getConn()
+        try:
+            for ref in newSeeds:
+                ref.rowid = conn.execute("INSERT INTO seeds (value) VALUES (?)",
+                                         (sqlite3.Binary(cPickle.dumps(ref.seed, 2)),)).lastrowid
+            if endOfBatch:
+                newIds = set([ref.rowid for ref in newSeeds])
+                conn.executemany("UPDATE seeds SET value = ? WHERE id = ?",
+                                 [(sqlite3.Binary(cPickle.dumps(ref.seed, 2)), ref.rowid)
+                                  for ref in self.liveSeeds.values() if ref.rowid not in newIds])
+            rows = []
+            for (label, kind, key), v in self.pending.items():
+                if kind == "seed":
+                    v = v.rowid
+                rows.append((label, kind, key, sqlite3.Binary(cPickle.dumps(v, 2))))
+            conn.executemany("INSERT OR REPLACE INTO surrogates VALUES (?, ?, ?, ?)", rows)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            for ref in newSeeds:
+                ref.rowid = None
+            raise
+
+    # Called at the end of each batch.
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            self._write(True)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.flush()
+            self._getConn().close()
+        finally:
+            self.lock.release()
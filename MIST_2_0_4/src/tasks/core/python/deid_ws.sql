@@ -4,4 +4,27 @@ CREATE TABLE IF NOT EXISTS nomination_lock (
   doc_name TEXT PRIMARY KEY NOT NULL,
   locked_by TEXT NOT NULL,
   lock_id TEXT NOT NULL
-);
\ No newline at end of file
+);
+
+/* The version of these tables. See DEID_WS_SCHEMA_VERSION in
+   Deidentification.py. */
+
+CREATE TABLE IF NOT EXISTS deid_schema_version (
+  version INTEGER NOT NULL
+);
+
+/* Version 2. The documents present in the nominated and redacted
+   folders, so they can be listed without looking at the files. A folder
+   is in folder_index once its contents have been recorded. */
+
+CREATE TABLE IF NOT EXISTS folder_contents (
+  folder TEXT NOT NULL,
+  doc_name TEXT NOT NULL,
+  PRIMARY KEY (folder, doc_name)
+);
+
+CREATE TABLE IF NOT EXISTS folder_index (
+  folder TEXT PRIMARY KEY NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS nomination_lock_lock_id ON nomination_lock (lock_id);
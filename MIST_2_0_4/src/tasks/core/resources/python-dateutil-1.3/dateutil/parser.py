@@ -13,6 +13,8 @@ import string
 import time
 import sys
 import os
+import re
+import bisect
 
 try:
     from cStringIO import StringIO
@@ -558,12 +560,18 @@ class parser(object):
     def digest(self, timestr, default=None,
                ignoretz=False, tzinfos=None,
                **kwargs):
-        if not default:
-            default = datetime.datetime.now().replace(hour=0, minute=0,
-                                                      second=0, microsecond=0)
         seq = self._tokenize(timestr, **kwargs)
         if seq is None:
             raise ValueError, "unknown string format"
+        return self._digest_seq(seq, default, ignoretz, tzinfos)
+
+    # Builds the result from the token sequence. Separate from
+    # digest() so that digestcache can use it.
+    
+    def _digest_seq(self, seq, default, ignoretz, tzinfos):
+        if not default:
+            default = datetime.datetime.now().replace(hour=0, minute=0,
+                                                      second=0, microsecond=0)
         repl = {}
         res = seq.dt_obj
         for attr in ["year", "month", "day", "hour",
@@ -1103,6 +1111,144 @@ def digest(timestr, parserinfo=None, **kwargs):
     else:
         return DEFAULTPARSER.digest(timestr, **kwargs)
 
+# A memoizing version of digest(). The same date often appears many
+# times in a corpus, so first of all, we remember the results for
+# recent strings (the results are never modified, so they can be shared).
+# Beyond that, most of the dates in a corpus
+# share a handful of shapes (e.g., MM/DD/YYYY), and for those, the
+# token sequence is the same except for the digits. The shape of a string
+# is the string with each run of digits replaced by its length, whether
+# it has a leading zero, and the range its value falls in (the tokenizer's
+# decisions depend on, e.g., whether a number can be a month, a day or
+# an hour). For each shape, we keep a template which records the class,
+# position, length and features of each token. A later string with
+# the same shape is digested by slicing its tokens out at the same positions
+# and recomputing the values from the digits; building the datetime
+# validates the values, and if that fails, we ask the parser.
+#
+# A template is only kept if every numeric token is a whole run of digits
+# whose value can be recomputed from its digits (directly, or through
+# convertyear() for years), and
+# rebuilding the original string from the template yields the same
+# result the parser did. Otherwise, the shape is always parsed.
+
+_DIGIT_RUN = re.compile("[0-9]+")
+_VALUE_BOUNDARIES = [1, 12, 13, 24, 32, 60, 100]
+
+def _digit_shape(timestr):
+    return (_DIGIT_RUN.sub("0", timestr),
+            tuple([(len(s), s[0] == "0", bisect.bisect_right(_VALUE_BOUNDARIES, int(s)))
+                   for s in _DIGIT_RUN.findall(timestr)]))
+
+class digestcache(object):
+
+    def __init__(self, parser=None, maxshapes=1000, maxstrings=10000):
+        self.parser = parser or DEFAULTPARSER
+        self.maxshapes = maxshapes
+        self.maxstrings = maxstrings
+        # shape -> template, or None if the shape can't be templated.
+        self.templates = {}
+        self.results = {}
+
+    def digest(self, timestr):
+        try:
+            return self.results[timestr]
+        except KeyError:
+            pass
+        p = self._digest(timestr)
+        if len(self.results) >= self.maxstrings:
+            self.results.clear()
+        self.results[timestr] = p
+        return p
+
+    def _digest(self, timestr):
+        shape = _digit_shape(timestr)
+        try:
+            template = self.templates[shape]
+        except KeyError:
+            p = self.parser.digest(timestr)
+            if len(self.templates) >= self.maxshapes:
+                self.templates.clear()
+            self.templates[shape] = self._make_template(p, timestr)
+            return p
+        if template is not None:
+            try:
+                return self._rebuild(template, timestr)
+            except ValueError:
+                pass
+        return self.parser.digest(timestr)
+
+    def _make_template(self, p, timestr):
+        toks = []
+        for t in p.pseq.ordered_toks():
+            lit = t.literal
+            if timestr[t.pos:t.pos + len(lit)] != lit:
+                return None
+            if lit.isdigit():
+                # The shape only describes whole runs of digits, so a
+                # number carved out of a longer run (e.g., the month
+                # in YYYYMMDD) might have different features in a
+                # string with the same shape.
+                if (t.pos > 0 and timestr[t.pos - 1].isdigit()) or \
+                   timestr[t.pos + len(lit):t.pos + len(lit) + 1].isdigit():
+                    return None
+                if t.value == int(lit):
+                    kind = "int"
+                elif t.__class__ is _ptok_year and \
+                     t.value == self.parser.info.convertyear(int(lit)):
+                    kind = "year"
+                else:
+                    return None
+            elif _DIGIT_RUN.search(lit):
+                return None
+            else:
+                kind = "const"
+            toks.append((t.__class__, t.pos, len(lit), t.features, kind, t.value))
+        types = {}
+        for ptype, t in p.pseq.type_dict.items():
+            if t is None:
+                types[ptype] = None
+            else:
+                types[ptype] = t.pos
+        template = (toks, types, [len(x) for x in p.pseq.toks])
+        # Make sure the template reproduces what the parser did.
+        try:
+            q = self._rebuild(template, timestr)
+        except ValueError:
+            return None
+        for attr in parser._result.__slots__:
+            if getattr(q.res, attr) != getattr(p.res, attr):
+                return None
+        if q.dt != p.dt:
+            return None
+        if [(t.__class__, t.features) for t in q.pseq.ordered_toks()] != \
+           [(t.__class__, t.features) for t in p.pseq.ordered_toks()]:
+            return None
+        return template
+
+    def _rebuild(self, template, timestr):
+        toks, types, tokLengths = template
+        res = parser._result()
+        lexToks = []
+        i = 0
+        for n in tokLengths:
+            lexToks.append(timestr[i:i + n])
+            i += n
+        seq = _ptok_sequence(lexToks, res)
+        for ptype, pos, n, features, kind, value in toks:
+            lit = timestr[pos:pos + n]
+            if kind == "int":
+                value = int(lit)
+            elif kind == "year":
+                value = self.parser.info.convertyear(int(lit))
+            seq.tok_objs[pos] = ptype(lit, value, pos, features, res)
+        for ptype, pos in types.items():
+            if pos is None:
+                seq.type_dict[ptype] = None
+            else:
+                seq.type_dict[ptype] = seq.tok_objs[pos]
+        return self.parser._digest_seq(seq, None, False, None)
+
 
 class _tzparser(object):
 
@@ -0,0 +1,227 @@
+# Copyright (C) 2012 The MITRE Corporation. See the toplevel
+# file LICENSE for license terms.
+
+# This script benchmarks the replacement engines (see
+# ReplacementBenchmark.py in the core python directory) and writes
+# the results as JSON, so that a change to the engine can be compared
+# against the numbers from before it. Like docReplace.py, it uses ONLY
+# the replacement engine Python.
+
+# Each engine is measured in a separate process, so that the cold
+# start and peak memory figures for one engine don't include the
+# resources loaded by another.
+
+import sys, os
+
+def Usage():
+    print >> sys.stderr, """Usage: benchmarkReplacers.py [ --json_dir <dir> ] [ --task_py_dir <dir> ] [ --task_resource_dir <dir> ] [ --engine <spec> ] [ --engine_arg <key>=<value> ] [ --docs <n> ] [ --spans_per_doc <n> ] [ --seed <n> ] [ --in_process ] [ --output <file> ] [ --compare <file> ] corePyDir coreResourceDir
+
+corePyDir: the python/ directory in src/tasks/core
+coreResourceDir: the resources/ directory in src/tasks/core
+
+--json_dir <d>: a directory containing simplejson, for Python versions before 2.6, or Jython
+--task_py_dir <d>: the python/ directory in a task. May be repeated.
+--task_resource_dir <d>: the resources/ directory in a task. May be repeated.
+--engine <spec>: the engine to measure, as <module>.<class>, optionally followed by
+  =<module>.<categories> to name the category table to use. May be repeated.
+  The default is the core clear, DE-ID, character and bracket engines with the
+  core categories, plus the AMIA clear and DE-ID engines if AMIAReplacementEngine
+  can be found in the task python directories.
+--engine_arg <key>=<value>: a keyword argument for the engines, e.g.
+  resource_snapshot=none or cache_scope=PERSON,batch. May be repeated.
+--docs <n>: the number of synthetic documents. Default is 200.
+--spans_per_doc <n>: the number of spans in each document. Default is 20.
+--seed <n>: the random seed for the corpus and the engines. Default is 0.
+--in_process: measure all the engines in this process, rather than one
+  process each. The cold start and memory figures will be misleading.
+--output <file>: where to write the JSON report. Default is standard output.
+--compare <file>: a previous report. The ratio of the throughput and cold start
+  figures in the new report to the old ones is printed on standard error."""
+    sys.exit(1)
+
+import getopt
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], "", ["json_dir=", "task_py_dir=", "task_resource_dir=",
+                                                  "engine=", "engine_arg=", "docs=", "spans_per_doc=",
+                                                  "seed=", "in_process", "output=", "compare=",
+                                                  "child_engine="])
+except getopt.GetoptError, e:
+    print >> sys.stderr, e
+    Usage()
+
+if len(args) != 2:
+    Usage()
+
+[CORE_PY_DIR, CORE_RESOURCE_DIR] = args
+
+JSON_DIR = None
+TASK_PY_DIRS = []
+TASK_RESOURCE_DIRS = []
+ENGINES = []
+ENGINE_ARGS = {}
+DOCS = 200
+SPANS_PER_DOC = 20
+SEED = 0
+IN_PROCESS = False
+OUTPUT = None
+COMPARE = None
+# Internal: set when we're the subprocess for a single engine.
+CHILD_ENGINE = None
+try:
+    for k, v in opts:
+        if k == "--json_dir":
+            JSON_DIR = v
+        elif k == "--task_py_dir":
+            TASK_PY_DIRS.append(os.path.abspath(v))
+        elif k == "--task_resource_dir":
+            TASK_RESOURCE_DIRS.append(os.path.abspath(v))
+        elif k == "--engine":
+            ENGINES.append(v)
+        elif k == "--engine_arg":
+            toks = v.split("=", 1)
+            if len(toks) != 2:
+                print >> sys.stderr, "Bad engine_arg '%s'" % v
+                sys.exit(1)
+            ENGINE_ARGS[toks[0]] = toks[1]
+        elif k == "--docs":
+            DOCS = int(v)
+        elif k == "--spans_per_doc":
+            SPANS_PER_DOC = int(v)
+        elif k == "--seed":
+            SEED = int(v)
+        elif k == "--in_process":
+            IN_PROCESS = True
+        elif k == "--output":
+            OUTPUT = os.path.abspath(v)
+        elif k == "--compare":
+            COMPARE = os.path.abspath(v)
+        elif k == "--child_engine":
+            CHILD_ENGINE = v
+except ValueError, e:
+    print >> sys.stderr, e
+    Usage()
+
+# Set up the imports.
+sys.path = TASK_PY_DIRS + [os.path.abspath(CORE_PY_DIR)] + sys.path
+
+try:
+    import json
+except ImportError:
+    # Python 2.5, or Jython.
+    if JSON_DIR is None:
+        print >> sys.stderr, "No dir for simplejson specified. Exiting."
+        sys.exit(1)
+    sys.path.insert(0, JSON_DIR)
+    import simplejson as json
+
+import ReplacementBenchmark
+
+DATA_DIRS = TASK_RESOURCE_DIRS + [os.path.abspath(CORE_RESOURCE_DIR)]
+
+def _importName(name):
+    toks = name.rsplit(".", 1)
+    if len(toks) != 2:
+        raise ReplacementBenchmark.BenchmarkError, ("'%s' is not of the form <module>.<name>" % name)
+    try:
+        mod = __import__(toks[0])
+    except ImportError, e:
+        raise ReplacementBenchmark.BenchmarkError, str(e)
+    try:
+        return getattr(mod, toks[1])
+    except AttributeError:
+        raise ReplacementBenchmark.BenchmarkError, ("module %s has no element %s" % (toks[0], toks[1]))
+
+def _fmt(v):
+    if v is None:
+        return "n/a"
+    else:
+        return "%.4g" % v
+
+def benchmarkSpec(spec):
+    toks = spec.split("=", 1)
+    engineCls = _importName(toks[0])
+    if len(toks) == 2:
+        categories = _importName(toks[1])
+    else:
+        categories = ReplacementBenchmark.CORE_CATEGORIES
+    return ReplacementBenchmark.benchmarkEngine(engineCls, categories, DATA_DIRS,
+                                                numDocs = DOCS, spansPerDoc = SPANS_PER_DOC,
+                                                seed = SEED, engineName = spec, **ENGINE_ARGS)
+
+if CHILD_ENGINE is not None:
+    try:
+        result = benchmarkSpec(CHILD_ENGINE)
+    except ReplacementBenchmark.BenchmarkError, e:
+        print >> sys.stderr, e
+        sys.exit(1)
+    print json.dumps(result)
+    sys.exit(0)
+
+if not ENGINES:
+    ENGINES = ["ClearReplacementStrategy.ClearReplacementEngine",
+               "DEIDStyleReplacementEngine.DEIDStyleReplacementEngine",
+               "CharacterReplacementEngine.CharacterReplacementEngine",
+               "BracketReplacementEngine.BracketReplacementEngine"]
+    for d in TASK_PY_DIRS:
+        if os.path.exists(os.path.join(d, "AMIAReplacementEngine.py")):
+            ENGINES += ["AMIAReplacementEngine.AMIAPIIReplacementEngine=AMIAReplacementEngine.AMIA_CATEGORIES",
+                        "AMIAReplacementEngine.AMIADEIDReplacementEngine=AMIAReplacementEngine.AMIA_CATEGORIES"]
+            break
+
+report = ReplacementBenchmark.newReport(DOCS, SPANS_PER_DOC, SEED)
+
+if IN_PROCESS:
+    for spec in ENGINES:
+        print >> sys.stderr, "Benchmarking", spec
+        try:
+            report["engines"].append(benchmarkSpec(spec))
+        except Exception, e:
+            report["engines"].append({"engine": spec, "error": "%s: %s" % (e.__class__.__name__, e)})
+else:
+    import subprocess
+    childArgs = [sys.executable, os.path.abspath(sys.argv[0]),
+                 "--docs", str(DOCS), "--spans_per_doc", str(SPANS_PER_DOC), "--seed", str(SEED)]
+    if JSON_DIR is not None:
+        childArgs += ["--json_dir", JSON_DIR]
+    for d in TASK_PY_DIRS:
+        childArgs += ["--task_py_dir", d]
+    for d in TASK_RESOURCE_DIRS:
+        childArgs += ["--task_resource_dir", d]
+    for k, v in ENGINE_ARGS.items():
+        childArgs += ["--engine_arg", "%s=%s" % (k, v)]
+    for spec in ENGINES:
+        print >> sys.stderr, "Benchmarking", spec
+        p = subprocess.Popen(childArgs + ["--child_engine", spec, CORE_PY_DIR, CORE_RESOURCE_DIR],
+                             stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        out, err = p.communicate()
+        if p.returncode != 0:
+            report["engines"].append({"engine": spec, "error": err.strip()})
+        else:
+            report["engines"].append(json.loads(out))
+
+for e in report["engines"]:
+    if e.has_key("error"):
+        print >> sys.stderr, "%s failed:\n%s" % (e["engine"], e["error"])
+
+s = json.dumps(report, indent = 2, sort_keys = True)
+if OUTPUT is None:
+    print s
+else:
+    fp = open(OUTPUT, "w")
+    fp.write(s)
+    fp.close()
+
+if COMPARE is not None:
+    fp = open(COMPARE, "r")
+    oldReport = json.loads(fp.read())
+    fp.close()
+    for engine, label, measure, old, new, ratio in ReplacementBenchmark.compareReports(oldReport, report):
+        if ratio is None:
+            ratioStr = "n/a"
+        else:
+            ratioStr = "%.2f" % ratio
+        print >> sys.stderr, "%-60s %-10s %-20s %12s %12s %6s" % \
+              (engine, label or "(all)", measure, _fmt(old), _fmt(new), ratioStr)
+
+sys.exit(0)
@@ -0,0 +1,69 @@
+# Copyright (C) 2012 The MITRE Corporation. See the toplevel
+# file LICENSE for license terms.
+
+# This script compiles the replacement engine resources into a
+# snapshot (see ResourceSnapshot.py in the core python directory).
+# Like docReplace.py, it uses ONLY the replacement engine Python.
+
+import sys, os
+
+def Usage():
+    print >> sys.stderr, """Usage: buildResourceSnapshot.py [ --task_resource_dir <dir> ] [ --resource_file_repl <repl> ] [ --output <file> ] corePyDir coreResourceDir
+
+corePyDir: the python/ directory in src/tasks/core
+coreResourceDir: the resources/ directory in src/tasks/core
+
+--task_resource_dir <d>: the resources/ directory in a task. May be repeated. Task
+  resource directories take precedence over the core resource directory, as they
+  do in the replacement engine.
+--resource_file_repl <repl>: a semicolon-delimited sequence of <file>=<repl>, as
+  in the resource_file_repl argument to the nominate step.
+--output <file>: where to write the snapshot. The default is %s in the first
+  resource directory, which is where the replacement engine looks for it."""
+    sys.exit(1)
+
+import getopt
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], "", ["task_resource_dir=", "resource_file_repl=", "output="])
+except getopt.GetoptError, e:
+    print >> sys.stderr, e
+    Usage()
+
+if len(args) != 2:
+    Usage()
+
+[CORE_PY_DIR, CORE_RESOURCE_DIR] = args
+
+TASK_RESOURCE_DIRS = []
+RESOURCE_FILE_REPL = None
+OUTPUT = None
+for k, v in opts:
+    if k == "--task_resource_dir":
+        TASK_RESOURCE_DIRS.append(os.path.abspath(v))
+    elif k == "--resource_file_repl":
+        RESOURCE_FILE_REPL = v
+    elif k == "--output":
+        OUTPUT = os.path.abspath(v)
+
+sys.path.insert(0, CORE_PY_DIR)
+
+import ReplacementEngine, ResourceSnapshot
+
+DATA_DIRS = TASK_RESOURCE_DIRS + [os.path.abspath(CORE_RESOURCE_DIR)]
+
+resourceReplacements = {}
+if RESOURCE_FILE_REPL is not None:
+    for pair in RESOURCE_FILE_REPL.split(";"):
+        toks = pair.split("=", 1)
+        if len(toks) != 2:
+            print >> sys.stderr, "Bad resource_file_repl pair '%s'" % pair
+            sys.exit(1)
+        resourceReplacements[toks[0]] = toks[1]
+
+if OUTPUT is None:
+    OUTPUT = os.path.join(DATA_DIRS[0], ReplacementEngine.Repository.SNAPSHOT_FILE)
+
+ResourceSnapshot.compileSnapshot(DATA_DIRS, OUTPUT, resourceReplacements)
+print "Wrote", OUTPUT
+sys.exit(0)
@@ -0,0 +1,124 @@
+# Copyright (C) 2012 The MITRE Corporation. See the toplevel
+# file LICENSE for license terms.
+
+# This script runs the resident replacement server (see
+# ReplacementServer.py in the core python directory), which accepts
+# a stream of documents as JSON lines, and returns the replaced
+# signals and tuples. Like docReplace.py, it uses ONLY the
+# replacement engine Python.
+
+import sys, os
+
+def Usage():
+    print >> sys.stderr, """Usage: replacementServer.py [ --json_dir <dir> ] [ --task_py_dir <dir> ] [ --task_resource_dir <dir> ] [ --workers <n> ] [ --port <n> ] [ --preload <replacer> ] corePyDir coreResourceDir moduleName className
+
+corePyDir: the python/ directory in src/tasks/core
+coreResourceDir: the resources/ directory in src/tasks/core
+moduleName: the name of the Python module which contains the specific subclass of StandaloneReplacementEngine
+className: the name of the specific subclass of StandaloneReplacementEngine
+
+--json_dir <d>: a directory containing simplejson, for Python versions before 2.6, or Jython
+--task_py_dir <d>: the python/ directory in a task. May be repeated.
+--task_resource_dir <d>: the resources/ directory in a task. May be repeated.
+--workers <n>: the number of requests to process at once. The workers share
+  the engine's resources. Default is 1.
+--port <n>: listen for connections on this port on the local host, rather
+  than reading requests from standard input.
+--preload <replacer>: load the resources for this replacer (e.g., "clear -> clear")
+  before accepting any requests. May be repeated.
+
+See ReplacementServer.py for the format of the requests and responses."""
+    sys.exit(1)
+
+import getopt
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], "", ["json_dir=", "task_py_dir=", "task_resource_dir=",
+                                                  "workers=", "port=", "preload="])
+except getopt.GetoptError, e:
+    print >> sys.stderr, e
+    Usage()
+
+if len(args) != 4:
+    Usage()
+
+[CORE_PY_DIR, CORE_RESOURCE_DIR, SRE_MODULE, SRE_CLASS] = args
+
+JSON_DIR = None
+TASK_PY_DIRS = []
+TASK_RESOURCE_DIRS = []
+WORKERS = 1
+PORT = None
+PRELOAD = []
+try:
+    for k, v in opts:
+        if k == "--json_dir":
+            JSON_DIR = v
+        elif k == "--task_py_dir":
+            TASK_PY_DIRS.append(os.path.abspath(v))
+        elif k == "--task_resource_dir":
+            TASK_RESOURCE_DIRS.append(os.path.abspath(v))
+        elif k == "--workers":
+            WORKERS = int(v)
+        elif k == "--port":
+            PORT = int(v)
+        elif k == "--preload":
+            PRELOAD.append(v)
+except ValueError, e:
+    print >> sys.stderr, e
+    Usage()
+
+# Set up the imports.
+sys.path = TASK_PY_DIRS + [CORE_PY_DIR] + sys.path
+
+try:
+    import json
+except ImportError:
+    # Python 2.5, or Jython.
+    if JSON_DIR is None:
+        print >> sys.stderr, "No dir for simplejson specified. Exiting."
+        sys.exit(1)
+    sys.path.insert(0, JSON_DIR)
+
+try:
+    exec "import %s" % SRE_MODULE
+except ImportError, e:
+    print >> sys.stderr, e
+    sys.exit(1)
+
+try:
+    rClass = eval("%s.%s" % (SRE_MODULE, SRE_CLASS))
+except (ValueError, AttributeError), e:
+    print >> sys.stderr, e
+    sys.exit(1)
+
+import ReplacementEngine, ReplacementServer
+
+if not issubclass(rClass, ReplacementEngine.StandaloneReplacementEngine):
+    print >> sys.stderr, "The requested class is not a subclass of ReplacementEngine.StandaloneReplacementEngine"
+    sys.exit(1)
+
+def newEngine():
+    e = rClass()
+    for p in TASK_RESOURCE_DIRS:
+        e.addResourceDir(p)
+    e.addResourceDir(os.path.abspath(CORE_RESOURCE_DIR))
+    return e
+
+server = ReplacementServer.ReplacementServer(newEngine, workers = WORKERS)
+
+try:
+    server.preload(PRELOAD)
+except ReplacementEngine.StandaloneReplacementEngineError, e:
+    print >> sys.stderr, "Error:", str(e)
+    sys.exit(1)
+
+if PORT is None:
+    server.serveStream(sys.stdin, sys.stdout)
+else:
+    print >> sys.stderr, "Listening on port", PORT
+    try:
+        server.serveSocket(PORT)
+    except KeyboardInterrupt:
+        pass
+sys.exit(0)